@@ -1,141 +1,1195 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response, stream_with_context, has_request_context
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_cors import CORS
 from datetime import datetime, timedelta
 import uuid
+import argparse
+import base64
+import binascii
+import csv
 import hashlib
+import hmac
+import io
+import atexit
+import json
+import logging
+import logging.handlers
 import os
-import sqlite3
+import queue
+import random
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from functools import wraps
 
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+try:
+    import brotli  # необязательно: без него ответы сжимаются только gzip
+except ImportError:
+    brotli = None
+
+import bulk
+import metrics
+from licensekeys import KeyFormat, KnownKeyFilter
+from profiling import ProfilingMiddleware, StackSampler
+from ratelimit import create_rate_limiter, retry_after_header
+from sharedcache import MAX_HWIDS, SharedLicenseCache
+from storage import create_storage
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """jsonify с замером времени сериализации"""
+
+    def dumps(self, obj, **kwargs):
+        with metrics.JSON_SERIALIZATION_DURATION.time():
+            return super().dumps(obj, **kwargs)
+
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
 CORS(app)
 
 # ========== КОНФИГУРАЦИЯ ==========
+# Эндпоинты исходной версии (генерация, список лицензий, статистика) для
+# совместимости пускают с любым ключом. Новые админские эндпоинты (отзыв,
+# импорт/экспорт, пакетная генерация, логирование, профиль) требуют ключ и
+# закрыты, пока ADMIN_API_KEY не задан явно
 ADMIN_API_KEY = os.environ.get('ADMIN_API_KEY', 'BYDSQ123')
+ADMIN_API_KEY_CONFIGURED = bool(os.environ.get('ADMIN_API_KEY'))
 SERVER_SECRET = os.environ.get('SERVER_SECRET', 'BYDSQ123')
-DATABASE_URL = '/tmp/licenses.db'  # На Render.com можно писать в /tmp
+# postgres://... - общая база для нескольких инстансов, иначе путь к файлу SQLite
+DATABASE_URL = os.environ.get('DATABASE_URL', '/tmp/licenses.db')  # На Render.com можно писать в /tmp
+
+# Реплика PostgreSQL для эндпоинтов только для чтения (валидация, списки, статистика)
+DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL', '')
+# Сколько секунд после записи лицензии воркер валидирует ее по primary, а не по реплике
+DB_READ_LAG_WINDOW = float(os.environ.get('DB_READ_LAG_WINDOW', 5))
+
+# Пулы соединений (на каждый воркер gunicorn): запись и чтение раздельно
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_READ_POOL_SIZE = int(os.environ.get('DB_READ_POOL_SIZE', DB_POOL_SIZE))
+DB_TIMEOUT = int(os.environ.get('DB_TIMEOUT', 30))
+DB_HEALTH_CHECK_INTERVAL = int(os.environ.get('DB_HEALTH_CHECK_INTERVAL', 60))
+
+# PRAGMA SQLite применяются один раз при создании соединения
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    f"PRAGMA mmap_size={int(os.environ.get('SQLITE_MMAP_SIZE', 64 * 1024 * 1024))}",
+    f"PRAGMA cache_size={int(os.environ.get('SQLITE_CACHE_SIZE', -16000))}",
+    'PRAGMA temp_store=MEMORY',
+)
+
+# Кэш валидации (на каждый воркер gunicorn)
+VALIDATION_CACHE_SIZE = int(os.environ.get('VALIDATION_CACHE_SIZE', 50000))
+VALIDATION_CACHE_TTL = int(os.environ.get('VALIDATION_CACHE_TTL', 30))
+
+# Общий кэш состояния лицензий для всех воркеров хоста (префикс mmap-файла, например
+# /dev/shm/snos-license-cache; к имени добавляется разметка); пусто - выключен. SHARED_CACHE_TTL - за сколько
+# секунд активации и отзывы из других воркеров и инстансов становятся видны
+SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH', '')
+SHARED_CACHE_SIZE = int(os.environ.get('SHARED_CACHE_SIZE', 65536))
+SHARED_CACHE_TTL = float(os.environ.get('SHARED_CACHE_TTL', 5))
+
+# Ключи SNOS2-... несут HMAC от LICENSE_KEY_SECRET: подделку или опечатку
+# отсекаем без запроса к базе. Секрет нельзя менять после выдачи ключей
+LICENSE_KEY_SECRET = os.environ.get('LICENSE_KEY_SECRET', SERVER_SECRET)
+# Ключи старого формата и импортированные проверяет bloom-фильтр в памяти воркера;
+# импорт в другом воркере или инстансе виден не позже KEY_FILTER_REFRESH_INTERVAL
+KEY_FILTER_REFRESH_INTERVAL = int(os.environ.get('KEY_FILTER_REFRESH_INTERVAL', 60))
+KEY_FILTER_ERROR_RATE = float(os.environ.get('KEY_FILTER_ERROR_RATE', 0.01))
+
+# Пакетная генерация
+MAX_BATCH_GENERATE = int(os.environ.get('MAX_BATCH_GENERATE', 50000))
+
+# Пакетная валидация: максимум пар (license_key, hwid) в одном запросе
+MAX_BATCH_VALIDATE = int(os.environ.get('MAX_BATCH_VALIDATE', 1000))
+
+# Прогрев воркера до первого запроса: соединений в пуле и вердиктов
+# для устройств с последними активациями в кэше валидации
+DB_POOL_WARM = int(os.environ.get('DB_POOL_WARM', 2))
+VALIDATION_CACHE_WARM = int(os.environ.get('VALIDATION_CACHE_WARM', 1000))
+
+# Массовый импорт: строк в одной транзакции (executemany)
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 500))
+
+# Постраничный список лицензий
+LICENSES_PAGE_SIZE = int(os.environ.get('LICENSES_PAGE_SIZE', 100))
+LICENSES_MAX_PAGE_SIZE = int(os.environ.get('LICENSES_MAX_PAGE_SIZE', 1000))
+
+# Постраничные активации в деталях лицензии
+ACTIVATIONS_PAGE_SIZE = int(os.environ.get('ACTIVATIONS_PAGE_SIZE', 100))
+ACTIVATIONS_MAX_PAGE_SIZE = int(os.environ.get('ACTIVATIONS_MAX_PAGE_SIZE', 1000))
+
+# Сжатие ответов (gzip, br при установленном brotli): JSON от COMPRESS_MIN_SIZE байт и потоки
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+COMPRESS_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain')
+
+# Подписанные токены лицензий (Ed25519)
+# Ключ - base64 от 32-байтного seed; если не задан, выводится из SERVER_SECRET
+LICENSE_SIGNING_KEY = os.environ.get('LICENSE_SIGNING_KEY', '')
+# Клиент обновляет токен и список отзыва раз в TOKEN_REFRESH_INTERVAL; токен и
+# список живут TOKEN_TTL - столько отозванная лицензия может работать офлайн
+TOKEN_REFRESH_INTERVAL = int(os.environ.get('TOKEN_REFRESH_INTERVAL', 3600))
+TOKEN_TTL = int(os.environ.get('TOKEN_TTL', 4 * TOKEN_REFRESH_INTERVAL))
+REVOCATION_LIST_TTL = int(os.environ.get('REVOCATION_LIST_TTL', 60))
+
+# Логирование: JSON-строки через очередь и фоновый поток записи
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Доля логируемых запросов по маршруту, например "/api/validate=0.01,/api/activate=1"
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', '/api/validate=0.01')
+
+# Фоновое обслуживание: пометка истекших лицензий и архивация активаций
+EXPIRY_SWEEP_INTERVAL = int(os.environ.get('EXPIRY_SWEEP_INTERVAL', 60))
+EXPIRY_SWEEP_BATCH = int(os.environ.get('EXPIRY_SWEEP_BATCH', 1000))
+# Активации лицензий, истекших более N дней назад, уходят в архив (0 - не архивировать)
+ACTIVATION_ARCHIVE_DAYS = int(os.environ.get('ACTIVATION_ARCHIVE_DAYS', 90))
+ACTIVATION_ARCHIVE_INTERVAL = int(os.environ.get('ACTIVATION_ARCHIVE_INTERVAL', 3600))
+ACTIVATION_ARCHIVE_BATCH = int(os.environ.get('ACTIVATION_ARCHIVE_BATCH', 1000))
+# Архивные активации старше N дней сворачиваются в сводки по лицензии и дню (0 - не сворачивать)
+ACTIVATION_COMPACT_DAYS = int(os.environ.get('ACTIVATION_COMPACT_DAYS', 365))
+ACTIVATION_COMPACT_INTERVAL = int(os.environ.get('ACTIVATION_COMPACT_INTERVAL', 6 * 3600))
+ACTIVATION_COMPACT_BATCH = int(os.environ.get('ACTIVATION_COMPACT_BATCH', 5000))
+
+# Групповая фиксация активаций: запросы воркера объединяются в общие транзакции
+# (один commit/fsync на пачку); ответ уходит только после фиксации
+ACTIVATION_GROUP_COMMIT = os.environ.get('ACTIVATION_GROUP_COMMIT', '0').lower() in ('1', 'true', 'yes')
+ACTIVATION_BATCH_SIZE = int(os.environ.get('ACTIVATION_BATCH_SIZE', 64))
+ACTIVATION_BATCH_DELAY_MS = float(os.environ.get('ACTIVATION_BATCH_DELAY_MS', 2))
+
+# Ограничение частоты /api/activate и /api/validate (token bucket: запросов/с и запас)
+# По умолчанию лимит на воркер; redis://... - общий для всех воркеров
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', '')
+RATE_LIMIT_IP_RATE = float(os.environ.get('RATE_LIMIT_IP_RATE', 20))
+RATE_LIMIT_IP_BURST = int(os.environ.get('RATE_LIMIT_IP_BURST', 100))
+RATE_LIMIT_KEY_RATE = float(os.environ.get('RATE_LIMIT_KEY_RATE', 2))
+RATE_LIMIT_KEY_BURST = int(os.environ.get('RATE_LIMIT_KEY_BURST', 20))
+# Число доверенных прокси перед сервером (Render - 1): IP клиента берется из X-Forwarded-For
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+
+# Статистика
+STATS_RECONCILE_INTERVAL = int(os.environ.get('STATS_RECONCILE_INTERVAL', 300))
+STATS_DAILY_DAYS = int(os.environ.get('STATS_DAILY_DAYS', 30))
+
+# Профилирование запросов сэмплером стеков (выключено - middleware не ставится).
+# Профилируется доля PROFILE_SAMPLE_RATE запросов и запросы с заголовком
+# X-Profile: 1 и админским X-API-Key; итоги - GET /api/admin/profile
+PROFILING = os.environ.get('PROFILING', '0').lower() in ('1', 'true', 'yes')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
+
+# ========== ПРОФИЛИРОВАНИЕ ==========
+profiler = StackSampler(PROFILE_INTERVAL_MS / 1000) if PROFILING else None
+
+def profile_requested(environ):
+    """Запрос с X-Profile: 1 от администратора"""
+    return environ.get('HTTP_X_PROFILE') == '1' and is_admin_key(environ.get('HTTP_X_API_KEY', ''))
+
+def profile_label(environ):
+    """Маршрут запроса для итогов профиля: 'POST /api/activate'"""
+    try:
+        rule, _ = app.url_map.bind_to_environ(environ).match(return_rule=True)
+        route = rule.rule
+    except Exception:
+        route = 'unmatched'
+    return f"{environ.get('REQUEST_METHOD')} {route}"
+
+if profiler is not None:
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app, profiler, PROFILE_SAMPLE_RATE,
+                                       force=profile_requested, label=profile_label)
+
+# ========== ЛОГИРОВАНИЕ ==========
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись"""
+
+    FIELDS = ('request_id', 'method', 'path', 'status', 'duration_ms', 'ip')
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry, ensure_ascii=False)
+
+class RequestIdFilter(logging.Filter):
+    """Добавляет request id текущего запроса (выполняется в потоке запроса)"""
+
+    def filter(self, record):
+        if getattr(record, 'request_id', None) is None and has_request_context():
+            record.request_id = g.get('request_id')
+        return True
+
+def parse_sample_rates(value):
+    rates = {}
+    for item in value.split(','):
+        path, sep, rate = item.strip().partition('=')
+        if sep:
+            rates[path] = float(rate)
+    return rates
+
+def setup_logging():
+    """Запросы только кладут запись в очередь; форматирует и пишет в stdout отдельный поток
+
+    Возвращает (логгер, обработчик вывода): экспорт в stdout переключает его на stderr.
+    """
+    log_queue = queue.SimpleQueue()
+    
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    
+    def start_listener():
+        listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        listener.start()
+        atexit.register(listener.stop)
+    
+    start_listener()
+    # Поток записи не переживает fork (preload_app в gunicorn) - в дочернем процессе свой
+    os.register_at_fork(after_in_child=start_listener)
+    
+    root_logger = logging.getLogger('snos')
+    root_logger.setLevel(LOG_LEVEL)
+    root_logger.addHandler(queue_handler)
+    root_logger.propagate = False
+    return root_logger, stream_handler
+
+logger, log_stream_handler = setup_logging()
+access_logger = logging.getLogger('snos.access')
+log_sample_rates = parse_sample_rates(LOG_SAMPLE_RATES)
 
 # ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
-def init_database():
+def init_database(storage):
     """Инициализирует базу данных"""
     try:
-        print(f"[INIT] Creating database at: {DATABASE_URL}")
-        
-        conn = sqlite3.connect(DATABASE_URL, check_same_thread=False, timeout=30)
-        c = conn.cursor()
-        
-        # Таблица лицензий
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS licenses (
-                id TEXT PRIMARY KEY,
-                license_key TEXT UNIQUE NOT NULL,
-                created_at TIMESTAMP NOT NULL,
-                expires_at TIMESTAMP NOT NULL,
-                max_activations INTEGER DEFAULT 1,
-                current_activations INTEGER DEFAULT 0,
-                is_active BOOLEAN DEFAULT 1,
-                notes TEXT,
-                created_by TEXT,
-                source TEXT DEFAULT 'server'
-            )
-        ''')
-        
-        # Таблица активаций
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS activations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                license_key TEXT NOT NULL,
-                hwid TEXT NOT NULL,
-                device_name TEXT,
-                platform TEXT,
-                activation_time TIMESTAMP NOT NULL,
-                ip_address TEXT,
-                user_agent TEXT
-            )
-        ''')
-        
-        # Индексы для скорости
-        c.execute('CREATE INDEX IF NOT EXISTS idx_license_key ON licenses(license_key)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_activations_license ON activations(license_key)')
-        
-        # Создаем тестовую лицензию если нет
-        test_key = "TEST-SNOS-0000-0000-0000-0000-0001"
-        c.execute("SELECT * FROM licenses WHERE license_key = ?", (test_key,))
-        if not c.fetchone():
-            license_id = str(uuid.uuid4())
-            created_at = datetime.now()
-            expires_at = created_at + timedelta(days=365)
-            
-            c.execute('''
-                INSERT INTO licenses (id, license_key, created_at, expires_at, max_activations, notes, created_by)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                license_id,
-                test_key,
-                created_at.isoformat(),
-                expires_at.isoformat(),
-                999,
-                "Test license for development",
-                "system"
-            ))
-            print(f"[INIT] Created test license: {test_key}")
-        
-        conn.commit()
-        conn.close()
-        print("[INIT] Database initialized successfully")
+        storage.init_schema()
+        logger.info("Database initialized successfully")
         return True
         
     except Exception as e:
-        print(f"[ERROR] Database initialization failed: {e}")
+        logger.exception("Database initialization failed: %s", e)
         return False
 
-def get_db_connection():
-    """Возвращает соединение с базой данных"""
+_storage = None
+_storage_pid = None
+_storage_lock = threading.Lock()
+# Схема проверена и мигрирована; в мастере gunicorn ставится до fork и наследуется воркерами
+_schema_ready = False
+
+def create_app_storage():
+    return create_storage(
+        DATABASE_URL,
+        pragmas=SQLITE_PRAGMAS,
+        read_url=DATABASE_READ_URL or None,
+        pool_size=DB_POOL_SIZE,
+        read_pool_size=DB_READ_POOL_SIZE,
+        timeout=DB_TIMEOUT,
+        health_check_interval=DB_HEALTH_CHECK_INTERVAL,
+        daily_days=STATS_DAILY_DAYS
+    )
+
+def get_storage():
+    """Возвращает хранилище текущего процесса (после fork создается новое)"""
+    global _storage, _storage_pid, _schema_ready
+    pid = os.getpid()
+    if _storage is None or _storage_pid != pid:
+        with _storage_lock:
+            if _storage is None or _storage_pid != pid:
+                storage = create_app_storage()
+                # Схему проверяем один раз на процесс, а не на каждый запрос
+                if _schema_ready:
+                    storage.initialized = True
+                else:
+                    _schema_ready = init_database(storage)
+                _storage = storage
+                _storage_pid = pid
+                start_background_jobs()
+    return _storage
+
+def get_db_connection(readonly=False):
+    """Возвращает соединение из пула, закрепленное за текущим запросом
+
+    readonly=True - соединение пула чтения (mode=ro в SQLite, реплика
+    PostgreSQL) для эндпоинтов, которые ничего не пишут.
+    """
+    name = 'db_read' if readonly else 'db'
     try:
-        # Проверяем, существует ли база
-        if not os.path.exists(DATABASE_URL):
-            init_database()
-        
-        conn = sqlite3.connect(DATABASE_URL, check_same_thread=False, timeout=30)
-        conn.row_factory = sqlite3.Row
-        return conn
+        if name not in g:
+            storage = get_storage()
+            with metrics.DB_ACQUIRE_DURATION.time(pool='read' if readonly else 'write'):
+                setattr(g, name, storage.acquire(readonly))
+        return g.get(name)
     except Exception as e:
-        print(f"[ERROR] Database connection failed: {e}")
+        logger.exception("Database connection failed: %s", e)
         return None
 
+@app.teardown_appcontext
+def release_db_connection(error):
+    """Возвращает соединения запроса в пулы"""
+    for name, readonly in (('db', False), ('db_read', True)):
+        conn = g.pop(name, None)
+        if conn is not None:
+            get_storage().release(conn, readonly)
+
+# ========== КЭШ ВАЛИДАЦИИ ==========
+class ValidationCache:
+    """LRU-кэш вердиктов валидации с TTL, ключ - (license_key, hwid)
+
+    Кэш локален для процесса: активация и отзыв сбрасывают записи лицензии
+    в своем воркере, в остальных запись живет не дольше TTL.
+    """
+
+    def __init__(self, max_size=VALIDATION_CACHE_SIZE, ttl=VALIDATION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (license_key, hwid) -> (payload, deadline)
+        self._by_license = {}          # license_key -> {hwid, ...}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _remove(self, cache_key):
+        self._entries.pop(cache_key, None)
+        license_key, hwid = cache_key
+        hwids = self._by_license.get(license_key)
+        if hwids is not None:
+            hwids.discard(hwid)
+            if not hwids:
+                del self._by_license[license_key]
+
+    def get(self, license_key, hwid):
+        cache_key = (license_key, hwid)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, deadline = entry
+            if deadline <= time.monotonic():
+                self._remove(cache_key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return payload
+
+    def set(self, license_key, hwid, payload, ttl=None):
+        """Сохраняет вердикт; ttl ограничивает жизнь записи (например, до истечения лицензии)"""
+        if self.max_size <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        cache_key = (license_key, hwid)
+        with self._lock:
+            self._entries[cache_key] = (payload, time.monotonic() + ttl)
+            self._entries.move_to_end(cache_key)
+            self._by_license.setdefault(license_key, set()).add(hwid)
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def purge_expired(self):
+        """Удаляет записи с истекшим TTL (get убирает их только при обращении)"""
+        now = time.monotonic()
+        with self._lock:
+            stale = [cache_key for cache_key, (_, deadline) in self._entries.items() if deadline <= now]
+            for cache_key in stale:
+                self._remove(cache_key)
+            self.expirations += len(stale)
+        return len(stale)
+
+    def invalidate(self, license_key):
+        """Сбрасывает все записи лицензии (активация, отзыв, истечение)"""
+        with self._lock:
+            for hwid in self._by_license.pop(license_key, ()):
+                self._entries.pop((license_key, hwid), None)
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations
+            }
+
+shared_cache = SharedLicenseCache(SHARED_CACHE_PATH, SHARED_CACHE_SIZE, SHARED_CACHE_TTL) if SHARED_CACHE_PATH else None
+
+# С общим кэшем локальный вердикт не должен жить дольше записи общего кэша:
+# отзыв в соседнем воркере виден всем не позже SHARED_CACHE_TTL
+validation_cache = ValidationCache(
+    ttl=min(VALIDATION_CACHE_TTL, SHARED_CACHE_TTL) if shared_cache else VALIDATION_CACHE_TTL
+)
+
+key_format = KeyFormat(LICENSE_KEY_SECRET)
+known_keys = KnownKeyFilter(key_format, KEY_FILTER_ERROR_RATE)
+
+def check_key(license_key):
+    """Проверка ключа без базы: True - ключ может существовать, False - точно нет
+    (новый формат с неверным HMAC), None - ключ старого формата мимо фильтра
+
+    Фильтр старых ключей может отстать от базы: ключ мог вставить инстанс
+    прошлой версии или ручной SQL без key_filter_version.
+    """
+    if key_format.verify(license_key) or known_keys.might_contain(license_key):
+        return True
+    if key_format.matches(license_key):
+        return False
+    return None
+
+def is_known_key(license_key, readonly=False):
+    """False - ключа нет в базе; ключ старого формата мимо фильтра проверяется одним запросом"""
+    known = check_key(license_key)
+    if known is None:
+        conn = get_db_connection(readonly=readonly)
+        # Без соединения не отказываем: ошибку базы вернет основной запрос
+        known = conn is None or get_storage().has_license(conn, license_key)
+        if known:
+            known_keys.add(license_key)
+            logger.info("Key %s... is missing from the key filter, added", license_key[:20])
+    return known
+
+def refresh_key_filter(storage):
+    """Пересобирает фильтр ключей, если в базе появились ключи без HMAC"""
+    started = time.perf_counter()
+    with storage.connection(readonly=True) as conn:
+        rebuilt = known_keys.refresh(storage, conn)
+    if rebuilt:
+        logger.info("Built license key filter: %d legacy keys in %.1f ms",
+                    known_keys.keys, (time.perf_counter() - started) * 1000)
+    return rebuilt
+
+# Лицензии, записанные этим воркером за последние DB_READ_LAG_WINDOW секунд:
+# реплика могла их еще не получить (только при DATABASE_READ_URL)
+recent_writes = {}
+_recent_writes_lock = threading.Lock()
+
+def invalidate_license(license_key):
+    """Сбрасывает закэшированные вердикты лицензии: свой воркер и общий кэш хоста"""
+    validation_cache.invalidate(license_key)
+    if shared_cache is not None:
+        shared_cache.invalidate(license_key)
+    if DATABASE_READ_URL:
+        now = time.monotonic()
+        with _recent_writes_lock:
+            if len(recent_writes) >= 10000:
+                for key in [key for key, deadline in recent_writes.items() if deadline <= now]:
+                    del recent_writes[key]
+            recent_writes[license_key] = now + DB_READ_LAG_WINDOW
+
+def reads_from_replica(*license_keys):
+    """True - лицензии можно читать с реплики: она есть, и этот воркер их недавно не писал"""
+    if not DATABASE_READ_URL:
+        return False
+    now = time.monotonic()
+    return all(recent_writes.get(key, 0) <= now for key in license_keys)
+
+# Причина вердикта для метрик - по тексту ответа, он стабилен для клиентов
+VALIDATION_OUTCOMES = {
+    'License key not found': 'not_found',
+    'License has been revoked': 'revoked',
+    'License has expired': 'expired',
+    'License not activated on this device': 'not_activated',
+    'License is valid': 'valid'
+}
+
+def record_validation_outcome(payload):
+    metrics.LICENSE_OUTCOMES.inc(endpoint='validate',
+                                 outcome=VALIDATION_OUTCOMES.get(payload['message'], 'other'))
+
+def evaluate_license(conn, license_key, hwid, replica=False):
+    """Проверяет лицензию по базе, возвращает (ответ, ttl для кэша)
+
+    ttl=None означает, что вердикт кэшировать нельзя. replica=True - conn
+    читает реплику: состояние без этого устройства в общий кэш не кладем,
+    реплика могла еще не получить его активацию.
+    """
+    storage = get_storage()
+    license_dict = storage.get_license(conn, license_key)
+    if shared_cache is None or not license_dict:
+        return license_verdict(license_key, hwid, license_dict,
+                               lambda: storage.has_activation(conn, license_key, hwid))
+    
+    # Для общего кэша читаем активации лицензии целиком (до MAX_HWIDS устройств)
+    hwids = storage.get_activated_hwids(conn, license_key, MAX_HWIDS + 1)
+    if not (replica and hwid and hwid not in hwids):
+        shared_cache.set(license_key, license_dict, hwids)
+    return license_verdict(
+        license_key, hwid, license_dict,
+        lambda: hwid in hwids or (len(hwids) > MAX_HWIDS and storage.has_activation(conn, license_key, hwid))
+    )
+
+def shared_verdict(license_key, hwid):
+    """Вердикт по общему кэшу воркеров без обращения к базе; None - кэш не знает ответа"""
+    if shared_cache is None:
+        return None
+    entry = shared_cache.get(license_key)
+    if entry is None:
+        return None
+    
+    license_dict, fingerprints, complete = entry
+    activated = not hwid or shared_cache.fingerprint(hwid) in fingerprints
+    if not activated and not complete:
+        # Устройство может быть среди активаций, не поместившихся в запись
+        return None
+    return license_verdict(license_key, hwid, license_dict, lambda: activated)
+
+def license_verdict(license_key, hwid, license_dict, is_activated):
+    """Вердикт валидации по уже прочитанной лицензии
+
+    is_activated() вызывается, только если HWID передан и лицензия
+    прошла остальные проверки.
+    """
+    if not license_dict:
+        return {
+            'valid': False,
+            'message': 'License key not found'
+        }, None
+    
+    # Проверяем активность
+    if license_dict['status'] == 'revoked':
+        return {
+            'valid': False,
+            'message': 'License has been revoked'
+        }, VALIDATION_CACHE_TTL
+    
+    # Проверяем срок: status='expired' ставит фоновый обход, до него решает время
+    seconds_left = license_dict['expires_at'] - time.time()
+    if license_dict['status'] == 'expired' or seconds_left < 0:
+        return {
+            'valid': False,
+            'message': 'License has expired',
+            'expired_at': format_timestamp(license_dict['expires_at'])
+        }, VALIDATION_CACHE_TTL
+    
+    # Если передан HWID, проверяем активацию. Отказ не кэшируем: активация
+    # в другом воркере сбрасывает только свой кэш, и устройство видело бы
+    # "not activated" до VALIDATION_CACHE_TTL
+    if hwid:
+        if not is_activated():
+            return {
+                'valid': False,
+                'message': 'License not activated on this device'
+            }, None
+    
+    payload = {
+        'valid': True,
+        'message': 'License is valid',
+        'license_key': license_key,
+        'expires_at': format_timestamp(license_dict['expires_at']),
+        'max_activations': license_dict['max_activations'],
+        'current_activations': license_dict['current_activations'],
+        'is_active': bool(license_dict['is_active'])
+    }
+    
+    # Токен привязан к устройству, поэтому выдается только при переданном HWID
+    if hwid:
+        payload['token'] = issue_license_token(license_key, hwid, license_dict['expires_at'])
+    
+    # Положительный вердикт не должен пережить срок лицензии
+    return payload, seconds_left
+
+# ========== СТАТИСТИКА ==========
+def reconcile_stats_job():
+    """Фоновая сверка счетчиков с таблицами"""
+    storage = get_storage()
+    with storage.connection() as conn:
+        if storage.reconcile_stats(conn, STATS_RECONCILE_INTERVAL):
+            logger.info("Stats counters reconciled")
+
+# ========== ГРУППОВАЯ ФИКСАЦИЯ АКТИВАЦИЙ ==========
+class ActivationTimeout(Exception):
+    """Активация не дождалась фиксации пачки
+
+    unknown=False - активация снята с очереди и точно не зафиксирована,
+    unknown=True - пачка уже фиксировалась, исход неизвестен.
+    """
+
+    def __init__(self, unknown):
+        super().__init__('activation result is unknown' if unknown else 'activation was not committed')
+        self.unknown = unknown
+
+class ActivationBatcher:
+    """Очередь активаций воркера и поток, фиксирующий их пачками
+
+    Лимит max_activations по-прежнему проверяет условный UPDATE в базе,
+    поэтому гарантия держится и между воркерами. Поток запускается лениво
+    в каждом процессе (после fork gunicorn). Пачку ждем max_delay, только
+    если другие запросы уже ждут фиксации: у sync-воркера gunicorn запрос
+    один, и активация фиксируется сразу.
+    """
+
+    def __init__(self, max_batch=ACTIVATION_BATCH_SIZE, max_delay=ACTIVATION_BATCH_DELAY_MS / 1000):
+        self.max_batch = max(max_batch, 1)
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+        self._waiting = 0
+
+    def _get_queue(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._run, args=(self._queue,), name='activation-batcher',
+                                     daemon=True).start()
+                    self._pid = pid
+        return self._queue
+
+    def submit(self, *activation):
+        """Ставит активацию в очередь и ждет фиксации; результат как у storage.activate
+
+        Не дождавшись, снимает активацию с очереди, чтобы она не зафиксировалась
+        после ответа клиенту, и бросает ActivationTimeout.
+        """
+        future = Future()
+        pending = self._get_queue()
+        with self._lock:
+            self._waiting += 1
+        try:
+            pending.put((activation, future))
+            try:
+                return future.result(timeout=DB_TIMEOUT * 2)
+            except FutureTimeoutError:
+                raise ActivationTimeout(unknown=not future.cancel())
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def _run(self, pending):
+        while True:
+            batch = [pending.get()]
+            try:
+                # Пока фиксировалась прошлая пачка, очередь могла накопиться;
+                # ждать остальных есть смысл, только если кто-то еще в очереди
+                deadline = time.monotonic() + self.max_delay
+                while len(batch) < self.max_batch:
+                    timeout = max(0, deadline - time.monotonic()) if self._waiting > len(batch) else 0
+                    try:
+                        batch.append(pending.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+                # Снятые по таймауту активации не фиксируем
+                batch = [(activation, future) for activation, future in batch
+                         if future.set_running_or_notify_cancel()]
+                if batch:
+                    self._flush(batch)
+            except Exception as e:
+                # Поток не должен умирать: иначе все следующие submit зависнут
+                logger.exception("Activation batcher failed: %s", e)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _flush(self, batch):
+        try:
+            metrics.ACTIVATION_BATCH_SIZE.observe(len(batch))
+            storage = get_storage()
+            with storage.connection() as conn:
+                results = storage.activate_many(conn, [activation for activation, _ in batch])
+        except Exception as e:
+            logger.exception("Activation batch of %d failed: %s", len(batch), e)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+activation_batcher = ActivationBatcher()
+
+# ========== ОБСЛУЖИВАНИЕ ==========
+def expiry_sweep_job():
+    """Помечает истекшие лицензии и чистит кэш валидации
+
+    Кэши других воркеров не сбрасываются: положительный вердикт в них
+    и так живет не дольше срока лицензии.
+    """
+    storage = get_storage()
+    with storage.connection() as conn:
+        swept = storage.sweep_expired(conn, EXPIRY_SWEEP_BATCH)
+    for license_key in swept:
+        invalidate_license(license_key)
+    purged = validation_cache.purge_expired()
+    if swept:
+        logger.info("Marked %d licenses expired, purged %d cache entries", len(swept), purged)
+
+def archive_activations_job():
+    """Переносит активации давно истекших лицензий в activations_archive"""
+    storage = get_storage()
+    with storage.connection() as conn:
+        archived = storage.archive_activations(
+            conn, int(time.time()) - ACTIVATION_ARCHIVE_DAYS * 24 * 3600, ACTIVATION_ARCHIVE_BATCH
+        )
+    if archived:
+        logger.info("Archived %d activations", archived)
+
+def compact_activations_job():
+    """Сворачивает старые строки activations_archive в activation_summaries"""
+    storage = get_storage()
+    with storage.connection() as conn:
+        compacted = storage.compact_activations(
+            conn, int(time.time()) - ACTIVATION_COMPACT_DAYS * 24 * 3600, ACTIVATION_COMPACT_BATCH
+        )
+    if compacted:
+        logger.info("Compacted %d archived activations", compacted)
+
+# ========== ФОНОВЫЕ ЗАДАЧИ ==========
+def start_background_job(name, interval, func):
+    """Запускает func каждые interval секунд в daemon-потоке"""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                func()
+            except Exception as e:
+                logger.exception("Background job %s failed: %s", name, e)
+    
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+def key_filter_job():
+    refresh_key_filter(get_storage())
+
+def start_background_jobs():
+    """Фоновые задачи процесса-воркера"""
+    start_background_job('key-filter', KEY_FILTER_REFRESH_INTERVAL, key_filter_job)
+    start_background_job('stats-reconcile', STATS_RECONCILE_INTERVAL, reconcile_stats_job)
+    start_background_job('expiry-sweep', EXPIRY_SWEEP_INTERVAL, expiry_sweep_job)
+    if ACTIVATION_ARCHIVE_DAYS > 0:
+        start_background_job('activation-archive', ACTIVATION_ARCHIVE_INTERVAL, archive_activations_job)
+    if ACTIVATION_COMPACT_DAYS > 0:
+        start_background_job('activation-compact', ACTIVATION_COMPACT_INTERVAL, compact_activations_job)
+
+# ========== СТАРТ И ГОТОВНОСТЬ ==========
+_ready_pid = None
+_warmup_stats = {}
+_warmup_lock = threading.Lock()
+
+def prepare_database():
+    """Миграции схемы до запуска воркеров (хук on_starting в gunicorn.conf.py)
+
+    Соединения закрываются до fork, воркеры наследуют _schema_ready
+    и фильтр ключей и не повторяют ни проверку схемы, ни сборку фильтра.
+    """
+    global _schema_ready
+    storage = create_app_storage()
+    try:
+        _schema_ready = init_database(storage)
+        if _schema_ready:
+            refresh_key_filter(storage)
+    finally:
+        storage.close()
+    return _schema_ready
+
+def warm_validation_cache(storage, limit):
+    """Кладет в кэш вердикты для устройств с последними активациями, возвращает их число"""
+    with storage.connection(readonly=True) as conn:
+        pairs = storage.recent_activations(conn, limit)
+        licenses = storage.get_licenses_for_validation(conn, pairs)
+    
+    for license_key, hwid in pairs:
+        license_dict, activated = licenses.get(license_key, (None, ()))
+        payload, ttl = license_verdict(license_key, hwid, license_dict, lambda: hwid in activated)
+        if ttl is not None:
+            validation_cache.set(license_key, hwid, payload, ttl)
+    return len(pairs)
+
+def warm_up():
+    """Прогрев воркера: хранилище и фоновые задачи, пул соединений, кэш валидации
+
+    Вызывается хуком post_worker_init, при старте ASGI и dev-сервера;
+    без хуков - первой проверкой /api/ready.
+    """
+    global _ready_pid, _warmup_stats
+    with _warmup_lock:
+        if is_ready():
+            return True
+        
+        started = time.perf_counter()
+        storage = get_storage()
+        if not storage.initialized:
+            return False
+        
+        try:
+            connections = storage.warm_pool(DB_POOL_WARM)
+            refresh_key_filter(storage)
+            cached = warm_validation_cache(storage, VALIDATION_CACHE_WARM) if VALIDATION_CACHE_WARM > 0 else 0
+        except Exception as e:
+            logger.exception("Warm-up failed: %s", e)
+            return False
+        
+        _warmup_stats = {
+            'connections': connections,
+            'legacy_keys': known_keys.keys,
+            'cached_verdicts': cached,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 3)
+        }
+        _ready_pid = os.getpid()
+        logger.info("Worker %s ready: %d connections, %d cached verdicts in %.1f ms",
+                    _ready_pid, connections, cached, _warmup_stats['duration_ms'])
+        return True
+
+def is_ready():
+    return _ready_pid == os.getpid()
+
 def generate_license_key():
-    """Генерирует лицензионный ключ"""
-    key_base = hashlib.sha256(
-        f"{uuid.uuid4()}{SERVER_SECRET}{datetime.now().timestamp()}".encode()
-    ).hexdigest().upper()
-    return f"SNOS-{key_base[:4]}-{key_base[4:8]}-{key_base[8:12]}-{key_base[12:16]}-{key_base[16:20]}"
+    """Генерирует лицензионный ключ SNOS2-... с HMAC (старые SNOS-... по-прежнему принимаются)"""
+    return key_format.generate()
+
+def format_timestamp(value):
+    """Время из базы (секунды epoch) -> ISO-строка для ответов API"""
+    return datetime.fromtimestamp(value).isoformat() if value is not None else None
+
+def format_row(row):
+    """Строка лицензии или активации: поля времени - в ISO, как в ответах API"""
+    for field in ('created_at', 'expires_at', 'activation_time'):
+        if row.get(field) is not None:
+            row[field] = format_timestamp(row[field])
+    return row
+
+def encode_cursor(row, field='created_at'):
+    """Курсор пагинации: позиция (field, id) последней выданной строки"""
+    raw = f"{row[field]}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    created_at, sep, license_id = raw.partition('|')
+    if not sep:
+        raise ValueError('Invalid cursor')
+    return int(created_at), license_id
+
+def iter_export_rows(conn, table):
+    """Строки таблицы для экспорта, читаются из курсора БД"""
+    storage = get_storage()
+    if table == 'licenses':
+        return storage.iter_license_rows(conn)
+    return storage.iter_activations(conn)
+
+def with_etag(response, etag):
+    """Слабый ETag (тело может быть сжато) и обязательная перепроверка клиентом"""
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def not_modified(etag):
+    return with_etag(Response(status=304), etag)
+
+# ========== ПОДПИСАННЫЕ ТОКЕНЫ ==========
+def _load_signing_key():
+    if LICENSE_SIGNING_KEY:
+        seed = base64.b64decode(LICENSE_SIGNING_KEY)
+    else:
+        seed = hashlib.sha256(f"snos-license-token:{SERVER_SECRET}".encode()).digest()
+    return Ed25519PrivateKey.from_private_bytes(seed)
+
+signing_key = _load_signing_key()
+public_key_bytes = signing_key.public_key().public_bytes(
+    encoding=serialization.Encoding.Raw,
+    format=serialization.PublicFormat.Raw
+)
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+def issue_license_token(license_key, hwid, expires_at):
+    """Короткоживущий токен для офлайн-проверки на клиенте (expires_at - epoch лицензии)
+
+    Формат: base64url(JSON payload) + "." + base64url(подпись Ed25519 над payload).
+    Клиент проверяет подпись публичным ключом (/api/token/public-key) и
+    обращается к серверу только после refresh_by; после exp токен недействителен.
+    """
+    now = int(time.time())
+    exp = min(now + TOKEN_TTL, expires_at)
+    payload = json.dumps({
+        'v': 1,
+        'license_key': license_key,
+        'hwid': hwid,
+        'expires_at': format_timestamp(expires_at),
+        'iat': now,
+        'refresh_by': min(now + TOKEN_REFRESH_INTERVAL, exp),
+        'exp': exp
+    }, separators=(',', ':'), sort_keys=True).encode()
+    return f"{_b64url(payload)}.{_b64url(signing_key.sign(payload))}"
+
+class RevocationList:
+    """Подписанный список отозванных ключей; версию в базе проверяет не чаще раза в REVOCATION_LIST_TTL
+
+    Подписывается канонический JSON целиком: ключи, version (растет с каждым
+    отзывом), issued_at и expires_at. Клиент проверяет подпись над payload,
+    отвергает список с version меньше уже виденной и список после expires_at -
+    старый список нельзя выдать за свежий.
+
+    issued_at выровнен по периоду TOKEN_TTL / 2, а подпись Ed25519
+    детерминирована, поэтому все воркеры и все пересборки в пределах периода
+    отдают одно и то же тело. ETag - версия и период: клиент с If-None-Match
+    получает 304, пока нет нового отзыва, а свежую подпись - не позже, чем
+    за половину TOKEN_TTL до истечения своей.
+    """
+
+    def __init__(self, ttl=REVOCATION_LIST_TTL, period=max(TOKEN_TTL // 2, 1)):
+        self.ttl = ttl
+        self.period = period
+        self._lock = threading.Lock()
+        self._body = None
+        self._etag = None
+        self._deadline = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._deadline = 0
+
+    def get(self, load_version, load_keys):
+        """Возвращает (тело ответа, ETag)
+
+        load_version() - версия списка из базы, load_keys() - отозванные ключи;
+        ключи читаются и список подписывается заново, только когда сменилась
+        версия или период подписи.
+        """
+        with self._lock:
+            if self._body is None or self._deadline <= time.monotonic():
+                version = load_version()
+                issued_at = int(time.time()) // self.period * self.period
+                etag = f'{version}.{issued_at}'
+                if etag != self._etag:
+                    self._body = self._build(version, issued_at, load_keys())
+                    self._etag = etag
+                self._deadline = time.monotonic() + self.ttl
+            return self._body, self._etag
+
+    def _build(self, version, issued_at, revoked):
+        payload = json.dumps({
+            'v': 1,
+            'version': version,
+            'issued_at': issued_at,
+            'expires_at': issued_at + TOKEN_TTL,
+            'revoked': revoked
+        }, separators=(',', ':'), sort_keys=True).encode()
+        return json.dumps({
+            'success': True,
+            'count': len(revoked),
+            'version': version,
+            'issued_at': issued_at,
+            'revoked': revoked,
+            'payload': _b64url(payload),
+            'signature': _b64url(signing_key.sign(payload))
+        })
+
+revocation_list = RevocationList()
+
+# ========== МЕТРИКИ ==========
+def _pool_metrics():
+    stats = get_storage().pool_stats()
+    return {(key,): value for key, value in stats.items()}
+
+def _cache_metrics():
+    stats = validation_cache.stats()
+    return {(key,): stats[key] for key in ('size', 'hits', 'misses', 'evictions', 'expirations', 'invalidations')}
+
+metrics.registry.gauge('snos_db_pool_connections', 'Connection pool state of this worker', ('state',),
+                       callback=_pool_metrics)
+metrics.registry.gauge('snos_validation_cache', 'Validation cache size and lifetime counters', ('field',),
+                       callback=_cache_metrics)
+if shared_cache is not None:
+    metrics.registry.gauge('snos_shared_cache', 'Shared license cache lookups by this worker', ('field',),
+                           callback=lambda: {(key,): value for key, value in shared_cache.stats().items()})
+
+# ========== ОГРАНИЧЕНИЕ ЧАСТОТЫ ==========
+ip_rate_limiter = create_rate_limiter(RATE_LIMIT_BACKEND, RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST, 'ip')
+key_rate_limiter = create_rate_limiter(RATE_LIMIT_BACKEND, RATE_LIMIT_KEY_RATE, RATE_LIMIT_KEY_BURST, 'key')
+
+# ========== СЖАТИЕ ОТВЕТОВ ==========
+def _choose_encoding():
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def _compressor(encoding):
+    """(сжать порцию, сбросить накопленное, завершить поток)"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=min(COMPRESS_LEVEL, 11))
+        return compressor.process, compressor.flush, compressor.finish
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+def _compress_stream(chunks, encoding):
+    """Сжимает поток по порциям: каждая уходит клиенту сразу, без буферизации всего ответа"""
+    compress, flush, finish = _compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if chunk:
+                yield compress(chunk) + flush()
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+@app.after_request
+def compress_response(response):
+    """gzip/br для больших JSON-ответов и потоков NDJSON/CSV"""
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    if not response.is_streamed and response.calculate_content_length() < COMPRESS_MIN_SIZE:
+        return response
+    
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+    
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        compress, _, finish = _compressor(encoding)
+        response.set_data(compress(response.get_data()) + finish())
+    response.headers['Content-Encoding'] = encoding
+    return response
 
 # ========== ДЕКОРАТОРЫ ==========
+def is_admin_key(api_key):
+    """Ключ совпадает с ADMIN_API_KEY; без явно заданного ключа - всегда False"""
+    return ADMIN_API_KEY_CONFIGURED and hmac.compare_digest(api_key.encode(), ADMIN_API_KEY.encode())
+
 def require_api_key(f):
-    """Проверяет API ключ"""
+    """Проверяет API ключ эндпоинтов исходной версии: неверный только логируется"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # Для простоты принимаем любой ключ или отсутствие ключа
         api_key = request.headers.get('X-API-Key', '')
         
-        if api_key and api_key != ADMIN_API_KEY:
-            print(f"[WARNING] Invalid API key: {api_key[:10]}...")
+        if api_key and not hmac.compare_digest(api_key.encode(), ADMIN_API_KEY.encode()):
+            logger.warning("Invalid API key for %s", request.path)
             # Все равно продолжаем для совместимости
         
         return f(*args, **kwargs)
     return decorated_function
 
-def log_request(f):
-    """Логирует запросы"""
+def require_admin_key(f):
+    """Пускает только с X-API-Key, равным явно заданному ADMIN_API_KEY"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        ip = request.remote_addr
-        endpoint = request.path
-        method = request.method
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] {method} {endpoint} - IP: {ip}")
+        if not ADMIN_API_KEY_CONFIGURED:
+            return jsonify({
+                'success': False,
+                'message': 'Admin API is disabled: ADMIN_API_KEY is not set'
+            }), 503
+        
+        api_key = request.headers.get('X-API-Key', '')
+        if not is_admin_key(api_key):
+            logger.warning("Rejected admin request to %s: invalid API key", request.path)
+            return jsonify({
+                'success': False,
+                'message': 'Invalid or missing API key'
+            }), 401
+        
+        return f(*args, **kwargs)
+    return decorated_function
+
+def rate_limit(f):
+    """Отклоняет частые запросы с 429 и Retry-After до логирования и работы с базой
+
+    Лимиты - по IP клиента и по license_key из тела запроса.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        checks = [('ip', ip_rate_limiter, request.remote_addr or '')]
+        data = request.get_json(silent=True)
+        if isinstance(data, dict) and isinstance(data.get('license_key'), str):
+            checks.append(('license_key', key_rate_limiter, data['license_key'].strip()))
+        
+        for scope, limiter, key in checks:
+            if limiter is None or not key:
+                continue
+            retry_after = limiter.hit(key)
+            if retry_after:
+                metrics.RATE_LIMITED.inc(endpoint=request.path, scope=scope)
+                retry_after = retry_after_header(retry_after)
+                response = jsonify({
+                    'success': False,
+                    'valid': False,
+                    'message': 'Too many requests, retry later',
+                    'retry_after': int(retry_after)
+                })
+                response.status_code = 429
+                response.headers['Retry-After'] = retry_after
+                return response
+        
         return f(*args, **kwargs)
     return decorated_function
 
+def log_request(f):
+    """Логирует запросы: JSON-строка с request id, статусом и длительностью"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16]
+        started = time.perf_counter()
+        
+        response = app.make_response(f(*args, **kwargs))
+        response.headers['X-Request-ID'] = g.request_id
+        
+        route = request.url_rule.rule if request.url_rule else request.path
+        duration = time.perf_counter() - started
+        metrics.HTTP_REQUEST_DURATION.observe(duration, endpoint=route, method=request.method)
+        metrics.HTTP_REQUESTS.inc(endpoint=route, method=request.method, status=response.status_code)
+        
+        # Для горячих маршрутов пишем только выборку, ошибки сервера - всегда
+        if access_logger.isEnabledFor(logging.INFO) and (
+            response.status_code >= 500 or random.random() < log_sample_rates.get(route, 1.0)
+        ):
+            access_logger.info('%s %s %s', request.method, request.path, response.status_code, extra={
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round(duration * 1000, 3),
+                'ip': request.remote_addr
+            })
+        return response
+    return decorated_function
+
 # ========== API ENDPOINTS ==========
 @app.route('/')
 def index():
@@ -144,15 +1198,24 @@ def index():
         'service': 'Snos Tool License Server',
         'version': '2.0.0',
         'status': 'online',
-        'database': 'sqlite',
+        'database': get_storage().name,
         'test_key': 'TEST-SNOS-0000-0000-0000-0000-0001',
         'endpoints': [
             'GET /api/test - Test server',
-            'POST /api/generate - Generate license (X-API-Key: BYDSQ123)',
+            'GET /api/ready - Worker readiness (schema, pool and cache warmed up)',
+            'POST /api/generate - Generate license (X-API-Key: ADMIN_API_KEY)',
+            'POST /api/generate/batch - Generate licenses in bulk (NDJSON/CSV)',
             'POST /api/activate - Activate license',
             'POST /api/validate - Validate license',
-            'GET /api/licenses - List all licenses',
-            'GET /api/license/<key> - Get license details'
+            'POST /api/validate/batch - Validate many (license_key, hwid) pairs at once',
+            'POST /api/revoke - Revoke license',
+            'GET /api/token/public-key - Public key for offline token verification',
+            'GET /api/revocations - Signed revocation list (ETag/If-None-Match)',
+            'GET /api/licenses - List licenses (limit, cursor, status, source, created_by, format=ndjson; ETag)',
+            'GET /api/license/<key> - Get license details with activations (limit, cursor; ETag/If-None-Match)',
+            'POST /api/admin/import/<licenses|activations> - Stream import from CSV/NDJSON body',
+            'GET /api/admin/export/<licenses|activations> - Stream export (format=ndjson|csv)',
+            'GET /api/admin/profile - Sampled request profile as collapsed stacks (PROFILING=1; DELETE resets)'
         ]
     })
 
@@ -167,34 +1230,504 @@ def test():
         'server_version': '2.0.0'
     })
 
-@app.route('/api/generate', methods=['POST'])
-@require_api_key
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    """Готовность воркера принимать трафик; /api/test только показывает, что процесс жив"""
+    if not is_ready() and not warm_up():
+        return jsonify({
+            'ready': False,
+            'message': 'Database is not initialized'
+        }), 503
+    
+    return jsonify({
+        'ready': True,
+        'pid': os.getpid(),
+        'database': get_storage().name,
+        'warmup': _warmup_stats
+    })
+
+@app.route('/api/generate', methods=['POST'])
+@require_api_key
+@log_request
+def generate_license():
+    """Генерация нового лицензионного ключа"""
+    try:
+        data = request.json or {}
+        
+        # Получаем параметры
+        days_valid = int(data.get('days_valid', 30))
+        max_activations = int(data.get('max_activations', 1))
+        notes = data.get('notes', '')
+        created_by = data.get('created_by', 'admin_panel')
+        
+        # Валидация
+        if days_valid <= 0 or max_activations <= 0:
+            return jsonify({
+                'success': False,
+                'message': 'days_valid and max_activations must be positive numbers'
+            }), 400
+        
+        # В базе время хранится в целых секундах
+        created_at = datetime.now().replace(microsecond=0)
+        expires_at = created_at + timedelta(days=days_valid)
+        
+        # Сохраняем в базу
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({
+                'success': False,
+                'message': 'Database connection failed'
+            }), 500
+        
+        # Вставляем лицензию (коллизия ключа перегенерируется внутри)
+        [(license_id, license_key)] = get_storage().create_licenses(
+            conn, 1, generate_license_key, created_at, expires_at, max_activations, notes, created_by
+        )
+        
+        logger.info("Created license %s", license_key)
+        
+        return jsonify({
+            'success': True,
+            'license_key': license_key,
+            'license_id': license_id,
+            'created_at': created_at.isoformat(),
+            'expires_at': expires_at.isoformat(),
+            'max_activations': max_activations,
+            'message': f'License generated successfully for {days_valid} days'
+        })
+        
+    except Exception as e:
+        logger.exception("Generate failed: %s", e)
+        return jsonify({
+            'success': False,
+            'message': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/api/generate/batch', methods=['POST'])
+@require_admin_key
+@log_request
+def generate_license_batch():
+    """Пакетная генерация лицензий (ответ - поток NDJSON или CSV)"""
+    try:
+        data = request.json or {}
+        
+        # Получаем параметры
+        count = int(data.get('count', 0))
+        days_valid = int(data.get('days_valid', 30))
+        max_activations = int(data.get('max_activations', 1))
+        notes = data.get('notes', '')
+        created_by = data.get('created_by', 'admin_panel')
+        output_format = data.get('format', request.args.get('format', 'ndjson')).lower()
+        
+        # Валидация
+        if not 0 < count <= MAX_BATCH_GENERATE:
+            return jsonify({
+                'success': False,
+                'message': f'count must be between 1 and {MAX_BATCH_GENERATE}'
+            }), 400
+        
+        if days_valid <= 0 or max_activations <= 0:
+            return jsonify({
+                'success': False,
+                'message': 'days_valid and max_activations must be positive numbers'
+            }), 400
+        
+        if output_format not in ('ndjson', 'csv'):
+            return jsonify({
+                'success': False,
+                'message': 'format must be ndjson or csv'
+            }), 400
+        
+        # В базе время хранится в целых секундах
+        created_at = datetime.now().replace(microsecond=0)
+        expires_at = created_at + timedelta(days=days_valid)
+        
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({
+                'success': False,
+                'message': 'Database connection failed'
+            }), 500
+        
+        # Вся пачка - одна транзакция
+        created = get_storage().create_licenses(
+            conn, count, generate_license_key, created_at, expires_at, max_activations, notes, created_by
+        )
+        
+        logger.info("Created %d licenses in batch", len(created))
+        
+        created_at = created_at.isoformat()
+        expires_at = expires_at.isoformat()
+        
+        def generate_ndjson():
+            for license_id, license_key in created:
+                yield json.dumps({
+                    'license_key': license_key,
+                    'license_id': license_id,
+                    'created_at': created_at,
+                    'expires_at': expires_at,
+                    'max_activations': max_activations
+                }) + '\n'
+        
+        def generate_csv():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(['license_key', 'license_id', 'created_at', 'expires_at', 'max_activations'])
+            for i, (license_id, license_key) in enumerate(created, 1):
+                writer.writerow([license_key, license_id, created_at, expires_at, max_activations])
+                if i % 1000 == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        
+        if output_format == 'csv':
+            body, mimetype = generate_csv(), 'text/csv'
+        else:
+            body, mimetype = generate_ndjson(), 'application/x-ndjson'
+        
+        return Response(body, mimetype=mimetype, headers={'X-License-Count': str(len(created))})
+        
+    except Exception as e:
+        logger.exception("Generate batch failed: %s", e)
+        return jsonify({
+            'success': False,
+            'message': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/api/activate', methods=['POST'])
+@rate_limit
+@log_request
+def activate_license():
+    """Активация лицензии"""
+    try:
+        data = request.json or {}
+        
+        license_key = data.get('license_key', '').strip()
+        hwid = data.get('hwid', '').strip()
+        
+        logger.debug("Activate key=%s... hwid=%s...", license_key[:20], hwid[:10])
+        
+        # Валидация
+        if not license_key:
+            return jsonify({
+                'success': False,
+                'message': 'License key is required'
+            }), 400
+        
+        if not hwid:
+            return jsonify({
+                'success': False,
+                'message': 'HWID is required'
+            }), 400
+        
+        # Несуществующий ключ отсекаем без запроса к базе (старые ключи мимо фильтра - одним запросом)
+        if not is_known_key(license_key):
+            metrics.LICENSE_OUTCOMES.inc(endpoint='activate', outcome='rejected_key')
+            return jsonify({
+                'success': False,
+                'message': 'License key not found'
+            }), 404
+        
+        # Подключаемся к базе
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({
+                'success': False,
+                'message': 'Database connection failed'
+            }), 500
+        
+        storage = get_storage()
+        
+        # Лицензия и активация этого устройства одним запросом
+        license_dict = storage.get_license_for_activation(conn, license_key, hwid)
+        
+        if not license_dict:
+            metrics.LICENSE_OUTCOMES.inc(endpoint='activate', outcome='not_found')
+            return jsonify({
+                'success': False,
+                'message': 'License key not found'
+            }), 404
+        
+        # Проверяем активность
+        if license_dict['status'] == 'revoked':
+            metrics.LICENSE_OUTCOMES.inc(endpoint='activate', outcome='revoked')
+            return jsonify({
+                'success': False,
+                'message': 'License has been revoked'
+            }), 400
+        
+        # Проверяем срок
+        expires_at = format_timestamp(license_dict['expires_at'])
+        if license_dict['status'] == 'expired' or license_dict['expires_at'] < time.time():
+            metrics.LICENSE_OUTCOMES.inc(endpoint='activate', outcome='expired')
+            return jsonify({
+                'success': False,
+                'message': 'License has expired',
+                'expired_at': expires_at
+            }), 400
+        
+        max_reached = {
+            'success': False,
+            'message': f'Maximum activations reached ({license_dict["max_activations"]})'
+        }
+        
+        # Проверяем активации (денормализованный счетчик вместо COUNT(*))
+        if license_dict['current_activations'] >= license_dict['max_activations']:
+            metrics.LICENSE_OUTCOMES.inc(endpoint='activate', outcome='max_activations')
+            return jsonify(max_reached), 400
+        
+        already_activated = {
+            'success': True,
+            'message': 'License already activated on this device',
+            'already_activated': True,
+            'activation_time': format_timestamp(license_dict['existing_activation_time']),
+            'license_key': license_key,
+            'hwid': hwid,
+            'expires_at': expires_at
+        }
+        
+        # Проверяем, активирована ли уже на этом устройстве
+        if license_dict['existing_activation_time'] is not None:
+            metrics.LICENSE_OUTCOMES.inc(endpoint='activate', outcome='already_activated')
+            already_activated['token'] = issue_license_token(license_key, hwid, license_dict['expires_at'])
+            return jsonify(already_activated)
+        
+        # Активируем одной короткой пишущей транзакцией
+        device_info = data.get('device_info', {})
+        activation = (
+            license_key,
+            hwid,
+            device_info.get('device_name', 'Unknown'),
+            device_info.get('platform', 'Unknown'),
+            datetime.now(),
+            request.remote_addr,
+            request.headers.get('User-Agent', 'Unknown')[:200]
+        )
+        if ACTIVATION_GROUP_COMMIT:
+            # Соединение запроса больше не нужно: отдаем его пулу, пока ждем пачку
+            release_db_connection(None)
+            try:
+                result, activation_time = activation_batcher.submit(*activation)
+            except ActivationTimeout as e:
+                # Не отвечаем "не активирована": повтор на том же устройстве безопасен
+                # и вернет already_activated, если пачка все же зафиксировалась
+                logger.warning("Activation of %s... timed out: %s", license_key[:20], e)
+                response = jsonify({
+                    'success': False,
+                    'message': ('Activation result is unknown, retry later' if e.unknown
+                                else 'Activation was not committed, retry later'),
+                    'result_unknown': e.unknown,
+                    'retry_after': 1
+                })
+                response.status_code = 503
+                response.headers['Retry-After'] = '1'
+                return response
+        else:
+            result, activation_time = storage.activate(conn, *activation)
+        
+        if result == 'max_reached':
+            metrics.LICENSE_OUTCOMES.inc(endpoint='activate', outcome='max_activations')
+            return jsonify(max_reached), 400
+        
+        if result == 'already_activated':
+            metrics.LICENSE_OUTCOMES.inc(endpoint='activate', outcome='already_activated')
+            already_activated['activation_time'] = format_timestamp(activation_time)
+            already_activated['token'] = issue_license_token(license_key, hwid, license_dict['expires_at'])
+            return jsonify(already_activated)
+        
+        invalidate_license(license_key)
+        metrics.LICENSE_OUTCOMES.inc(endpoint='activate', outcome='activated')
+        
+        logger.info("Activated %s... on %s...", license_key[:20], hwid[:10])
+        
+        return jsonify({
+            'success': True,
+            'message': 'License activated successfully',
+            'license_key': license_key,
+            'hwid': hwid,
+            'activation_time': format_timestamp(activation_time),
+            'expires_at': expires_at,
+            'max_activations': license_dict['max_activations'],
+            'current_activations': license_dict['current_activations'] + 1,
+            'already_activated': False,
+            'token': issue_license_token(license_key, hwid, license_dict['expires_at'])
+        })
+        
+    except Exception as e:
+        logger.exception("Activate failed: %s", e)
+        return jsonify({
+            'success': False,
+            'message': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/api/validate', methods=['POST'])
+@rate_limit
+@log_request
+def validate_license():
+    """Валидация лицензии"""
+    try:
+        data = request.json or {}
+        
+        license_key = data.get('license_key', '').strip()
+        hwid = data.get('hwid', '').strip()
+        
+        logger.debug("Validate key=%s... hwid=%s...", license_key[:20], hwid[:10])
+        
+        # Валидация
+        if not license_key:
+            return jsonify({
+                'valid': False,
+                'message': 'License key is required'
+            }), 400
+        
+        if not is_known_key(license_key, readonly=reads_from_replica(license_key) or not DATABASE_READ_URL):
+            metrics.LICENSE_OUTCOMES.inc(endpoint='validate', outcome='rejected_key')
+            return jsonify({
+                'valid': False,
+                'message': 'License key not found'
+            })
+        
+        cached = validation_cache.get(license_key, hwid)
+        if cached is not None:
+            record_validation_outcome(cached)
+            return jsonify(cached)
+        
+        # Общий кэш воркеров хоста, в базу - только при промахе. Лицензию,
+        # которую этот воркер только что записал, читаем с primary, не с реплики
+        verdict = shared_verdict(license_key, hwid)
+        if verdict is None:
+            replica = reads_from_replica(license_key)
+            conn = get_db_connection(readonly=replica or not DATABASE_READ_URL)
+            if not conn:
+                return jsonify({
+                    'valid': False,
+                    'message': 'Database connection failed'
+                }), 500
+            
+            verdict = evaluate_license(conn, license_key, hwid, replica=replica)
+        payload, ttl = verdict
+        
+        if ttl is not None:
+            validation_cache.set(license_key, hwid, payload, ttl)
+        
+        record_validation_outcome(payload)
+        return jsonify(payload)
+        
+    except Exception as e:
+        logger.exception("Validate failed: %s", e)
+        return jsonify({
+            'valid': False,
+            'message': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/api/validate/batch', methods=['POST'])
+@rate_limit
+@log_request
+def validate_license_batch():
+    """Пакетная валидация пар (license_key, hwid) - для прокси и многоместных клиентов
+
+    Вердикты те же, что у /api/validate, в порядке запроса.
+    """
+    try:
+        data = request.json or {}
+        items = data.get('items')
+        
+        # Валидация
+        if not isinstance(items, list) or not 0 < len(items) <= MAX_BATCH_VALIDATE:
+            return jsonify({
+                'success': False,
+                'message': f'items must be a list of 1 to {MAX_BATCH_VALIDATE} objects'
+            }), 400
+        
+        pairs = []
+        for item in items:
+            if not isinstance(item, dict):
+                return jsonify({
+                    'success': False,
+                    'message': 'Each item must be an object with license_key and hwid'
+                }), 400
+            pairs.append((str(item.get('license_key') or '').strip(), str(item.get('hwid') or '').strip()))
+        
+        # Сначала кэш, в базу - только промахи
+        verdicts = {}
+        for license_key, hwid in pairs:
+            if not license_key:
+                verdicts[(license_key, hwid)] = {
+                    'valid': False,
+                    'message': 'License key is required'
+                }
+            elif check_key(license_key) is False:
+                # Старые ключи мимо фильтра проверит общий запрос к базе ниже
+                verdicts[(license_key, hwid)] = {
+                    'valid': False,
+                    'message': 'License key not found'
+                }
+            elif (license_key, hwid) not in verdicts:
+                cached = validation_cache.get(license_key, hwid)
+                if cached is None:
+                    verdict = shared_verdict(license_key, hwid)
+                    if verdict is not None:
+                        cached, ttl = verdict
+                        if ttl is not None:
+                            validation_cache.set(license_key, hwid, cached, ttl)
+                if cached is not None:
+                    verdicts[(license_key, hwid)] = cached
+        
+        missing = [pair for pair in dict.fromkeys(pairs) if pair not in verdicts]
+        if missing:
+            replica = reads_from_replica(*(license_key for license_key, _ in missing))
+            conn = get_db_connection(readonly=replica or not DATABASE_READ_URL)
+            if not conn:
+                return jsonify({
+                    'success': False,
+                    'message': 'Database connection failed'
+                }), 500
+            
+            licenses = get_storage().get_licenses_for_validation(conn, missing)
+            for license_key, hwid in missing:
+                license_dict, activated = licenses.get(license_key, (None, ()))
+                payload, ttl = license_verdict(license_key, hwid, license_dict, lambda: hwid in activated)
+                
+                if ttl is not None:
+                    validation_cache.set(license_key, hwid, payload, ttl)
+                verdicts[(license_key, hwid)] = payload
+        
+        results = []
+        for license_key, hwid in pairs:
+            payload = verdicts[(license_key, hwid)]
+            if license_key:
+                record_validation_outcome(payload)
+            results.append({'license_key': license_key, 'hwid': hwid, **payload})
+        
+        return jsonify({
+            'success': True,
+            'count': len(results),
+            'results': results
+        })
+        
+    except Exception as e:
+        logger.exception("Batch validate failed: %s", e)
+        return jsonify({
+            'success': False,
+            'message': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/api/revoke', methods=['POST'])
+@require_admin_key
 @log_request
-def generate_license():
-    """Генерация нового лицензионного ключа"""
+def revoke_license():
+    """Отзыв лицензии"""
     try:
         data = request.json or {}
+        license_key = data.get('license_key', '').strip()
         
-        # Получаем параметры
-        days_valid = int(data.get('days_valid', 30))
-        max_activations = int(data.get('max_activations', 1))
-        notes = data.get('notes', '')
-        created_by = data.get('created_by', 'admin_panel')
-        
-        # Валидация
-        if days_valid <= 0 or max_activations <= 0:
+        if not license_key:
             return jsonify({
                 'success': False,
-                'message': 'days_valid and max_activations must be positive numbers'
+                'message': 'License key is required'
             }), 400
         
-        # Генерируем ключ
-        license_key = generate_license_key()
-        license_id = str(uuid.uuid4())
-        created_at = datetime.now()
-        expires_at = created_at + timedelta(days=days_valid)
-        
-        # Сохраняем в базу
         conn = get_db_connection()
         if not conn:
             return jsonify({
@@ -202,82 +1735,131 @@ def generate_license():
                 'message': 'Database connection failed'
             }), 500
         
-        try:
-            c = conn.cursor()
-            
-            # Вставляем лицензию
-            c.execute('''
-                INSERT INTO licenses (id, license_key, created_at, expires_at, max_activations, notes, created_by)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                license_id,
-                license_key,
-                created_at.isoformat(),
-                expires_at.isoformat(),
-                max_activations,
-                notes,
-                created_by
-            ))
-            
-            conn.commit()
-            conn.close()
-            
-            print(f"[GENERATE] Created license: {license_key}")
-            
+        revoked = get_storage().revoke(conn, license_key)
+        invalidate_license(license_key)
+        revocation_list.invalidate()
+        
+        if not revoked:
             return jsonify({
-                'success': True,
-                'license_key': license_key,
-                'license_id': license_id,
-                'created_at': created_at.isoformat(),
-                'expires_at': expires_at.isoformat(),
-                'max_activations': max_activations,
-                'message': f'License generated successfully for {days_valid} days'
-            })
-            
-        except sqlite3.IntegrityError:
-            conn.rollback()
-            conn.close()
-            # Если ключ уже существует (маловероятно), генерируем новый
-            return generate_license()  # Рекурсивно вызываем снова
-            
-        except Exception as e:
-            conn.rollback()
-            conn.close()
-            raise e
-            
+                'success': False,
+                'message': 'License not found'
+            }), 404
+        
+        logger.info("Revoked license %s...", license_key[:20])
+        
+        return jsonify({
+            'success': True,
+            'message': 'License revoked',
+            'license_key': license_key
+        })
+        
     except Exception as e:
-        print(f"[ERROR] Generate: {e}")
+        logger.exception("Revoke failed: %s", e)
         return jsonify({
             'success': False,
             'message': f'Server error: {str(e)}'
         }), 500
 
-@app.route('/api/activate', methods=['POST'])
+@app.route('/api/token/public-key', methods=['GET'])
+def get_token_public_key():
+    """Публичный ключ для офлайн-проверки токенов"""
+    return jsonify({
+        'success': True,
+        'algorithm': 'Ed25519',
+        'public_key': base64.b64encode(public_key_bytes).decode()
+    })
+
+def load_revocation_version():
+    """Версия списка отзыва; читается до ключей - ключей не меньше, чем в ней"""
+    return get_storage().get_counter(get_db_connection(readonly=True), 'revocation_version')
+
+def load_revoked_keys():
+    return get_storage().list_revoked_keys(get_db_connection(readonly=True))
+
+@app.route('/api/revocations', methods=['GET'])
 @log_request
-def activate_license():
-    """Активация лицензии"""
+def get_revocations():
+    """Список отозванных ключей с поддержкой If-None-Match"""
     try:
-        data = request.json or {}
+        body, etag = revocation_list.get(load_revocation_version, load_revoked_keys)
         
-        license_key = data.get('license_key', '').strip()
-        hwid = data.get('hwid', '').strip()
+        if etag in request.if_none_match:
+            return Response(status=304, headers={'ETag': f'"{etag}"'})
         
-        print(f"[ACTIVATE] Key: {license_key[:20]}..., HWID: {hwid[:10]}...")
+        return Response(body, mimetype='application/json', headers={
+            'ETag': f'"{etag}"',
+            'Cache-Control': f'public, max-age={REVOCATION_LIST_TTL}'
+        })
         
-        # Валидация
-        if not license_key:
+    except Exception as e:
+        logger.exception("Get revocations failed: %s", e)
+        return jsonify({
+            'success': False,
+            'message': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/api/admin/logging', methods=['GET', 'POST'])
+@require_admin_key
+def configure_logging():
+    """Уровни логирования и доли выборки во время работы (в пределах воркера)"""
+    try:
+        if request.method == 'POST':
+            data = request.json or {}
+            
+            level = str(data.get('level', '')).upper()
+            if level:
+                if not isinstance(logging.getLevelName(level), int):
+                    return jsonify({
+                        'success': False,
+                        'message': f'Unknown log level: {level}'
+                    }), 400
+                logging.getLogger(data.get('logger', 'snos')).setLevel(level)
+            
+            sample_rates = data.get('sample_rates')
+            if isinstance(sample_rates, dict):
+                log_sample_rates.update({path: float(rate) for path, rate in sample_rates.items()})
+        
+        return jsonify({
+            'success': True,
+            'level': logging.getLevelName(logger.getEffectiveLevel()),
+            'loggers': {
+                name: logging.getLevelName(logging.getLogger(name).getEffectiveLevel())
+                for name in ('snos', 'snos.access', 'snos.storage')
+            },
+            'sample_rates': log_sample_rates,
+            'pid': os.getpid()
+        })
+        
+    except Exception as e:
+        logger.exception("Configure logging failed: %s", e)
+        return jsonify({
+            'success': False,
+            'message': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/api/admin/import/<table>', methods=['POST'])
+@require_admin_key
+@log_request
+def import_records(table):
+    """Потоковый импорт лицензий или активаций: тело запроса - файл CSV или NDJSON
+
+    Тело читается построчно и вставляется порциями по IMPORT_CHUNK_SIZE,
+    каждая порция - своя транзакция. Формат - ?format= или Content-Type.
+    """
+    try:
+        if table not in bulk.TABLES:
             return jsonify({
                 'success': False,
-                'message': 'License key is required'
-            }), 400
+                'message': 'table must be licenses or activations'
+            }), 404
         
-        if not hwid:
+        input_format = request.args.get('format') or bulk.detect_format(request.content_type)
+        if input_format not in bulk.FORMATS:
             return jsonify({
                 'success': False,
-                'message': 'HWID is required'
+                'message': 'format must be ndjson or csv'
             }), 400
         
-        # Подключаемся к базе
         conn = get_db_connection()
         if not conn:
             return jsonify({
@@ -285,209 +1867,66 @@ def activate_license():
                 'message': 'Database connection failed'
             }), 500
         
-        try:
-            c = conn.cursor()
-            
-            # Ищем лицензию
-            c.execute('SELECT * FROM licenses WHERE license_key = ?', (license_key,))
-            license_data = c.fetchone()
-            
-            if not license_data:
-                conn.close()
-                return jsonify({
-                    'success': False,
-                    'message': 'License key not found'
-                }), 404
-            
-            license_dict = dict(license_data)
-            
-            # Проверяем активность
-            if not license_dict['is_active']:
-                conn.close()
-                return jsonify({
-                    'success': False,
-                    'message': 'License has been revoked'
-                }), 400
-            
-            # Проверяем срок
-            expires_at = datetime.fromisoformat(license_dict['expires_at'].replace('Z', '+00:00'))
-            if expires_at < datetime.now():
-                conn.close()
-                return jsonify({
-                    'success': False,
-                    'message': 'License has expired',
-                    'expired_at': expires_at.isoformat()
-                }), 400
-            
-            # Проверяем активации
-            c.execute('SELECT COUNT(*) as count FROM activations WHERE license_key = ?', (license_key,))
-            activation_count = c.fetchone()['count']
-            
-            if activation_count >= license_dict['max_activations']:
-                conn.close()
-                return jsonify({
-                    'success': False,
-                    'message': f'Maximum activations reached ({license_dict["max_activations"]})'
-                }), 400
-            
-            # Проверяем, активирована ли уже на этом устройстве
-            c.execute('SELECT * FROM activations WHERE license_key = ? AND hwid = ?', (license_key, hwid))
-            existing = c.fetchone()
-            
-            if existing:
-                conn.close()
-                return jsonify({
-                    'success': True,
-                    'message': 'License already activated on this device',
-                    'already_activated': True,
-                    'activation_time': dict(existing)['activation_time'],
-                    'license_key': license_key,
-                    'hwid': hwid,
-                    'expires_at': license_dict['expires_at']
-                })
-            
-            # Активируем
-            activation_time = datetime.now()
-            device_info = data.get('device_info', {})
-            
-            c.execute('''
-                INSERT INTO activations (license_key, hwid, device_name, platform, activation_time, ip_address, user_agent)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                license_key,
-                hwid,
-                device_info.get('device_name', 'Unknown'),
-                device_info.get('platform', 'Unknown'),
-                activation_time.isoformat(),
-                request.remote_addr,
-                request.headers.get('User-Agent', 'Unknown')[:200]
-            ))
-            
-            # Обновляем счетчик
-            c.execute('UPDATE licenses SET current_activations = current_activations + 1 WHERE license_key = ?', (license_key,))
-            
-            conn.commit()
-            conn.close()
-            
-            print(f"[ACTIVATE] Success: {license_key[:20]}...")
-            
-            return jsonify({
-                'success': True,
-                'message': 'License activated successfully',
-                'license_key': license_key,
-                'hwid': hwid,
-                'activation_time': activation_time.isoformat(),
-                'expires_at': license_dict['expires_at'],
-                'max_activations': license_dict['max_activations'],
-                'current_activations': activation_count + 1,
-                'already_activated': False
-            })
-            
-        except Exception as e:
-            conn.rollback()
-            conn.close()
-            raise e
-            
+        report = bulk.import_file(get_storage(), conn, table, request.stream, input_format, IMPORT_CHUNK_SIZE)
+        if table == 'licenses' and report.imported:
+            # Остальные воркеры увидят новые ключи через key_filter_job
+            refresh_key_filter(get_storage())
+        
+        logger.info("Imported %d %s (%d skipped, %d invalid)",
+                    report.imported, table, report.skipped, report.invalid)
+        
+        return jsonify({
+            'success': True,
+            'table': table,
+            **report.to_dict()
+        })
+        
     except Exception as e:
-        print(f"[ERROR] Activate: {e}")
+        logger.exception("Import failed: %s", e)
         return jsonify({
             'success': False,
             'message': f'Server error: {str(e)}'
         }), 500
 
-@app.route('/api/validate', methods=['POST'])
+@app.route('/api/admin/export/<table>', methods=['GET'])
+@require_admin_key
 @log_request
-def validate_license():
-    """Валидация лицензии"""
+def export_records(table):
+    """Потоковый экспорт лицензий или активаций в NDJSON или CSV прямо из курсора БД"""
     try:
-        data = request.json or {}
-        
-        license_key = data.get('license_key', '').strip()
-        hwid = data.get('hwid', '').strip()
-        
-        print(f"[VALIDATE] Key: {license_key[:20]}..., HWID: {hwid[:10]}...")
+        if table not in bulk.TABLES:
+            return jsonify({
+                'success': False,
+                'message': 'table must be licenses or activations'
+            }), 404
         
-        # Валидация
-        if not license_key:
+        output_format = request.args.get('format', 'ndjson').lower()
+        if output_format not in bulk.FORMATS:
             return jsonify({
-                'valid': False,
-                'message': 'License key is required'
+                'success': False,
+                'message': 'format must be ndjson or csv'
             }), 400
         
-        # Подключаемся к базе
-        conn = get_db_connection()
+        conn = get_db_connection(readonly=True)
         if not conn:
             return jsonify({
-                'valid': False,
+                'success': False,
                 'message': 'Database connection failed'
             }), 500
         
-        try:
-            c = conn.cursor()
-            
-            # Ищем лицензию
-            c.execute('SELECT * FROM licenses WHERE license_key = ?', (license_key,))
-            license_data = c.fetchone()
-            
-            if not license_data:
-                conn.close()
-                return jsonify({
-                    'valid': False,
-                    'message': 'License key not found'
-                })
-            
-            license_dict = dict(license_data)
-            
-            # Проверяем активность
-            if not license_dict['is_active']:
-                conn.close()
-                return jsonify({
-                    'valid': False,
-                    'message': 'License has been revoked'
-                })
-            
-            # Проверяем срок
-            expires_at = datetime.fromisoformat(license_dict['expires_at'].replace('Z', '+00:00'))
-            if expires_at < datetime.now():
-                conn.close()
-                return jsonify({
-                    'valid': False,
-                    'message': 'License has expired',
-                    'expired_at': expires_at.isoformat()
-                })
-            
-            # Если передан HWID, проверяем активацию
-            if hwid:
-                c.execute('SELECT * FROM activations WHERE license_key = ? AND hwid = ?', (license_key, hwid))
-                activation = c.fetchone()
-                
-                if not activation:
-                    conn.close()
-                    return jsonify({
-                        'valid': False,
-                        'message': 'License not activated on this device'
-                    })
-            
-            conn.close()
-            
-            return jsonify({
-                'valid': True,
-                'message': 'License is valid',
-                'license_key': license_key,
-                'expires_at': license_dict['expires_at'],
-                'max_activations': license_dict['max_activations'],
-                'current_activations': license_dict['current_activations'],
-                'is_active': bool(license_dict['is_active'])
-            })
-            
-        except Exception as e:
-            conn.close()
-            raise e
-            
+        rows = iter_export_rows(conn, table)
+        body = bulk.write_records((format_row(row) for row in rows), table, output_format)
+        
+        return Response(
+            stream_with_context(body),
+            mimetype='text/csv' if output_format == 'csv' else 'application/x-ndjson',
+            headers={'Content-Disposition': f'attachment; filename={table}.{output_format}'}
+        )
+        
     except Exception as e:
-        print(f"[ERROR] Validate: {e}")
+        logger.exception("Export failed: %s", e)
         return jsonify({
-            'valid': False,
+            'success': False,
             'message': f'Server error: {str(e)}'
         }), 500
 
@@ -495,39 +1934,86 @@ def validate_license():
 @require_api_key
 @log_request
 def get_all_licenses():
-    """Получение всех лицензий (админ)"""
+    """Получение лицензий (админ): постранично по курсору или потоком NDJSON"""
     try:
-        conn = get_db_connection()
+        output_format = request.args.get('format', 'json').lower()
+        
+        # В потоковом режиме лимит не обязателен
+        limit = request.args.get('limit', type=int)
+        if limit is None and output_format != 'ndjson':
+            limit = LICENSES_PAGE_SIZE
+        if limit is not None and not 0 < limit <= LICENSES_MAX_PAGE_SIZE:
+            return jsonify({
+                'success': False,
+                'message': f'limit must be between 1 and {LICENSES_MAX_PAGE_SIZE}'
+            }), 400
+        
+        # Keyset-пагинация по (created_at, id)
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                cursor = decode_cursor(cursor)
+            except ValueError:
+                return jsonify({
+                    'success': False,
+                    'message': 'Invalid cursor'
+                }), 400
+        
+        status = request.args.get('status')
+        if status and status not in ('active', 'expired', 'revoked'):
+            return jsonify({
+                'success': False,
+                'message': 'status must be active, expired or revoked'
+            }), 400
+        
+        conn = get_db_connection(readonly=True)
         if not conn:
             return jsonify({
                 'success': False,
                 'message': 'Database connection failed'
             }), 500
         
-        c = conn.cursor()
-        c.execute('''
-            SELECT l.*, COUNT(a.id) as activation_count
-            FROM licenses l
-            LEFT JOIN activations a ON l.license_key = a.license_key
-            GROUP BY l.id
-            ORDER BY l.created_at DESC
-        ''')
+        storage = get_storage()
         
-        licenses = []
-        for row in c.fetchall():
-            license_data = dict(row)
-            licenses.append(license_data)
+        # ETag - общая версия данных (URL с параметрами различает страницы):
+        # пока ничего не менялось, список не читаем
+        etag = str(storage.get_data_version(conn))
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
         
-        conn.close()
+        # Для страницы берем на одну строку больше, чтобы узнать has_more
+        rows = storage.iter_licenses(
+            conn,
+            limit=limit if output_format == 'ndjson' else limit + 1,
+            cursor=cursor,
+            status=status,
+            source=request.args.get('source'),
+            created_by=request.args.get('created_by')
+        )
         
-        return jsonify({
+        # Потоковый режим: строки идут прямо из курсора, память не растет
+        if output_format == 'ndjson':
+            def generate():
+                for row in rows:
+                    yield json.dumps(format_row(row)) + '\n'
+            
+            return with_etag(Response(stream_with_context(generate()), mimetype='application/x-ndjson'), etag)
+        
+        licenses = list(rows)
+        has_more = len(licenses) > limit
+        licenses = licenses[:limit]
+        next_cursor = encode_cursor(licenses[-1]) if has_more else None
+        
+        return with_etag(jsonify({
             'success': True,
             'count': len(licenses),
-            'licenses': licenses
-        })
+            'licenses': [format_row(row) for row in licenses],
+            'has_more': has_more,
+            'next_cursor': next_cursor
+        }), etag)
         
     except Exception as e:
-        print(f"[ERROR] Get licenses: {e}")
+        logger.exception("Get licenses failed: %s", e)
         return jsonify({
             'success': False,
             'message': f'Server error: {str(e)}'
@@ -536,45 +2022,72 @@ def get_all_licenses():
 @app.route('/api/license/<license_key>', methods=['GET'])
 @log_request
 def get_license_details(license_key):
-    """Получение деталей лицензии"""
+    """Получение деталей лицензии: активации - постранично по курсору"""
     try:
-        conn = get_db_connection()
+        limit = request.args.get('limit', ACTIVATIONS_PAGE_SIZE, type=int)
+        if not 0 < limit <= ACTIVATIONS_MAX_PAGE_SIZE:
+            return jsonify({
+                'success': False,
+                'message': f'limit must be between 1 and {ACTIVATIONS_MAX_PAGE_SIZE}'
+            }), 400
+        
+        # Keyset-пагинация по (activation_time, id)
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                activation_time, activation_id = decode_cursor(cursor)
+                cursor = activation_time, int(activation_id)
+            except ValueError:
+                return jsonify({
+                    'success': False,
+                    'message': 'Invalid cursor'
+                }), 400
+        
+        conn = get_db_connection(readonly=True)
         if not conn:
             return jsonify({
                 'success': False,
                 'message': 'Database connection failed'
             }), 500
         
-        c = conn.cursor()
+        storage = get_storage()
         
         # Получаем лицензию
-        c.execute('SELECT * FROM licenses WHERE license_key = ?', (license_key,))
-        license_data = c.fetchone()
+        license_dict = storage.get_license(conn, license_key)
         
-        if not license_data:
-            conn.close()
+        if not license_dict:
             return jsonify({
                 'success': False,
                 'message': 'License not found'
             }), 404
         
-        # Получаем активации
-        c.execute('SELECT * FROM activations WHERE license_key = ? ORDER BY activation_time DESC', (license_key,))
-        activations = [dict(row) for row in c.fetchall()]
+        # Версия меняется при активации, отзыве, истечении и архивации:
+        # совпал ETag - активации не читаем
+        etag = f"{license_dict['id']}-{license_dict['version']}"
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
         
-        conn.close()
+        # Страница активаций: на одну строку больше, чтобы узнать has_more
+        activations = storage.get_activations(conn, license_key, limit=limit + 1, cursor=cursor)
+        has_more = len(activations) > limit
+        activations = activations[:limit]
+        next_cursor = encode_cursor(activations[-1], 'activation_time') if has_more else None
         
-        license_dict = dict(license_data)
+        # Свернутая история старых активаций - только с первой страницей
+        history = storage.get_activation_summaries(conn, license_key) if not cursor else None
         
-        return jsonify({
+        return with_etag(jsonify({
             'success': True,
-            'license': license_dict,
-            'activations': activations,
-            'activation_count': len(activations)
-        })
+            'license': format_row(license_dict),
+            'activations': [format_row(activation) for activation in activations],
+            'activation_count': license_dict['current_activations'],
+            'has_more': has_more,
+            'next_cursor': next_cursor,
+            'activation_history': history
+        }), etag)
         
     except Exception as e:
-        print(f"[ERROR] Get license details: {e}")
+        logger.exception("Get license details failed: %s", e)
         return jsonify({
             'success': False,
             'message': f'Server error: {str(e)}'
@@ -586,45 +2099,89 @@ def get_license_details(license_key):
 def get_stats():
     """Получение статистики сервера"""
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(readonly=True)
         if not conn:
             return jsonify({
                 'success': False,
                 'message': 'Database connection failed'
             }), 500
         
-        c = conn.cursor()
-        
-        # Общая статистика
-        c.execute('SELECT COUNT(*) as total FROM licenses')
-        total_licenses = c.fetchone()['total']
-        
-        c.execute('SELECT COUNT(*) as total_activations FROM activations')
-        total_activations = c.fetchone()['total_activations']
-        
-        c.execute('SELECT COUNT(DISTINCT hwid) as unique_devices FROM activations')
-        unique_devices = c.fetchone()['unique_devices']
-        
-        conn.close()
+        # Агрегаты поддерживаются инкрементально, чтение - O(1)
+        storage = get_storage()
+        counters, activations_per_day = storage.get_stats(conn)
         
         return jsonify({
             'success': True,
             'stats': {
-                'total_licenses': total_licenses,
-                'total_activations': total_activations,
-                'unique_devices': unique_devices,
+                'total_licenses': counters.get('total_licenses', 0),
+                'total_activations': counters.get('total_activations', 0),
+                'unique_devices': counters.get('unique_devices', 0),
+                'active_licenses': counters.get('active_licenses', 0),
+                'expired_licenses': counters.get('expired_licenses', 0),
+                'revoked_licenses': counters.get('revoked_licenses', 0),
+                'activations_per_day': activations_per_day,
+                'reconciled_at': datetime.fromtimestamp(counters.get('reconciled_at', 0)).isoformat(),
+                'database': storage.name,
+                'db_pool': storage.pool_stats(),
+                'validation_cache': validation_cache.stats(),
+                'shared_cache': shared_cache.stats() if shared_cache else None,
                 'server_time': datetime.now().isoformat(),
                 'server_version': '2.0.0'
             }
         })
         
     except Exception as e:
-        print(f"[ERROR] Get stats: {e}")
+        logger.exception("Get stats failed: %s", e)
+        return jsonify({
+            'success': False,
+            'message': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/api/admin/profile', methods=['GET', 'DELETE'])
+@require_admin_key
+@log_request
+def get_profile():
+    """Профиль текущего воркера: collapsed stacks (text/plain) или сводка (?format=json); DELETE - сброс
+
+    Выход подходит для flamegraph.pl и speedscope; ?endpoint='POST /api/activate' - один маршрут.
+    """
+    try:
+        if profiler is None:
+            return jsonify({
+                'success': False,
+                'message': 'Profiling is disabled (set PROFILING=1)'
+            }), 404
+        
+        if request.method == 'DELETE':
+            profiler.reset()
+            return jsonify({
+                'success': True,
+                'message': 'Profile reset'
+            })
+        
+        if request.args.get('format') == 'json':
+            return jsonify({
+                'success': True,
+                'pid': os.getpid(),
+                'sample_rate': PROFILE_SAMPLE_RATE,
+                **profiler.stats()
+            })
+        
+        lines = profiler.collapsed(request.args.get('endpoint'))
+        return Response(''.join(line + '\n' for line in lines), mimetype='text/plain')
+        
+    except Exception as e:
+        logger.exception("Get profile failed: %s", e)
         return jsonify({
             'success': False,
             'message': f'Server error: {str(e)}'
         }), 500
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Метрики текущего воркера в формате Prometheus"""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 # ========== ОБРАБОТЧИКИ ОШИБОК ==========
 @app.errorhandler(404)
 def not_found(error):
@@ -642,19 +2199,66 @@ def server_error(error):
         'error': str(error)
     }), 500
 
-# ========== ЗАПУСК СЕРВЕРА ==========
-if __name__ == '__main__':
+# ========== КОМАНДНАЯ СТРОКА ==========
+def parse_cli_args(argv=None):
+    parser = argparse.ArgumentParser(description='Snos Tool License Server')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help='run the development server (default)')
+    
+    import_parser = commands.add_parser('import', help='stream-import licenses or activations from CSV/NDJSON')
+    import_parser.add_argument('table', choices=tuple(bulk.TABLES))
+    import_parser.add_argument('file', help="input file, '-' for stdin")
+    import_parser.add_argument('--format', choices=bulk.FORMATS, help='default: by file extension')
+    import_parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, help='rows per transaction')
+    
+    export_parser = commands.add_parser('export', help='stream-export licenses or activations to CSV/NDJSON')
+    export_parser.add_argument('table', choices=tuple(bulk.TABLES))
+    export_parser.add_argument('file', help="output file, '-' for stdout")
+    export_parser.add_argument('--format', choices=bulk.FORMATS, help='default: by file extension')
+    return parser.parse_args(argv)
+
+def run_import(args):
+    """python app.py import licenses licenses.csv"""
+    input_format = args.format or bulk.detect_format(args.file)
+    stream = sys.stdin.buffer if args.file == '-' else open(args.file, 'rb')
+    try:
+        storage = get_storage()
+        with storage.connection() as conn:
+            report = bulk.import_file(storage, conn, args.table, stream, input_format, args.chunk_size)
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    
+    print(json.dumps({'table': args.table, **report.to_dict()}, indent=2), file=sys.stderr)
+    return 0 if not report.invalid else 1
+
+def run_export(args):
+    """python app.py export activations - > activations.ndjson"""
+    output_format = args.format or bulk.detect_format(args.file)
+    output = sys.stdout if args.file == '-' else open(args.file, 'w', encoding='utf-8', newline='')
+    try:
+        storage = get_storage()
+        with storage.connection(readonly=True) as conn:
+            rows = iter_export_rows(conn, args.table)
+            for chunk in bulk.write_records((format_row(row) for row in rows), args.table, output_format):
+                output.write(chunk)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+def run_server():
     # Инициализация при запуске
     print("=" * 60)
     print("Snos Tool License Server v2.0.0")
     print("=" * 60)
-    print(f"Database: {DATABASE_URL}")
-    print(f"Admin API Key: {ADMIN_API_KEY}")
+    print(f"Database: {DATABASE_URL.split('@')[-1]}")
+    print(f"Admin API Key: {ADMIN_API_KEY[:4] + '...' if ADMIN_API_KEY_CONFIGURED else 'not set, new admin endpoints disabled'}")
     print(f"Server Secret: {SERVER_SECRET[:10]}...")
     print("-" * 60)
     
-    # Инициализируем базу данных
-    if init_database():
+    # Инициализируем базу данных и прогреваем пул и кэш
+    if warm_up():
         print("✓ Database initialized successfully")
     else:
         print("⚠ Database initialization failed, using fallback")
@@ -669,3 +2273,17 @@ if __name__ == '__main__':
     
     # Запускаем сервер
     app.run(host='0.0.0.0', port=port, debug=False)
+
+# ========== ЗАПУСК СЕРВЕРА ==========
+if __name__ == '__main__':
+    cli_args = parse_cli_args()
+    if cli_args.command == 'import':
+        sys.exit(run_import(cli_args))
+    elif cli_args.command == 'export':
+        # Экспорт в stdout - логи в stderr, чтобы не смешивались с файлом
+        logger.setLevel(logging.WARNING)
+        if cli_args.file == '-':
+            log_stream_handler.setStream(sys.stderr)
+        sys.exit(run_export(cli_args))
+    else:
+        run_server()
@@ -0,0 +1,170 @@
+"""ASGI-режим сервера лицензий
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT --workers 2
+
+Соединения клиентов обслуживает цикл событий, поэтому тысячи ожидающих
+heartbeat-запросов не занимают по процессу. Обработчики Flask из app.py
+выполняются как есть в отдельном пуле потоков, там же вся работа с базой:
+долгое ожидание блокировки SQLite держит один поток, а не весь воркер.
+JSON-контракты эндпоинтов совпадают с WSGI-режимом, потому что код тот же.
+"""
+import asyncio
+import io
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app as flask_app, warm_up
+
+logger = logging.getLogger('snos.asgi')
+
+# Потоки для обработчиков и запросов к базе (на каждый процесс)
+ASGI_DB_THREADS = int(os.environ.get('ASGI_DB_THREADS', 32))
+
+executor = ThreadPoolExecutor(max_workers=ASGI_DB_THREADS, thread_name_prefix='snos-db')
+
+class _RequestBody(io.RawIOBase):
+    """wsgi.input поверх receive: тело читается порциями по мере того, как Flask его просит
+
+    Чтение идет в потоке пула, сообщения receive запрашиваются у цикла событий -
+    потоковый импорт не держит тело запроса в памяти целиком.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self._buffer and self._more:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                raise OSError('Client disconnected')
+            self._buffer = message.get('body', b'')
+            self._more = message.get('more_body', False)
+        count = min(len(target), len(self._buffer))
+        target[:count] = self._buffer[:count]
+        self._buffer = self._buffer[count:]
+        return count
+
+def _build_environ(scope, body):
+    """WSGI environ из ASGI scope (PEP 3333)"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0] if client else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BufferedReader(body),
+        # Тело без Content-Length (chunked) werkzeug читает до конца потока
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+def _run_flask(environ, loop, send):
+    """Выполняет запрос Flask в потоке пула
+
+    Возвращает (статус, заголовки, тело) для ответа с Content-Length - тело
+    уже в памяти, его одним сообщением отправит цикл событий. Потоковые ответы
+    (NDJSON, CSV) без Content-Length отдаются порциями из этого же потока:
+    stream_with_context держит контекст запроса, а он привязан к потоку.
+    Каждая порция ждет отправки - медленный клиент притормаживает генератор.
+    """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and response.get('started'):
+            raise exc_info[1].with_traceback(exc_info[2])
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                               for name, value in headers]
+        response['sized'] = any(name.lower() == 'content-length' for name, _ in headers)
+
+    def send_sync(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def send_start():
+        response['started'] = True
+        send_sync({'type': 'http.response.start', 'status': response['status'],
+                   'headers': response['headers']})
+
+    result = flask_app(environ, start_response)
+    try:
+        # Обычный ответ Flask (ClosingIterator над готовым телом) несет
+        # Content-Length: отдаем тело циклу событий целиком, без переключений
+        # между потоками на каждую порцию
+        if response.get('sized'):
+            return response['status'], response['headers'], b''.join(result)
+
+        for chunk in result:
+            if not chunk:
+                continue
+            if not response.get('started'):
+                send_start()
+            send_sync({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        if not response.get('started'):
+            send_start()
+        send_sync({'type': 'http.response.body', 'body': b''})
+        return None
+    finally:
+        # Закрытие ответа запускает teardown: соединение возвращается в пул
+        if hasattr(result, 'close'):
+            result.close()
+
+async def _lifespan(receive, send):
+    loop = asyncio.get_running_loop()
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                # Схема, пул, кэш и фоновые задачи - до первого запроса
+                if not await loop.run_in_executor(executor, warm_up):
+                    raise RuntimeError('Database is not initialized')
+            except Exception as e:
+                logger.exception("Startup failed: %s", e)
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        raise RuntimeError(f"Unsupported ASGI scope: {scope['type']}")
+
+    loop = asyncio.get_running_loop()
+    environ = _build_environ(scope, _RequestBody(receive, loop))
+    response = await loop.run_in_executor(executor, _run_flask, environ, loop, send)
+    if response is not None:
+        status, headers, content = response
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
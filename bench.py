@@ -0,0 +1,352 @@
+"""Нагрузочный бенчмарк горячих эндпоинтов сервера лицензий
+
+    python bench.py --licenses 1000000 --activations 5000000 --concurrency 16
+    python bench.py --mode server --server gunicorn --workers 4 --output before.json
+
+Заполняет базу N лицензиями и M активациями (повторный запуск с тем же
+--database переиспользует данные), гоняет сценарии через тестовый клиент
+Flask и/или через настоящий сервер и пишет JSON с пропускной способностью
+и перцентилями задержки. Файлы разных коммитов удобно сравнивать diff'ом.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BENCH_KEY_PREFIX = 'BENCH-'
+BENCH_KEY_END = 'BENCH.'  # '.' следует за '-': диапазон по индексу вместо LIKE
+SEED_CHUNK = 10000
+HOT_KEYS = 100
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--database', default='/tmp/snos_bench.db',
+                        help='DATABASE_URL for the benchmark (SQLite path or postgres://...)')
+    parser.add_argument('--licenses', type=int, default=100000, help='licenses to seed (N)')
+    parser.add_argument('--activations', type=int, default=300000, help='activations to seed (M)')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='parallel clients')
+    parser.add_argument('--scenarios', default='validate,validate_hot,activate,licenses,stats',
+                        help='comma-separated scenarios to run')
+    parser.add_argument('--mode', choices=('testclient', 'server', 'both'), default='testclient')
+    parser.add_argument('--server', choices=('gunicorn', 'uvicorn'), default='gunicorn',
+                        help='server for --mode server: gunicorn app:app or uvicorn asgi:app')
+    parser.add_argument('--workers', type=int, default=2, help='server worker processes')
+    parser.add_argument('--port', type=int, default=0, help='server port (0 = pick a free one)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for request mix')
+    parser.add_argument('--output', default='bench_results.json')
+    return parser.parse_args(argv)
+
+# ========== ЗАПОЛНЕНИЕ БАЗЫ ==========
+def bench_key(index):
+    return f'{BENCH_KEY_PREFIX}{index:010d}'
+
+def license_shape(index, licenses, activations):
+    """Детерминированная форма лицензии: (число активаций, отозвана, истекла)"""
+    count = activations // licenses + (1 if index < activations % licenses else 0)
+    return count, index % 20 == 7, index % 20 == 13
+
+def seed_database(storage, licenses, activations):
+    """Заливает лицензии BENCH-... и их активации, если их еще нет"""
+    with storage.connection() as conn:
+        c = conn.cursor()
+        storage._execute(c, 'SELECT COUNT(*) AS n FROM licenses WHERE license_key >= ? AND license_key < ?',
+                         (BENCH_KEY_PREFIX, BENCH_KEY_END))
+        existing = c.fetchone()['n']
+        conn.rollback()
+        if existing == licenses:
+            print(f'Reusing {existing} seeded licenses', file=sys.stderr)
+            return False
+        if existing:
+            raise SystemExit(f'{storage.name} database already has {existing} bench licenses, '
+                             f'expected {licenses}: use a fresh --database')
+
+        started = time.perf_counter()
+        now = int(time.time())
+        valid_until = now + 365 * 24 * 3600
+        expired_at = now - 24 * 3600
+        created_at = now - 30 * 24 * 3600
+
+        for start in range(0, licenses, SEED_CHUNK):
+            license_rows = []
+            activation_rows = []
+            for index in range(start, min(start + SEED_CHUNK, licenses)):
+                count, revoked, expired = license_shape(index, licenses, activations)
+                key = bench_key(index)
+                license_rows.append((
+                    str(uuid.UUID(int=index)), key, created_at, expired_at if expired else valid_until,
+                    count + 2, count, 0 if revoked else 1,
+                    'revoked' if revoked else 'expired' if expired else 'active', 'bench', 'bench'
+                ))
+                activation_rows.extend(
+                    (key, f'HW-{index}-{n}', 'bench', 'bench', created_at, '127.0.0.1', 'bench')
+                    for n in range(count)
+                )
+            with storage.transaction(conn) as c:
+                c.executemany(storage._sql('''
+                    INSERT INTO licenses (id, license_key, created_at, expires_at, max_activations,
+                                          current_activations, is_active, status, notes, created_by)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                '''), license_rows)
+                c.executemany(storage._sql('''
+                    INSERT INTO activations (license_key, hwid, device_name, platform, activation_time,
+                                             ip_address, user_agent)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                '''), activation_rows)
+            print(f'Seeded {min(start + SEED_CHUNK, licenses)}/{licenses} licenses', file=sys.stderr)
+
+        # Счетчики /api/stats пересчитываем по залитым данным, фильтр ключей воркеров - пересобрать
+        storage.reconcile_stats(conn, 0)
+        with storage.transaction(conn) as c:
+            storage._bump_stats(c, data_version=1, key_filter_version=1)
+        print(f'Seeding took {time.perf_counter() - started:.1f}s', file=sys.stderr)
+        return True
+
+# ========== СЦЕНАРИИ ==========
+class Scenarios:
+    """Генераторы запросов: name -> () -> (method, path, json)"""
+
+    def __init__(self, license_count, activation_count, seed):
+        self.license_count = license_count
+        self.activation_count = activation_count
+        self.seed = seed
+        self._local = threading.local()
+
+    @property
+    def random(self):
+        rng = getattr(self._local, 'random', None)
+        if rng is None:
+            rng = self._local.random = random.Random(f'{self.seed}-{threading.get_ident()}')
+        return rng
+
+    def _validate_pair(self, index):
+        count, _, _ = license_shape(index, self.license_count, self.activation_count)
+        return {'license_key': bench_key(index), 'hwid': f'HW-{index}-0' if count else ''}
+
+    def validate(self):
+        # Равномерно по всем лицензиям: в основном промахи кэша
+        return 'POST', '/api/validate', self._validate_pair(self.random.randrange(self.license_count))
+
+    def validate_hot(self):
+        # Небольшой набор ключей: путь попадания в кэш
+        return 'POST', '/api/validate', self._validate_pair(self.random.randrange(min(HOT_KEYS, self.license_count)))
+
+    def activate(self):
+        return 'POST', '/api/activate', {
+            'license_key': bench_key(self.random.randrange(self.license_count)),
+            'hwid': f'NEW-{uuid.uuid4().hex}',
+            'device_info': {'device_name': 'bench', 'platform': 'bench'}
+        }
+
+    def licenses(self):
+        status = self.random.choice(('', 'active', 'expired', 'revoked'))
+        return 'GET', f'/api/licenses?limit=100{"&status=" + status if status else ""}', None
+
+    def stats(self):
+        return 'GET', '/api/stats', None
+
+# ========== КЛИЕНТЫ ==========
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def run_scenario(make_request, send, total, concurrency):
+    """Выполняет total запросов в concurrency потоков, возвращает сводку"""
+    latencies = []
+    statuses = {}
+    errors = 0
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker():
+        nonlocal errors
+        local_latencies = []
+        local_statuses = {}
+        local_errors = 0
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            method, path, body = make_request()
+            started = time.perf_counter()
+            try:
+                status = send(method, path, body)
+            except Exception:
+                status = 'error'
+            local_latencies.append(time.perf_counter() - started)
+            local_statuses[str(status)] = local_statuses.get(str(status), 0) + 1
+            if status == 'error' or status >= 500:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors += local_errors
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': dict(sorted(statuses.items())),
+        'duration_s': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'latency_ms': {
+            name: round(percentile(latencies, fraction) * 1000, 3)
+            for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))
+        } if latencies else {}
+    }
+
+def testclient_sender(flask_app):
+    local = threading.local()
+    headers = {'X-API-Key': os.environ.get('ADMIN_API_KEY', 'BYDSQ123')}
+
+    def send(method, path, body):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = flask_app.test_client()
+        response = client.open(path, method=method, json=body, headers=headers)
+        response.close()
+        return response.status_code
+    return send
+
+def http_sender(base_url):
+    import requests
+
+    local = threading.local()
+    headers = {'X-API-Key': os.environ.get('ADMIN_API_KEY', 'BYDSQ123')}
+
+    def send(method, path, body):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        response = session.request(method, base_url + path, json=body, headers=headers, timeout=60)
+        return response.status_code
+    return send
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(args, env):
+    port = args.port or free_port()
+    if args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '--workers', str(args.workers),
+                   '--bind', f'127.0.0.1:{port}', 'app:app']
+    else:
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--workers', str(args.workers),
+                   '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning']
+    process = subprocess.Popen(command, cwd=HERE, env=env)
+
+    import requests
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'{args.server} exited with code {process.returncode}')
+        try:
+            if requests.get(base_url + '/api/test', timeout=1).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f'{args.server} did not become ready on port {port}')
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# ========== ЗАПУСК ==========
+def main(argv=None):
+    args = parse_args(argv)
+    if args.licenses <= 0 or args.activations < 0:
+        raise SystemExit('--licenses must be positive and --activations non-negative')
+
+    # Конфигурация app.py читается из окружения при импорте
+    env = dict(os.environ)
+    env['DATABASE_URL'] = args.database
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    env.setdefault('ADMIN_API_KEY', 'BYDSQ123')
+    # Все запросы идут с одного IP: лимитер частоты исказил бы замеры
+    env.setdefault('RATE_LIMIT_IP_RATE', '0')
+    env.setdefault('RATE_LIMIT_KEY_RATE', '0')
+    os.environ.update(env)
+    sys.path.insert(0, HERE)
+    import app as server
+
+    seed_database(server.get_storage(), args.licenses, args.activations)
+
+    scenarios = Scenarios(args.licenses, args.activations, args.seed)
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    for name in names:
+        if not callable(getattr(scenarios, name, None)) or name.startswith('_'):
+            raise SystemExit(f'Unknown scenario: {name}')
+
+    modes = ('testclient', 'server') if args.mode == 'both' else (args.mode,)
+    results = {}
+    for mode in modes:
+        process = None
+        if mode == 'testclient':
+            send = testclient_sender(server.app)
+        else:
+            process, base_url = start_server(args, env)
+            send = http_sender(base_url)
+        try:
+            label = mode if mode == 'testclient' else f'{args.server}-{args.workers}w'
+            results[label] = {}
+            for name in names:
+                summary = run_scenario(getattr(scenarios, name), send, args.requests, args.concurrency)
+                results[label][name] = summary
+                print(f"{label:>14} {name:<13} {summary['throughput_rps']:>9} rps  "
+                      f"p50={summary['latency_ms'].get('p50')}ms p99={summary['latency_ms'].get('p99')}ms  "
+                      f"errors={summary['errors']}", file=sys.stderr)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+
+    report = {
+        'meta': {
+            'git_revision': git_revision(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': server.get_storage().name,
+            'licenses': args.licenses,
+            'activations': args.activations,
+            'requests_per_scenario': args.requests,
+            'concurrency': args.concurrency,
+            'seed': args.seed
+        },
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print(f'Wrote {args.output}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""Массовый импорт и экспорт лицензий и активаций в CSV/NDJSON
+
+Файлы читаются и пишутся построчно: ни вход, ни выход не держатся в памяти
+целиком, поэтому размер файла ограничен только диском. Общий код для
+админских эндпоинтов и командной строки (python app.py import/export).
+"""
+import csv
+import io
+import json
+import time
+import uuid
+
+from storage import ACTIVATION_COLUMNS, LICENSE_COLUMNS, to_epoch
+
+FORMATS = ('ndjson', 'csv')
+TABLES = {
+    'licenses': LICENSE_COLUMNS,
+    'activations': ACTIVATION_COLUMNS
+}
+LICENSE_STATUSES = ('active', 'expired', 'revoked')
+
+# Сколько ошибок разбора строк попадает в отчет (всего считаются все)
+MAX_REPORTED_ERRORS = 20
+
+# Строк CSV в одной порции вывода
+CSV_FLUSH_ROWS = 1000
+
+def detect_format(name, default='ndjson'):
+    """Формат по расширению файла или Content-Type"""
+    name = (name or '').lower()
+    if name.endswith('.csv') or 'csv' in name:
+        return 'csv'
+    if name.endswith(('.ndjson', '.jsonl')) or 'ndjson' in name or 'json' in name:
+        return 'ndjson'
+    return default
+
+# ========== ЧТЕНИЕ ==========
+def read_records(stream, fmt):
+    """Записи файла: (номер строки, dict) или (номер строки, ValueError) для битой строки"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for line_no, line in enumerate(text, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_no, ValueError(f'invalid JSON: {e}')
+            continue
+        if not isinstance(record, dict):
+            yield line_no, ValueError('expected a JSON object')
+            continue
+        yield line_no, record
+
+def _value(record, field):
+    """Значение поля; пустая строка CSV считается отсутствующим значением"""
+    value = record.get(field)
+    if isinstance(value, str):
+        value = value.strip()
+    return None if value == '' else value
+
+def _required(record, field):
+    value = _value(record, field)
+    if value is None:
+        raise ValueError(f'{field} is required')
+    return str(value)
+
+def _int(record, field, default):
+    value = _value(record, field)
+    return default if value is None else int(value)
+
+def _timestamp(record, field, default=None):
+    """ISO-строка или секунды epoch (число или строка из цифр)"""
+    value = _value(record, field)
+    if value is None:
+        if default is None:
+            raise ValueError(f'{field} is required')
+        return default
+    if isinstance(value, str) and value.lstrip('-').isdigit():
+        value = int(value)
+    return to_epoch(value)
+
+def _flag(record, field):
+    value = _value(record, field)
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+def parse_license(record, now):
+    """Запись файла -> кортеж LICENSE_COLUMNS
+
+    Статус по умолчанию выводится из is_active и expires_at, is_active -
+    из статуса; источник - 'import', если в файле не указан.
+    """
+    license_key = _required(record, 'license_key')
+    created_at = _timestamp(record, 'created_at', now)
+    expires_at = _timestamp(record, 'expires_at')
+    max_activations = _int(record, 'max_activations', 1)
+    current_activations = _int(record, 'current_activations', 0)
+    if max_activations <= 0 or current_activations < 0:
+        raise ValueError('max_activations must be positive and current_activations non-negative')
+
+    is_active = _flag(record, 'is_active')
+    status = _value(record, 'status')
+    if status is None:
+        if is_active is False:
+            status = 'revoked'
+        else:
+            status = 'expired' if expires_at < now else 'active'
+    elif status not in LICENSE_STATUSES:
+        raise ValueError(f'status must be one of {", ".join(LICENSE_STATUSES)}')
+    # Список отзыва читает is_active, проверка лицензии - status: они не должны расходиться
+    if is_active is not None and is_active != (status != 'revoked'):
+        raise ValueError('status and is_active disagree')
+    is_active = status != 'revoked'
+
+    return (
+        str(_value(record, 'id') or uuid.uuid4()),
+        license_key,
+        created_at,
+        expires_at,
+        max_activations,
+        current_activations,
+        int(is_active),
+        status,
+        _value(record, 'notes'),
+        _value(record, 'created_by'),
+        _value(record, 'source') or 'import'
+    )
+
+def parse_activation(record, now):
+    """Запись файла -> кортеж ACTIVATION_COLUMNS"""
+    return (
+        _required(record, 'license_key'),
+        _required(record, 'hwid'),
+        _value(record, 'device_name'),
+        _value(record, 'platform'),
+        _timestamp(record, 'activation_time', now),
+        _value(record, 'ip_address'),
+        _value(record, 'user_agent')
+    )
+
+PARSERS = {
+    'licenses': parse_license,
+    'activations': parse_activation
+}
+
+class ImportReport:
+    """Итог импорта: вставлено, пропущено (дубликаты, неизвестные лицензии), с ошибками"""
+
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.errors = []
+
+    def rows(self, stream, fmt, table):
+        """Разобранные строки файла; битые строки учитываются в отчете и пропускаются"""
+        parse = PARSERS[table]
+        now = int(time.time())
+        for line_no, record in read_records(stream, fmt):
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                yield parse(record, now)
+            except (ValueError, TypeError) as e:
+                self.invalid += 1
+                if len(self.errors) < MAX_REPORTED_ERRORS:
+                    self.errors.append({'line': line_no, 'error': str(e)})
+
+    def to_dict(self):
+        return {
+            'imported': self.imported,
+            'skipped': self.skipped,
+            'invalid': self.invalid,
+            'errors': self.errors
+        }
+
+def import_file(storage, conn, table, stream, fmt, chunk_size=500):
+    """Импортирует файл в таблицу licenses или activations, возвращает ImportReport"""
+    report = ImportReport()
+    importer = storage.import_licenses if table == 'licenses' else storage.import_activations
+    report.imported, report.skipped = importer(conn, report.rows(stream, fmt, table), chunk_size=chunk_size)
+    return report
+
+# ========== ЗАПИСЬ ==========
+def write_records(rows, table, fmt):
+    """Порции текста файла из итератора строк (dict); поля - столбцы таблицы"""
+    fields = TABLES[table]
+    if fmt == 'ndjson':
+        for row in rows:
+            yield json.dumps({field: row.get(field) for field in fields}) + '\n'
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for i, row in enumerate(rows, 1):
+        writer.writerow([row.get(field) for field in fields])
+        if i % CSV_FLUSH_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,23 @@
+"""Настройки gunicorn: подхватываются автоматически при запуске из каталога проекта
+
+    gunicorn --bind 0.0.0.0:$PORT app:app
+
+Приложение загружается в мастере один раз (preload_app), там же до fork
+применяются миграции схемы. Каждый воркер прогревает пул соединений и кэш
+валидации до того, как начнет принимать запросы, поэтому первые запросы
+после деплоя не платят за инициализацию.
+"""
+
+preload_app = True
+
+def on_starting(server):
+    from app import prepare_database
+
+    if not prepare_database():
+        server.log.warning("Schema initialization failed; workers will retry on startup")
+
+def post_worker_init(worker):
+    from app import warm_up
+
+    if not warm_up():
+        worker.log.warning("Worker warm-up failed; /api/ready reports 503 until it succeeds")
@@ -0,0 +1,141 @@
+"""Формат лицензионных ключей и отсев заведомо несуществующих без запроса к базе
+
+Новые ключи - SNOS2-XXXXXX-XXXXXX-XXXXXX-XXXXXX (base32 Крокфорда): 80 случайных
+бит и 40 бит HMAC-SHA256 от секрета сервера. Опечатку или подобранный ключ
+выдает несовпадение HMAC - это микросекунды вместо запроса к базе.
+
+Ключи старого формата (SNOS-XXXX-..., TEST-SNOS-..., импортированные) HMAC
+не несут; для них в памяти держится bloom-фильтр ключей из базы. Фильтр
+может отстать от базы (ключ вставлен в обход счетчика key_filter_version),
+поэтому промах фильтра для ключа старого формата проверяется по базе.
+"""
+import hashlib
+import hmac
+import math
+import os
+import threading
+
+KEY_PREFIX = 'SNOS2-'
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+RANDOM_CHARS = 16   # 80 бит
+MAC_CHARS = 8       # 40 бит
+GROUP_SIZE = 6
+KEY_LENGTH = len(KEY_PREFIX) + RANDOM_CHARS + MAC_CHARS + (RANDOM_CHARS + MAC_CHARS) // GROUP_SIZE - 1
+
+_ALPHABET_SET = frozenset(ALPHABET)
+
+def _encode(value, length):
+    chars = []
+    for _ in range(length):
+        value, index = divmod(value, 32)
+        chars.append(ALPHABET[index])
+    return ''.join(reversed(chars))
+
+class KeyFormat:
+    """Выпуск и проверка ключей нового формата
+
+    Секрет нельзя менять после выдачи ключей: старые ключи перестанут
+    проходить проверку HMAC.
+    """
+
+    def __init__(self, secret):
+        self._mac_key = hashlib.sha256(b'snos-license-key\0' + secret.encode()).digest()
+
+    def _mac(self, body):
+        digest = hmac.new(self._mac_key, body.encode(), hashlib.sha256).digest()
+        return _encode(int.from_bytes(digest[:MAC_CHARS * 5 // 8], 'big'), MAC_CHARS)
+
+    def generate(self):
+        body = _encode(int.from_bytes(os.urandom(RANDOM_CHARS * 5 // 8), 'big'), RANDOM_CHARS)
+        chars = body + self._mac(body)
+        return KEY_PREFIX + '-'.join(chars[i:i + GROUP_SIZE] for i in range(0, len(chars), GROUP_SIZE))
+
+    def matches(self, license_key):
+        """True - ключ записан в новом формате (HMAC не проверяется)"""
+        return self._chars(license_key) is not None
+
+    def verify(self, license_key):
+        """True - ключ нового формата с верным HMAC"""
+        chars = self._chars(license_key)
+        if chars is None:
+            return False
+        return hmac.compare_digest(self._mac(chars[:RANDOM_CHARS]), chars[RANDOM_CHARS:])
+
+    def _chars(self, license_key):
+        if len(license_key) != KEY_LENGTH or not license_key.startswith(KEY_PREFIX):
+            return None
+        groups = license_key[len(KEY_PREFIX):].split('-')
+        if any(len(group) != GROUP_SIZE for group in groups):
+            return None
+        chars = ''.join(groups)
+        if not _ALPHABET_SET.issuperset(chars):
+            return None
+        return chars
+
+class BloomFilter:
+    """Битовый массив и k позиций из одного blake2b (двойное хеширование)"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        # Соль процесса: ложные срабатывания нельзя подобрать заранее
+        self._salt = os.urandom(16)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16, key=self._salt).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+class KnownKeyFilter:
+    """Bloom-фильтр ключей базы, не проходящих проверку key_format
+
+    Пересобирается целиком, когда меняется счетчик key_filter_version
+    (импорт, тестовая лицензия); до первой сборки пропускает все ключи.
+    """
+
+    def __init__(self, key_format, error_rate=0.01):
+        self.key_format = key_format
+        self.error_rate = error_rate
+        self._filter = None
+        self._version = None
+        self._lock = threading.Lock()
+        self.keys = 0
+
+    def refresh(self, storage, conn):
+        """Пересобирает фильтр, если ключи в базе менялись; True - пересобран"""
+        with self._lock:
+            version = storage.get_counter(conn, 'key_filter_version')
+            if self._filter is not None and version == self._version:
+                return False
+
+            # Емкость - по числу всех лицензий: O(1) из счетчиков, с запасом
+            capacity = storage.get_counter(conn, 'total_licenses')
+            bloom = BloomFilter(capacity, self.error_rate)
+            keys = 0
+            for license_key in storage.iter_license_keys(conn):
+                # Ключи с верным HMAC проверяются без фильтра
+                if not self.key_format.verify(license_key):
+                    bloom.add(license_key)
+                    keys += 1
+            self._filter, self._version, self.keys = bloom, version, keys
+            return True
+
+    def might_contain(self, license_key):
+        bloom = self._filter
+        return bloom is None or license_key in bloom
+
+    def add(self, license_key):
+        """Добавляет ключ, найденный в базе мимо фильтра, до следующей пересборки"""
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(license_key)
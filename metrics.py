@@ -0,0 +1,162 @@
+"""Метрики в текстовом формате Prometheus, без внешних зависимостей
+
+Значения живут в памяти процесса: каждый воркер gunicorn отдает на /metrics
+свои счетчики (метка pid в snos_process_info помогает их различать).
+Запись - это словарь и блокировка, поэтому сбор можно держать включенным.
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in sorted(items):
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        yield f'{self.name}{_format_labels(self.labelnames, key)} {value}'
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """Значение снимается в момент выдачи: callback() -> {(метки...): значение}"""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def render(self):
+        if self.callback is not None:
+            try:
+                values = self.callback()
+            except Exception:
+                values = {}
+            with self._lock:
+                self._values = dict(values)
+        return super().render()
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_sample(self, key, value):
+        counts, total = value
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", le)])} {cumulative}'
+        yield f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}'
+        yield f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}'
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# ========== HTTP ==========
+HTTP_REQUEST_DURATION = registry.histogram(
+    'snos_http_request_duration_seconds', 'Request latency by endpoint', ('endpoint', 'method'))
+HTTP_REQUESTS = registry.counter(
+    'snos_http_requests_total', 'Requests by endpoint and status', ('endpoint', 'method', 'status'))
+JSON_SERIALIZATION_DURATION = registry.histogram(
+    'snos_json_serialization_seconds', 'Time spent serializing JSON responses')
+LICENSE_OUTCOMES = registry.counter(
+    'snos_license_outcomes_total', 'Activation/validation results by reason', ('endpoint', 'outcome'))
+RATE_LIMITED = registry.counter(
+    'snos_rate_limited_total', 'Requests rejected with 429 before any DB work', ('endpoint', 'scope'))
+
+# ========== БАЗА ДАННЫХ ==========
+DB_ACQUIRE_DURATION = registry.histogram(
+    'snos_db_connection_acquire_seconds', 'Time to check a connection out of the pool', ('pool',))
+SQL_DURATION = registry.histogram(
+    'snos_sql_statement_seconds', 'SQL statement latency', ('statement',))
+DB_LOCK_WAIT = registry.histogram(
+    'snos_db_lock_wait_seconds', 'Time waiting for the SQLite write lock (BEGIN IMMEDIATE)')
+ACTIVATION_BATCH_SIZE = registry.histogram(
+    'snos_activation_batch_size', 'Activations committed per group-commit transaction',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+DB_BUSY_ERRORS = registry.counter(
+    'snos_db_busy_errors_total', 'Statements that failed with database is locked/busy', ('statement',))
+
+registry.gauge('snos_process_info', 'Worker process serving this scrape', ('pid',),
+               callback=lambda: {(str(os.getpid()),): 1})
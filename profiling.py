@@ -0,0 +1,146 @@
+"""Выборочное профилирование запросов сэмплером стеков
+
+Для выбранного запроса фоновый поток раз в interval снимает стек потока,
+который его обслуживает (sys._current_frames), и считает одинаковые стеки.
+Итоги копятся по маршрутам в памяти процесса и отдаются в формате collapsed
+stacks ("маршрут;кадр;кадр число"), который понимают flamegraph.pl и speedscope.
+
+Вызовы в C (sqlite3, zlib, json) видны как вызвавший их кадр Python.
+Когда профилирование выключено, запрос проходит через middleware одной
+проверкой; поток сэмплера спит, пока нет профилируемых запросов.
+"""
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from werkzeug.wsgi import ClosingIterator
+
+# Уникальных стеков на маршрут; остальные выборки копятся в одной строке
+MAX_STACKS = 10000
+MAX_DEPTH = 128
+
+class StackSampler:
+    """Сэмплер стеков потоков, обслуживающих профилируемые запросы"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._active = {}
+        self._stacks = {}
+        self._requests = Counter()
+        self._names = {}
+        self._pid = None
+
+    def _ensure_thread(self):
+        # После fork поток сэмплера остается в родителе - запускаем свой
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            threading.Thread(target=self._run, name='profiler', daemon=True).start()
+
+    def start(self):
+        """Начинает снимать стеки текущего потока, возвращает токен для stop()"""
+        token = (threading.get_ident(), Counter())
+        with self._lock:
+            self._ensure_thread()
+            self._active[token[0]] = token[1]
+            self._wake.set()
+        return token
+
+    def stop(self, token, label):
+        """Заканчивает запрос и добавляет его выборки к итогам маршрута label"""
+        ident, samples = token
+        with self._lock:
+            if self._active.get(ident) is samples:
+                del self._active[ident]
+            stacks = self._stacks.setdefault(label, Counter())
+            for stack, count in samples.items():
+                if stack in stacks or len(stacks) < MAX_STACKS:
+                    stacks[stack] += count
+                else:
+                    stacks['[truncated]'] += count
+            self._requests[label] += 1
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.items())
+                if not active:
+                    self._wake.clear()
+                    continue
+            frames = sys._current_frames()
+            for ident, samples in active:
+                frame = frames.get(ident)
+                if frame is not None:
+                    samples[self._collapse(frame)] += 1
+
+    def _collapse(self, frame):
+        """Стек от корня к листу: 'файл:функция;...'"""
+        names = []
+        while frame is not None and len(names) < MAX_DEPTH:
+            code = frame.f_code
+            name = self._names.get(code)
+            if name is None:
+                name = self._names[code] = f'{os.path.basename(code.co_filename)}:{code.co_name}'
+            names.append(name)
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def collapsed(self, label=None):
+        """Строки collapsed stacks всех маршрутов или одного"""
+        with self._lock:
+            items = [(name, Counter(stacks)) for name, stacks in self._stacks.items()
+                     if label is None or name == label]
+        lines = []
+        for name, stacks in sorted(items):
+            for stack, count in sorted(stacks.items()):
+                lines.append(f'{name};{stack} {count}')
+        return lines
+
+    def stats(self):
+        with self._lock:
+            return {
+                'interval_ms': self.interval * 1000,
+                'in_flight': len(self._active),
+                'requests': dict(self._requests),
+                'samples': {name: sum(stacks.values()) for name, stacks in self._stacks.items()}
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self._requests.clear()
+
+class ProfilingMiddleware:
+    """WSGI-обертка: профилирует долю sample_rate запросов и запросы, для которых force(environ)
+
+    Охватывает весь запрос в Flask - маршрутизацию, обработчик, сериализацию
+    и отдачу потокового тела. label(environ) - имя маршрута для итогов.
+    """
+
+    def __init__(self, wsgi_app, sampler, sample_rate, force, label):
+        self.wsgi_app = wsgi_app
+        self.sampler = sampler
+        self.sample_rate = sample_rate
+        self.force = force
+        self.label = label
+
+    def __call__(self, environ, start_response):
+        if not (self.sample_rate and random.random() < self.sample_rate) and not self.force(environ):
+            return self.wsgi_app(environ, start_response)
+
+        # Маршрут - до старта, чтобы сопоставление URL не попало в выборки
+        label = self.label(environ)
+        token = self.sampler.start()
+        try:
+            app_iter = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.sampler.stop(token, label)
+            raise
+        return ClosingIterator(app_iter, lambda: self.sampler.stop(token, label))
@@ -0,0 +1,102 @@
+"""Ограничение частоты запросов: token bucket по произвольному ключу (IP, license_key)
+
+Локальный лимитер держит корзины в памяти процесса: у каждого воркера
+gunicorn свой лимит. Общий для всех воркеров - Redis (RATE_LIMIT_BACKEND=
+redis://...), корзина обновляется атомарно Lua-скриптом.
+"""
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('snos.ratelimit')
+
+def create_rate_limiter(backend_url, rate, burst, name):
+    """Лимитер rate запросов/с с запасом burst; None, если rate <= 0 (лимит выключен)"""
+    if rate <= 0:
+        return None
+    if backend_url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisRateLimiter(backend_url, rate, burst, name)
+    return TokenBucketLimiter(rate, burst)
+
+class TokenBucketLimiter:
+    """Корзины в памяти процесса, вытеснение самых давно использованных ключей"""
+
+    def __init__(self, rate, burst, max_keys=100000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()  # key -> (токены, время обновления)
+        self._lock = threading.Lock()
+
+    def hit(self, key, cost=1):
+        """Списывает cost токенов; возвращает 0, если можно, иначе секунды до повтора"""
+        now = self.clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= cost:
+                tokens -= cost
+                retry_after = 0
+            else:
+                retry_after = (cost - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+# Время берется у Redis, чтобы корзина не зависела от часов воркеров
+_REDIS_TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(retry_after)
+"""
+
+class RedisRateLimiter:
+    """Общие для всех воркеров корзины в Redis; при недоступности Redis запросы пропускаются"""
+
+    ERROR_LOG_INTERVAL = 60
+
+    def __init__(self, url, rate, burst, name):
+        # redis нужен только при RATE_LIMIT_BACKEND=redis://...
+        import redis
+
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.prefix = f'snos:ratelimit:{name}:'
+        self._redis_error = redis.RedisError
+        self._client = redis.Redis.from_url(url, socket_timeout=0.05, socket_connect_timeout=0.05)
+        self._script = self._client.register_script(_REDIS_TOKEN_BUCKET)
+        self._last_error_log = 0
+
+    def hit(self, key, cost=1):
+        try:
+            return float(self._script(keys=[self.prefix + key], args=[self.rate, self.burst, cost]))
+        except self._redis_error as e:
+            # Лимитер защищает базу, но не должен сам ронять сервис
+            now = time.monotonic()
+            if now - self._last_error_log >= self.ERROR_LOG_INTERVAL:
+                self._last_error_log = now
+                logger.warning("Rate limit backend unavailable, allowing requests: %s", e)
+            return 0
+
+def retry_after_header(seconds):
+    """Значение Retry-After: целые секунды, не меньше 1"""
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,264 @@
+"""Общий для воркеров хоста кэш состояния лицензий в mmap-файле
+
+    SHARED_CACHE_PATH=/dev/shm/snos-license-cache gunicorn app:app
+
+Файл - хеш-таблица фиксированного размера: заголовок и корзины по
+BUCKET_SLOTS записей фиксированной ширины. Запись - состояние лицензии
+(статус, срок, лимиты) и отпечатки до MAX_HWIDS активированных устройств,
+ключ - хеш license_key. Память ограничена числом записей, при переполнении
+корзины вытесняется запись, которая истекает раньше других.
+
+Читатели не берут блокировок: каждая запись защищена счетчиком seqlock
+(нечетный - идет запись), читатель повторяет чтение, если счетчик
+изменился. Писатели разных процессов исключают друг друга блокировкой
+диапазона корзины (fcntl.lockf), потоки одного процесса - обычным Lock.
+
+Разметка входит в имя файла (SHARED_CACHE_PATH-SNOSLC01-<запись>x<корзины>):
+воркеры с другой разметкой (rolling restart) работают со своим файлом.
+Открытый файл никогда не усекается - обращение к усеченным страницам чужого
+mmap дало бы SIGBUS; новый или битый файл размечается во временном файле
+и подменяется через os.replace под блокировкой PATH.lock.
+"""
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('snos.sharedcache')
+
+MAGIC = b'SNOSLC01'
+HEADER = struct.Struct('<8sII16s')
+HEADER_SIZE = 64
+
+# Запись: seq, хеш ключа, срок жизни записи, expires_at, max/current_activations,
+# статус, is_active, число отпечатков, флаги, ключ, отпечатки устройств
+MAX_KEY_BYTES = 48
+MAX_HWIDS = 8
+SEQ = struct.Struct('<I')
+BODY = struct.Struct(f'<QdqiiBBBB{MAX_KEY_BYTES}s{MAX_HWIDS}Q4x')
+RECORD_SIZE = 8 + BODY.size
+BUCKET_SLOTS = 4
+BUCKET_SIZE = RECORD_SIZE * BUCKET_SLOTS
+
+# Все активации лицензии поместились в отпечатки: отсутствие устройства - точный ответ
+FLAG_COMPLETE = 1
+
+STATUSES = ('active', 'expired', 'revoked')
+
+# Попыток прочитать запись, пока писатель ее меняет
+READ_RETRIES = 16
+
+class SharedLicenseCache:
+    """Состояние лицензий в общем mmap-файле; открывается заново в каждом процессе"""
+
+    def __init__(self, path, size=65536, ttl=5):
+        self.path = path
+        self.buckets = max(1, size // BUCKET_SLOTS)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+        self._salt = b''
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.invalidations = 0
+
+    # ----- Файл -----
+    def _open(self):
+        """Открывает (или создает и размечает) файл кэша; после fork - заново"""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            total = HEADER_SIZE + self.buckets * BUCKET_SIZE
+            # Разметку создает один процесс хоста, остальные ждут и открывают готовый файл
+            lock_fd = os.open(f'{self.path}.lock', os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+                fd, salt = self._open_file(total)
+                if fd is None:
+                    self._create_file(total)
+                    fd, salt = self._open_file(total)
+            finally:
+                os.close(lock_fd)
+            self._map = mmap.mmap(fd, total)
+            self._fd = fd
+            self._salt = salt
+            self._pid = pid
+
+    @property
+    def file(self):
+        """Файл текущей разметки"""
+        return f'{self.path}-{MAGIC.decode()}-{RECORD_SIZE}x{self.buckets}'
+
+    def _open_file(self, total):
+        """(fd, соль) размеченного файла или (None, None), если его нет или он не той разметки"""
+        try:
+            fd = os.open(self.file, os.O_RDWR)
+        except FileNotFoundError:
+            return None, None
+        header = os.pread(fd, HEADER.size, 0)
+        if len(header) == HEADER.size and os.fstat(fd).st_size == total:
+            magic, record_size, buckets, salt = HEADER.unpack(header)
+            if (magic, record_size, buckets) == (MAGIC, RECORD_SIZE, self.buckets):
+                return fd, salt
+        os.close(fd)
+        return None, None
+
+    def _create_file(self, total):
+        """Размечает новый файл рядом и подменяет им старый: чужие mmap старого остаются целыми"""
+        tmp_path = f'{self.file}.{os.getpid()}.tmp'
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, total)
+            os.pwrite(fd, HEADER.pack(MAGIC, RECORD_SIZE, self.buckets, os.urandom(16)), 0)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, self.file)
+        logger.info("Initialized shared license cache %s (%d slots, %d bytes)",
+                    self.file, self.buckets * BUCKET_SLOTS, total)
+
+    def _hash(self, value):
+        # Хеш с солью файла: подобрать ключи в одну корзину снаружи нельзя
+        digest = hashlib.blake2b(value.encode(), digest_size=8, key=self._salt).digest()
+        return int.from_bytes(digest, 'little') or 1
+
+    def fingerprint(self, hwid):
+        """Отпечаток устройства в записи лицензии"""
+        self._open()
+        return self._hash('\0' + hwid)
+
+    def _bucket(self, key_hash):
+        return HEADER_SIZE + (key_hash % self.buckets) * BUCKET_SIZE
+
+    def _read(self, offset):
+        """Согласованная копия записи (seqlock) или None, если писатель не успел"""
+        for _ in range(READ_RETRIES):
+            seq = SEQ.unpack_from(self._map, offset)[0]
+            if seq & 1:
+                continue
+            body = self._map[offset + 8:offset + RECORD_SIZE]
+            if SEQ.unpack_from(self._map, offset)[0] == seq:
+                return BODY.unpack(body)
+        return None
+
+    def _write(self, offset, fields):
+        seq = SEQ.unpack_from(self._map, offset)[0]
+        SEQ.pack_into(self._map, offset, seq + 1)
+        BODY.pack_into(self._map, offset + 8, *fields)
+        SEQ.pack_into(self._map, offset, seq + 2)
+
+    @contextmanager
+    def _locked_bucket(self, bucket):
+        """Блокировка корзины: Lock для потоков процесса + lockf для других процессов"""
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, BUCKET_SIZE, bucket)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, BUCKET_SIZE, bucket)
+
+    # ----- Записи -----
+    def get(self, license_key):
+        """(лицензия, отпечатки активированных устройств, список полный) или None"""
+        key = license_key.encode()
+        if len(key) > MAX_KEY_BYTES:
+            return None
+        self._open()
+        key_hash = self._hash(license_key)
+        bucket = self._bucket(key_hash)
+        now = time.time()
+        for slot in range(BUCKET_SLOTS):
+            fields = self._read(bucket + slot * RECORD_SIZE)
+            if fields is None or fields[0] != key_hash or fields[9].rstrip(b'\0') != key:
+                continue
+            (_, deadline, expires_at, max_activations, current_activations,
+             status, is_active, hwid_count, flags) = fields[:9]
+            if deadline <= now:
+                break
+            self.hits += 1
+            license_dict = {
+                'license_key': license_key,
+                'status': STATUSES[status],
+                'expires_at': expires_at,
+                'max_activations': max_activations,
+                'current_activations': current_activations,
+                'is_active': is_active
+            }
+            return license_dict, frozenset(fields[10:10 + hwid_count]), bool(flags & FLAG_COMPLETE)
+        self.misses += 1
+        return None
+
+    def set(self, license_key, license_dict, hwids):
+        """Сохраняет состояние лицензии и активированные устройства (hwids - все или первые)"""
+        key = license_key.encode()
+        if len(key) > MAX_KEY_BYTES or license_dict['status'] not in STATUSES:
+            return
+        self._open()
+        key_hash = self._hash(license_key)
+        fingerprints = [self._hash('\0' + hwid) for hwid in list(hwids)[:MAX_HWIDS]]
+        fields = (
+            key_hash,
+            time.time() + self.ttl,
+            license_dict['expires_at'],
+            license_dict['max_activations'],
+            license_dict['current_activations'],
+            STATUSES.index(license_dict['status']),
+            int(bool(license_dict['is_active'])),
+            len(fingerprints),
+            FLAG_COMPLETE if len(hwids) <= MAX_HWIDS else 0,
+            key,
+            *fingerprints,
+            *[0] * (MAX_HWIDS - len(fingerprints))
+        )
+        bucket = self._bucket(key_hash)
+        with self._locked_bucket(bucket):
+            self._write(bucket + self._choose_slot(bucket, key_hash, key) * RECORD_SIZE, fields)
+            self.writes += 1
+
+    def _choose_slot(self, bucket, key_hash, key):
+        """Слот той же лицензии, пустой, иначе тот, что истекает раньше всех"""
+        victim, victim_deadline = 0, None
+        for slot in range(BUCKET_SLOTS):
+            # Под блокировкой корзины запись не меняется - читаем без seqlock
+            fields = BODY.unpack_from(self._map, bucket + slot * RECORD_SIZE + 8)
+            if fields[0] == 0 or (fields[0] == key_hash and fields[9].rstrip(b'\0') == key):
+                return slot
+            if victim_deadline is None or fields[1] < victim_deadline:
+                victim, victim_deadline = slot, fields[1]
+        return victim
+
+    def invalidate(self, license_key):
+        """Удаляет запись лицензии: другие воркеры хоста сразу пойдут в базу"""
+        key = license_key.encode()
+        if len(key) > MAX_KEY_BYTES:
+            return
+        self._open()
+        key_hash = self._hash(license_key)
+        bucket = self._bucket(key_hash)
+        with self._locked_bucket(bucket):
+            for slot in range(BUCKET_SLOTS):
+                offset = bucket + slot * RECORD_SIZE
+                fields = BODY.unpack_from(self._map, offset + 8)
+                if fields[0] == key_hash and fields[9].rstrip(b'\0') == key:
+                    self._write(offset, (0, 0.0) + fields[2:])
+                    self.invalidations += 1
+
+    def stats(self):
+        return {
+            'slots': self.buckets * BUCKET_SLOTS,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'invalidations': self.invalidations
+        }
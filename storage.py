@@ -0,0 +1,1526 @@
+"""Слой хранения лицензий: SQLite (по умолчанию) и PostgreSQL
+
+Весь SQL сервера живет здесь. Обработчики в app.py берут соединение из пула
+хранилища (acquire/release) и вызывают методы хранилища, передавая его.
+"""
+import itertools
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import quote
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from metrics import DB_BUSY_ERRORS, DB_LOCK_WAIT, SQL_DURATION
+
+logger = logging.getLogger('snos.storage')
+
+TEST_LICENSE_KEY = "TEST-SNOS-0000-0000-0000-0000-0001"
+
+STATS_COUNTERS = (
+    'total_licenses',
+    'total_activations',
+    'unique_devices',
+    'active_licenses',
+    'expired_licenses',
+    'revoked_licenses',
+    'reconciled_at',
+    # Растет при любом изменении лицензий и активаций - ETag списка лицензий
+    'data_version',
+    # Растет при появлении ключей не нового формата - пересборка фильтра ключей
+    'key_filter_version',
+    # Растет при отзыве - монотонная версия подписанного списка отзыва
+    'revocation_version'
+)
+
+# Столбцы массового импорта/экспорта (порядок полей в CSV)
+LICENSE_COLUMNS = (
+    'id',
+    'license_key',
+    'created_at',
+    'expires_at',
+    'max_activations',
+    'current_activations',
+    'is_active',
+    'status',
+    'notes',
+    'created_by',
+    'source'
+)
+ACTIVATION_COLUMNS = (
+    'license_key',
+    'hwid',
+    'device_name',
+    'platform',
+    'activation_time',
+    'ip_address',
+    'user_agent'
+)
+
+# Столбцы лицензии в горячих запросах. Список явный, а не SELECT *: подготовленное
+# выражение PostgreSQL с * ломается после ALTER TABLE из миграции другого инстанса
+LICENSE_FIELDS = LICENSE_COLUMNS + ('version',)
+
+def _fields(columns, alias):
+    return ', '.join(f'{alias}.{column}' for column in columns)
+
+# Строк за один шаг миграции времени в epoch
+EPOCH_MIGRATION_BATCH = 10000
+
+class PoolExhaustedError(Exception):
+    """Нет свободных соединений в пуле"""
+
+def to_epoch(value):
+    """ISO-строка (наивное локальное время или со смещением) -> целые секунды epoch"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp())
+
+_statement_names = {}
+
+def _statement_name(query):
+    """Метка запроса для метрик: 'select_licenses', 'update_stats_counters'..."""
+    name = _statement_names.get(query)
+    if name is None:
+        verb = query.split(None, 1)[0].lower()
+        table = re.search(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', query, re.IGNORECASE)
+        name = _statement_names[query] = f'{verb}_{table.group(1)}' if table else verb
+    return name
+
+def create_storage(database_url, **options):
+    """Выбирает реализацию хранилища по DATABASE_URL (read_url - реплика PostgreSQL для чтения)"""
+    if database_url.startswith(('postgres://', 'postgresql://')):
+        return PostgresStorage(database_url, **options)
+    if database_url.startswith('sqlite:///'):
+        database_url = database_url[len('sqlite:///'):]
+    return SQLiteStorage(database_url, **options)
+
+# ========== ОБЩАЯ ЛОГИКА ==========
+class BaseStorage:
+    """Запросы, общие для всех СУБД; диалектные отличия - в наследниках"""
+
+    name = None
+
+    def __init__(self, pool_size=8, read_pool_size=None, timeout=30, health_check_interval=60, daily_days=30):
+        self.pool_size = pool_size
+        self.read_pool_size = read_pool_size or pool_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.daily_days = daily_days
+        self.initialized = False
+
+    # ----- Соединения -----
+    # Пишущие запросы и все запросы внутри транзакций - пул записи. Чтение
+    # в эндпоинтах без записи (readonly=True) - отдельный пул: тяжелые отчеты
+    # не занимают соединения, которых ждут активации.
+    def acquire(self, readonly=False):
+        raise NotImplementedError
+
+    def release(self, conn, readonly=False):
+        raise NotImplementedError
+
+    def pool_stats(self):
+        raise NotImplementedError
+
+    def close(self):
+        """Закрывает свободные соединения пула (перед fork или при остановке)"""
+        raise NotImplementedError
+
+    def warm_pool(self, count):
+        """Открывает по count соединений в пулах записи и чтения, чтобы первые запросы не ждали подключения"""
+        opened = 0
+        for readonly, size in ((False, self.pool_size), (True, self.read_pool_size)):
+            conns = []
+            try:
+                for _ in range(min(count, size)):
+                    conns.append(self.acquire(readonly))
+            finally:
+                for conn in conns:
+                    self.release(conn, readonly)
+            opened += len(conns)
+        return opened
+
+    @contextmanager
+    def connection(self, readonly=False):
+        """Соединение вне запроса (фоновые задачи, CLI)"""
+        conn = self.acquire(readonly)
+        try:
+            yield conn
+        finally:
+            self.release(conn, readonly)
+
+    @contextmanager
+    def transaction(self, conn):
+        """Короткая пишущая транзакция: commit при успехе, rollback при ошибке"""
+        c = conn.cursor()
+        try:
+            self._begin_write(c)
+            yield c
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    # ----- Диалект -----
+    def _sql(self, query):
+        return query
+
+    def _is_busy_error(self, exc):
+        return False
+
+    @contextmanager
+    def _observe(self, statement):
+        """Время выполнения запроса и счетчик ошибок блокировки"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            if self._is_busy_error(e):
+                DB_BUSY_ERRORS.inc(statement=statement)
+            raise
+        finally:
+            SQL_DURATION.observe(time.perf_counter() - started, statement=statement)
+
+    def _execute(self, c, query, params=(), statement=None):
+        with self._observe(statement or _statement_name(query)):
+            c.execute(self._sql(query), params)
+
+    def _execute_prepared(self, c, name, query, params):
+        """Горячие запросы; по умолчанию полагаемся на кэш выражений драйвера"""
+        self._execute(c, query, params, statement=name)
+
+    def _begin_write(self, c):
+        pass
+
+    def _for_update(self, of=None, skip_locked=False):
+        """Блокировка выбранных строк до конца транзакции (в SQLite ее дает BEGIN IMMEDIATE)"""
+        return ''
+
+    def _insert_license_rows(self, c, rows):
+        """Вставляет строки лицензий, возвращает множество реально вставленных id"""
+        raise NotImplementedError
+
+    def _insert_import_rows(self, c, table, columns, rows):
+        """Вставляет строки, пропуская конфликты по любому уникальному ключу; возвращает число вставленных"""
+        raise NotImplementedError
+
+    def _stream_cursor(self, conn):
+        return conn.cursor()
+
+    def _epoch_day(self, column):
+        """SQL-выражение: день 'YYYY-MM-DD' (локальное время) для столбца epoch"""
+        raise NotImplementedError
+
+    def _lock_schema(self, c):
+        pass
+
+    def _has_table(self, c, name):
+        raise NotImplementedError
+
+    # ----- Схема и миграции -----
+    # Применяются по порядку при старте, номера примененных - в schema_version.
+    # Миграция 1 повторяет инициализацию до появления версий и идемпотентна,
+    # поэтому старые базы проходят ее без изменений.
+    MIGRATIONS = (
+        (1, '_migration_base_schema'),
+        (2, '_migration_composite_indexes'),
+        (3, '_migration_epoch_timestamps'),
+        (4, '_migration_license_status'),
+        (5, '_migration_license_version'),
+        (6, '_migration_activation_summaries'),
+        (7, '_migration_archive_hwid_index'),
+    )
+
+    def init_schema(self):
+        with self.connection() as conn:
+            with self.transaction(conn) as c:
+                # Не даем нескольким инстансам мигрировать схему одновременно
+                self._lock_schema(c)
+                stats_exist = self._has_table(c, 'stats_counters')
+
+                self._execute(c, '''
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        applied_at BIGINT NOT NULL
+                    )
+                ''')
+                self._execute(c, 'SELECT MAX(version) AS version FROM schema_version')
+                current = c.fetchone()['version'] or 0
+
+                for version, migration in self.MIGRATIONS:
+                    if version <= current:
+                        continue
+                    logger.info("Applying schema migration %s (%s)", version, migration)
+                    getattr(self, migration)(c)
+                    self._execute(c, 'INSERT INTO schema_version (version, applied_at) VALUES (?, ?)',
+                                  (version, int(time.time())))
+
+                # Счетчики считаем по уже мигрированным данным
+                self._seed_stats(c, seed=not stats_exist)
+
+                # Создаем тестовую лицензию если нет
+                if self._create_test_license(c):
+                    logger.info("Created test license: %s", TEST_LICENSE_KEY)
+
+        self.initialized = True
+
+    def _migration_base_schema(self, c):
+        raise NotImplementedError
+
+    def _migration_composite_indexes(self, c):
+        """Индексы под реальные запросы
+
+        idx_license_key дублирует индекс UNIQUE(license_key), а одиночный индекс
+        активаций по license_key - префикс уникального (license_key, hwid),
+        который и так обслуживает проверки активации устройства.
+        COUNT(DISTINCT hwid) покрывает idx_activations_hwid.
+        """
+        self._execute(c, 'DROP INDEX IF EXISTS idx_license_key')
+        self._execute(c, 'DROP INDEX IF EXISTS idx_activations_license')
+        # Активации лицензии по времени - детали лицензии без сортировки
+        self._execute(c, 'CREATE INDEX IF NOT EXISTS idx_activations_license_time ON activations(license_key, activation_time)')
+        # Пересчет активаций по дням за последние daily_days
+        self._execute(c, 'CREATE INDEX IF NOT EXISTS idx_activations_time ON activations(activation_time)')
+
+    def _migration_epoch_timestamps(self, c):
+        raise NotImplementedError
+
+    def _migration_license_status(self, c):
+        """Предвычисленное состояние лицензии (active/expired/revoked) и архив активаций"""
+        self._execute(c, "ALTER TABLE licenses ADD COLUMN status TEXT NOT NULL DEFAULT 'active'")
+        self._execute(c, "UPDATE licenses SET status = 'revoked' WHERE is_active = 0")
+        self._execute(c, "UPDATE licenses SET status = 'expired' WHERE is_active = 1 AND expires_at < ?",
+                      (int(time.time()),))
+        # Фильтр списка по статусу с keyset-пагинацией; обход истекших и архивация
+        self._execute(c, 'CREATE INDEX IF NOT EXISTS idx_licenses_status ON licenses(status, created_at, id)')
+        self._execute(c, 'CREATE INDEX IF NOT EXISTS idx_licenses_status_expiry ON licenses(status, expires_at)')
+        self._execute(c, '''
+            CREATE TABLE IF NOT EXISTS activations_archive (
+                id BIGINT PRIMARY KEY,
+                license_key TEXT NOT NULL,
+                hwid TEXT NOT NULL,
+                device_name TEXT,
+                platform TEXT,
+                activation_time BIGINT NOT NULL,
+                ip_address TEXT,
+                user_agent TEXT,
+                archived_at BIGINT NOT NULL
+            )
+        ''')
+        self._execute(c, 'CREATE INDEX IF NOT EXISTS idx_activations_archive_license ON activations_archive(license_key)')
+
+    def _migration_license_version(self, c):
+        """Версия лицензии для ETag деталей: растет при активации, отзыве, истечении, архивации"""
+        self._execute(c, 'ALTER TABLE licenses ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+
+    def _migration_activation_summaries(self, c):
+        """Сводки старых архивных активаций по лицензии и дню вместо строк архива"""
+        self._execute(c, '''
+            CREATE TABLE IF NOT EXISTS activation_summaries (
+                license_key TEXT NOT NULL,
+                day TEXT NOT NULL,
+                activations INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (license_key, day)
+            )
+        ''')
+        # Отбор строк архива для свертки по времени архивации
+        self._execute(c, 'CREATE INDEX IF NOT EXISTS idx_activations_archive_archived ON activations_archive(archived_at)')
+
+    def _migration_archive_hwid_index(self, c):
+        """Проверка нового устройства при активации смотрит и в архив"""
+        self._execute(c, 'CREATE INDEX IF NOT EXISTS idx_activations_archive_hwid ON activations_archive(hwid)')
+
+    # ----- Лицензии -----
+    def _create_test_license(self, c):
+        self._execute(c, 'SELECT 1 FROM licenses WHERE license_key = ?', (TEST_LICENSE_KEY,))
+        if c.fetchone():
+            return False
+
+        created_at = int(time.time())
+        expires_at = created_at + 365 * 24 * 3600
+        self._execute(c, '''
+            INSERT INTO licenses (id, license_key, created_at, expires_at, max_activations, notes, created_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (license_key) DO NOTHING
+        ''', (
+            str(uuid.uuid4()),
+            TEST_LICENSE_KEY,
+            created_at,
+            expires_at,
+            999,
+            "Test license for development",
+            "system"
+        ))
+        if c.rowcount != 1:
+            return False
+        self._bump_stats(c, total_licenses=1, active_licenses=1, data_version=1, key_filter_version=1)
+        return True
+
+    def get_license(self, conn, license_key):
+        c = conn.cursor()
+        self._execute_prepared(c, 'get_license', f'SELECT {_fields(LICENSE_FIELDS, "l")} FROM licenses l WHERE l.license_key = ?',
+                               (license_key,))
+        row = c.fetchone()
+        return dict(row) if row else None
+
+    def has_license(self, conn, license_key):
+        c = conn.cursor()
+        self._execute_prepared(c, 'has_license', 'SELECT 1 FROM licenses WHERE license_key = ?', (license_key,))
+        return c.fetchone() is not None
+
+    def has_activation(self, conn, license_key, hwid):
+        c = conn.cursor()
+        self._execute_prepared(c, 'has_activation', 'SELECT 1 FROM activations WHERE license_key = ? AND hwid = ?',
+                               (license_key, hwid))
+        return c.fetchone() is not None
+
+    def get_activated_hwids(self, conn, license_key, limit):
+        """До limit активированных устройств лицензии (для общего кэша воркеров)"""
+        c = conn.cursor()
+        self._execute_prepared(c, 'get_activated_hwids', 'SELECT hwid FROM activations WHERE license_key = ? LIMIT ?',
+                               (license_key, limit))
+        return [row['hwid'] for row in c.fetchall()]
+
+    def get_licenses_for_validation(self, conn, pairs, chunk_size=500):
+        """Пакетная валидация: {license_key: (лицензия, {активированные hwid})}
+
+        Лицензии и активации запрошенных устройств выбираются одним JOIN
+        на порцию ключей вместо двух запросов на каждую пару.
+        """
+        hwids_by_key = {}
+        for license_key, hwid in pairs:
+            hwids = hwids_by_key.setdefault(license_key, set())
+            if hwid:
+                hwids.add(hwid)
+
+        result = {}
+        keys = list(hwids_by_key)
+        c = conn.cursor()
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            hwids = sorted(set().union(*(hwids_by_key[key] for key in chunk))) or ['']
+            self._execute(c, f'''
+                SELECT l.*, a.hwid AS activated_hwid
+                FROM licenses l
+                LEFT JOIN activations a
+                    ON a.license_key = l.license_key AND a.hwid IN ({','.join('?' * len(hwids))})
+                WHERE l.license_key IN ({','.join('?' * len(chunk))})
+            ''', (*hwids, *chunk), statement='get_licenses_for_validation')
+            for row in c.fetchall():
+                row = dict(row)
+                activated_hwid = row.pop('activated_hwid')
+                entry = result.setdefault(row['license_key'], (row, set()))
+                if activated_hwid is not None:
+                    entry[1].add(activated_hwid)
+        return result
+
+    def get_license_for_activation(self, conn, license_key, hwid):
+        """Лицензия и время активации этого устройства (existing_activation_time) одним запросом"""
+        c = conn.cursor()
+        self._execute_prepared(c, 'get_license_for_activation', f'''
+            SELECT {_fields(LICENSE_FIELDS, 'l')}, a.activation_time AS existing_activation_time
+            FROM licenses l
+            LEFT JOIN activations a ON a.license_key = l.license_key AND a.hwid = ?
+            WHERE l.license_key = ?
+        ''', (hwid, license_key))
+        row = c.fetchone()
+        return dict(row) if row else None
+
+    def create_licenses(self, conn, count, key_factory, created_at, expires_at,
+                        max_activations, notes, created_by, retries=5):
+        """Создает count лицензий одной транзакцией, возвращает [(license_id, license_key), ...]
+
+        Коллизии ключей перегенерируются внутри той же транзакции.
+        """
+        created_at = int(created_at.timestamp())
+        expires_at = int(expires_at.timestamp())
+        created = []
+
+        with self.transaction(conn) as c:
+            for _ in range(retries):
+                batch = {}
+                while len(batch) < count - len(created):
+                    batch[key_factory()] = str(uuid.uuid4())
+
+                with self._observe('insert_licenses_batch'):
+                    inserted = self._insert_license_rows(c, [
+                        (license_id, license_key, created_at, expires_at, max_activations, notes, created_by)
+                        for license_key, license_id in batch.items()
+                    ])
+                created.extend(
+                    (license_id, license_key) for license_key, license_id in batch.items()
+                    if license_id in inserted
+                )
+                if len(created) == count:
+                    self._bump_stats(c, total_licenses=count, active_licenses=count, data_version=1)
+                    return created
+
+            raise RuntimeError(f'Could not generate {count - len(created)} unique license keys')
+
+    def activate(self, conn, license_key, hwid, device_name, platform, activation_time,
+                 ip_address, user_agent):
+        """Занимает слот активации; возвращает ('activated' | 'max_reached' | 'already_activated', время epoch)
+
+        Лимит проверяется условным UPDATE под блокировкой записи, поэтому
+        параллельные активации из разных воркеров не могут его превысить.
+        """
+        with self.transaction(conn) as c:
+            result = self._activate(c, license_key, hwid, device_name, platform, activation_time,
+                                    ip_address, user_agent)
+            if result[0] != 'activated':
+                conn.rollback()
+        return result
+
+    def activate_many(self, conn, activations):
+        """Групповая фиксация: несколько активаций одной транзакцией (один fsync на пачку)
+
+        activations - кортежи аргументов activate без conn. Каждая активация
+        выполняется в своей точке сохранения: отказ или ошибка одной не
+        затрагивает остальные. Возвращает результаты activate или исключения
+        в том же порядке.
+        """
+        results = []
+        with self.transaction(conn) as c:
+            for activation in activations:
+                self._execute(c, 'SAVEPOINT activation')
+                try:
+                    result = self._activate(c, *activation)
+                except Exception as e:
+                    self._execute(c, 'ROLLBACK TO SAVEPOINT activation')
+                    result = e
+                else:
+                    if result[0] != 'activated':
+                        self._execute(c, 'ROLLBACK TO SAVEPOINT activation')
+                self._execute(c, 'RELEASE SAVEPOINT activation')
+                results.append(result)
+        return results
+
+    def _activate(self, c, license_key, hwid, device_name, platform, activation_time, ip_address, user_agent):
+        """Активация внутри открытой транзакции; результат, отличный от 'activated', нужно откатить"""
+        self._execute(c, '''
+            UPDATE licenses SET current_activations = current_activations + 1, version = version + 1
+            WHERE license_key = ? AND status = 'active' AND current_activations < max_activations
+        ''', (license_key,))
+        if c.rowcount != 1:
+            return 'max_reached', None
+
+        self._record_activation_stats(c, hwid, activation_time)
+
+        self._execute(c, '''
+            INSERT INTO activations (license_key, hwid, device_name, platform, activation_time, ip_address, user_agent)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (license_key, hwid) DO NOTHING
+        ''', (
+            license_key,
+            hwid,
+            device_name,
+            platform,
+            int(activation_time.timestamp()),
+            ip_address,
+            user_agent
+        ))
+        if c.rowcount != 1:
+            # Устройство успели активировать параллельным запросом
+            self._execute(c, 'SELECT activation_time FROM activations WHERE license_key = ? AND hwid = ?',
+                          (license_key, hwid))
+            return 'already_activated', c.fetchone()['activation_time']
+
+        return 'activated', int(activation_time.timestamp())
+
+    def revoke(self, conn, license_key):
+        """Отзывает лицензию; None - лицензия не найдена"""
+        with self.transaction(conn) as c:
+            self._execute(c, 'SELECT status FROM licenses WHERE license_key = ?' + self._for_update(),
+                          (license_key,))
+            row = c.fetchone()
+            if not row:
+                return None
+
+            status = row['status']
+            if status != 'revoked':
+                self._execute(c, '''
+                    UPDATE licenses SET is_active = 0, status = 'revoked', version = version + 1
+                    WHERE license_key = ?
+                ''', (license_key,))
+                self._bump_stats(c, **{f'{status}_licenses': -1}, revoked_licenses=1, data_version=1,
+                                 revocation_version=1)
+        return True
+
+    def iter_licenses(self, conn, limit=None, cursor=None, status=None, source=None, created_by=None):
+        """Лицензии по убыванию (created_at, id), начиная после cursor; строки читаются из курсора БД"""
+        conditions = []
+        params = []
+
+        # Keyset-пагинация по (created_at, id)
+        if cursor:
+            cursor_created_at, cursor_id = cursor
+            conditions.append('(l.created_at < ? OR (l.created_at = ? AND l.id < ?))')
+            params += [cursor_created_at, cursor_created_at, cursor_id]
+
+        # Статус предвычисляет фоновый обход истекших (sweep_expired)
+        if status:
+            conditions.append('l.status = ?')
+            params.append(status)
+
+        if source:
+            conditions.append('l.source = ?')
+            params.append(source)
+        if created_by:
+            conditions.append('l.created_by = ?')
+            params.append(created_by)
+
+        if limit is not None:
+            params.append(limit)
+
+        c = self._stream_cursor(conn)
+        self._execute(c, f'''
+            SELECT l.*, (
+                SELECT COUNT(*) FROM activations a WHERE a.license_key = l.license_key
+            ) as activation_count
+            FROM licenses l
+            {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+            ORDER BY l.created_at DESC, l.id DESC
+            {'LIMIT ?' if limit is not None else ''}
+        ''', params)
+        for row in c:
+            yield dict(row)
+
+    def iter_license_rows(self, conn):
+        """Все лицензии по id, только столбцы таблицы - для экспорта; строки читаются из курсора БД"""
+        c = self._stream_cursor(conn)
+        self._execute(c, f'SELECT {", ".join(LICENSE_COLUMNS)} FROM licenses ORDER BY id')
+        for row in c:
+            yield dict(row)
+
+    def iter_license_keys(self, conn):
+        """Все ключи лицензий; строки читаются из курсора БД"""
+        c = self._stream_cursor(conn)
+        self._execute(c, 'SELECT license_key FROM licenses')
+        for row in c:
+            yield row['license_key']
+
+    def list_revoked_keys(self, conn):
+        c = conn.cursor()
+        self._execute(c, 'SELECT license_key FROM licenses WHERE is_active = 0 ORDER BY license_key')
+        return [row['license_key'] for row in c.fetchall()]
+
+    def recent_activations(self, conn, limit):
+        """Пары (license_key, hwid) последних активаций - устройства, которые скоро придут на валидацию"""
+        c = conn.cursor()
+        self._execute(c, 'SELECT license_key, hwid FROM activations ORDER BY activation_time DESC LIMIT ?',
+                      (limit,))
+        return [(row['license_key'], row['hwid']) for row in c.fetchall()]
+
+    def get_activations(self, conn, license_key, limit=None, cursor=None):
+        """Активации лицензии по убыванию (activation_time, id), начиная после cursor"""
+        conditions = ['license_key = ?']
+        params = [license_key]
+
+        # Keyset-пагинация по (activation_time, id): индекс (license_key, activation_time)
+        if cursor:
+            cursor_time, cursor_id = cursor
+            conditions.append('(activation_time < ? OR (activation_time = ? AND id < ?))')
+            params += [cursor_time, cursor_time, cursor_id]
+
+        if limit is not None:
+            params.append(limit)
+
+        c = conn.cursor()
+        self._execute(c, f'''
+            SELECT * FROM activations
+            WHERE {' AND '.join(conditions)}
+            ORDER BY activation_time DESC, id DESC
+            {'LIMIT ?' if limit is not None else ''}
+        ''', params)
+        return [dict(row) for row in c.fetchall()]
+
+    def get_activation_summaries(self, conn, license_key):
+        """Свернутая история активаций лицензии: [{day, activations}] по убыванию дня"""
+        c = conn.cursor()
+        self._execute(c, 'SELECT day, activations FROM activation_summaries WHERE license_key = ? ORDER BY day DESC',
+                      (license_key,))
+        return [dict(row) for row in c.fetchall()]
+
+    def iter_activations(self, conn):
+        """Все активации по id; строки читаются из курсора БД"""
+        c = self._stream_cursor(conn)
+        self._execute(c, f'SELECT {", ".join(ACTIVATION_COLUMNS)} FROM activations ORDER BY id')
+        for row in c:
+            yield dict(row)
+
+    # ----- Массовый импорт -----
+    def import_licenses(self, conn, rows, chunk_size=500):
+        """Импорт лицензий: rows - кортежи LICENSE_COLUMNS; возвращает (вставлено, пропущено)
+
+        Каждая порция - executemany в отдельной транзакции, поэтому память
+        не зависит от размера файла. Уже существующие ключи пропускаются.
+        """
+        inserted = skipped = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            with self.transaction(conn) as c:
+                with self._observe('import_licenses'):
+                    count = self._insert_import_rows(c, 'licenses', LICENSE_COLUMNS, chunk)
+            inserted += count
+            skipped += len(chunk) - count
+
+        # Среди импортированных могут быть отозванные - новая версия списка отзыва
+        self._finish_import(conn, inserted, key_filter_version=1, revocation_version=1)
+        return inserted, skipped
+
+    def import_activations(self, conn, rows, chunk_size=500):
+        """Импорт активаций: rows - кортежи ACTIVATION_COLUMNS; возвращает (вставлено, пропущено)
+
+        Активации неизвестных лицензий и уже активированных устройств
+        пропускаются; current_activations затронутых лицензий пересчитывается
+        в той же транзакции, что и вставка порции.
+        """
+        inserted = skipped = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            with self.transaction(conn) as c:
+                keys = sorted({row[0] for row in chunk})
+                placeholders = ','.join('?' * len(keys))
+                self._execute(c, f'SELECT license_key FROM licenses WHERE license_key IN ({placeholders})', keys)
+                known = {row['license_key'] for row in c.fetchall()}
+                chunk_rows = [row for row in chunk if row[0] in known]
+
+                count = 0
+                if chunk_rows:
+                    with self._observe('import_activations'):
+                        count = self._insert_import_rows(c, 'activations', ACTIVATION_COLUMNS, chunk_rows)
+                    known = sorted(known)
+                    self._execute(c, f'''
+                        UPDATE licenses SET current_activations = (
+                            SELECT COUNT(*) FROM activations a WHERE a.license_key = licenses.license_key
+                        ), version = version + 1
+                        WHERE license_key IN ({','.join('?' * len(known))})
+                    ''', known)
+            inserted += count
+            skipped += len(chunk) - count
+
+        self._finish_import(conn, inserted)
+        return inserted, skipped
+
+    def _finish_import(self, conn, inserted, **counters):
+        """Счетчики статистики после импорта - одной сверкой, а не по строке"""
+        if inserted:
+            with self.transaction(conn) as c:
+                self._reconcile_stats(c)
+                self._bump_stats(c, data_version=1, **counters)
+
+    # ----- Фоновое обслуживание -----
+    def sweep_expired(self, conn, batch_size):
+        """Помечает истекшие лицензии status='expired' порциями, возвращает их ключи"""
+        swept = []
+        while True:
+            with self.transaction(conn) as c:
+                self._execute(c, f'''
+                    SELECT license_key FROM licenses
+                    WHERE status = 'active' AND expires_at < ?
+                    LIMIT ?{self._for_update()}
+                ''', (int(time.time()), batch_size))
+                keys = [row['license_key'] for row in c.fetchall()]
+                if keys:
+                    self._execute(c, f'''
+                        UPDATE licenses SET status = 'expired', version = version + 1
+                        WHERE status = 'active' AND license_key IN ({','.join('?' * len(keys))})
+                    ''', keys)
+                    self._bump_stats(c, active_licenses=-c.rowcount, expired_licenses=c.rowcount, data_version=1)
+            swept.extend(keys)
+            if len(keys) < batch_size:
+                return swept
+
+    def archive_activations(self, conn, expired_before, batch_size):
+        """Переносит активации лицензий, истекших до expired_before, в activations_archive
+
+        Каждая порция - отдельная короткая транзакция, чтобы не держать
+        блокировку записи. Возвращает число перенесенных активаций.
+        """
+        archived = 0
+        while True:
+            with self.transaction(conn) as c:
+                # Задача стартует во всех воркерах одновременно: строки, которые
+                # уже переносит другой воркер, пропускаем, а не переносим дважды
+                self._execute(c, f'''
+                    SELECT a.id, a.license_key FROM licenses l
+                    JOIN activations a ON a.license_key = l.license_key
+                    WHERE l.status IN ('expired', 'revoked') AND l.expires_at < ?
+                    LIMIT ?{self._for_update(of='a', skip_locked=True)}
+                ''', (expired_before, batch_size))
+                rows = c.fetchall()
+                ids = [row['id'] for row in rows]
+                if ids:
+                    placeholders = ','.join('?' * len(ids))
+                    self._execute(c, f'''
+                        INSERT INTO activations_archive (id, license_key, hwid, device_name, platform,
+                                                         activation_time, ip_address, user_agent, archived_at)
+                        SELECT id, license_key, hwid, device_name, platform, activation_time, ip_address, user_agent, ?
+                        FROM activations WHERE id IN ({placeholders})
+                    ''', (int(time.time()), *ids))
+                    self._execute(c, f'DELETE FROM activations WHERE id IN ({placeholders})', ids)
+                    keys = sorted({row['license_key'] for row in rows})
+                    self._execute(c, f'''
+                        UPDATE licenses SET version = version + 1
+                        WHERE license_key IN ({','.join('?' * len(keys))})
+                    ''', keys)
+                    self._bump_stats(c, data_version=1)
+            archived += len(ids)
+            if len(ids) < batch_size:
+                return archived
+
+    def compact_activations(self, conn, archived_before, batch_size):
+        """Сворачивает строки activations_archive, заархивированные до archived_before,
+        в activation_summaries (лицензия, день, число активаций)
+
+        Как и архивация - порциями в коротких транзакциях. Возвращает число
+        свернутых строк.
+        """
+        day = self._epoch_day('activation_time')
+        compacted = 0
+        while True:
+            with self.transaction(conn) as c:
+                self._execute(c, f'''
+                    SELECT id, license_key FROM activations_archive
+                    WHERE archived_at < ?
+                    LIMIT ?{self._for_update()}
+                ''', (archived_before, batch_size))
+                rows = c.fetchall()
+                ids = [row['id'] for row in rows]
+                if ids:
+                    placeholders = ','.join('?' * len(ids))
+                    self._execute(c, f'''
+                        INSERT INTO activation_summaries (license_key, day, activations)
+                        SELECT license_key, {day}, COUNT(*)
+                        FROM activations_archive WHERE id IN ({placeholders})
+                        GROUP BY license_key, {day}
+                        ON CONFLICT (license_key, day) DO UPDATE
+                        SET activations = activation_summaries.activations + excluded.activations
+                    ''', ids)
+                    self._execute(c, f'DELETE FROM activations_archive WHERE id IN ({placeholders})', ids)
+                    # История в деталях лицензии изменилась - новый ETag деталей и списка
+                    keys = sorted({row['license_key'] for row in rows})
+                    self._execute(c, f'''
+                        UPDATE licenses SET version = version + 1
+                        WHERE license_key IN ({','.join('?' * len(keys))})
+                    ''', keys)
+                    self._bump_stats(c, data_version=1)
+            compacted += len(ids)
+            if len(ids) < batch_size:
+                return compacted
+
+    # ----- Статистика -----
+    def _bump_stats(self, c, **deltas):
+        """Инкрементирует счетчики в текущей транзакции одним UPDATE"""
+        deltas = {name: delta for name, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        self._execute(c, f'''
+            UPDATE stats_counters SET value = value + CASE name {' '.join('WHEN ? THEN ?' for _ in deltas)} END
+            WHERE name IN ({', '.join('?' * len(deltas))})
+        ''', [item for pair in deltas.items() for item in pair] + list(deltas))
+
+    def _seed_stats(self, c, seed):
+        for name in STATS_COUNTERS:
+            self._execute(c, 'INSERT INTO stats_counters (name, value) VALUES (?, 0) ON CONFLICT (name) DO NOTHING',
+                          (name,))
+        if seed:
+            self._reconcile_stats(c)
+            logger.info("Seeded stats counters")
+
+    def _record_activation_stats(self, c, hwid, activation_time):
+        """Учитывает новую активацию (вызывать до INSERT, внутри той же транзакции)
+
+        Устройство новое, если его нет ни в активациях, ни в архиве - как в
+        _reconcile_stats; проверка встроена в UPDATE счетчиков.
+        """
+        self._execute(c, '''
+            UPDATE stats_counters SET value = value + CASE
+                WHEN name <> 'unique_devices' THEN 1
+                WHEN EXISTS (
+                    SELECT 1 FROM activations WHERE hwid = ?
+                    UNION ALL
+                    SELECT 1 FROM activations_archive WHERE hwid = ?
+                ) THEN 0
+                ELSE 1
+            END
+            WHERE name IN ('total_activations', 'unique_devices', 'data_version')
+        ''', (hwid, hwid))
+        self._execute(c, '''
+            INSERT INTO activation_daily (day, activations) VALUES (?, 1)
+            ON CONFLICT (day) DO UPDATE SET activations = activation_daily.activations + 1
+        ''', (activation_time.date().isoformat(),))
+
+    def _reconcile_stats(self, c):
+        """Пересчитывает счетчики по таблицам"""
+        now = datetime.now()
+        since = (now - timedelta(days=self.daily_days)).date()
+        since_epoch = int(datetime.combine(since, datetime.min.time()).timestamp())
+
+        self._execute(c, '''
+            SELECT
+                COUNT(*) AS total_licenses,
+                COALESCE(SUM(CASE WHEN status = 'active' THEN 1 ELSE 0 END), 0) AS active_licenses,
+                COALESCE(SUM(CASE WHEN status = 'expired' THEN 1 ELSE 0 END), 0) AS expired_licenses,
+                COALESCE(SUM(CASE WHEN status = 'revoked' THEN 1 ELSE 0 END), 0) AS revoked_licenses
+            FROM licenses
+        ''')
+        counters = dict(c.fetchone())
+
+        # Архивные активации остаются в итогах
+        self._execute(c, '''
+            SELECT COUNT(*) AS total_activations, COUNT(DISTINCT hwid) AS unique_devices
+            FROM (SELECT hwid FROM activations UNION ALL SELECT hwid FROM activations_archive) AS all_activations
+        ''')
+        counters.update(dict(c.fetchone()))
+
+        # Свернутые - только в числе активаций: HWID у них не осталось, а считать
+        # каждую отдельным устройством значило бы завышать unique_devices
+        self._execute(c, 'SELECT COALESCE(SUM(activations), 0) AS compacted FROM activation_summaries')
+        counters['total_activations'] += c.fetchone()['compacted']
+        counters['reconciled_at'] = int(now.timestamp())
+
+        for name, value in counters.items():
+            self._execute(c, 'UPDATE stats_counters SET value = ? WHERE name = ?', (value, name))
+
+        # Активации по дням пересчитываем только за последние daily_days
+        day = self._epoch_day('activation_time')
+        self._execute(c, 'DELETE FROM activation_daily WHERE day >= ?', (since.isoformat(),))
+        self._execute(c, f'''
+            INSERT INTO activation_daily (day, activations)
+            SELECT {day} AS day, COUNT(*)
+            FROM activations
+            WHERE activation_time >= ?
+            GROUP BY {day}
+        ''', (since_epoch,))
+
+    def reconcile_stats(self, conn, min_interval):
+        """Сверка счетчиков; выполняет один воркер за интервал (аренда через reconciled_at)"""
+        with self.transaction(conn) as c:
+            now = int(time.time())
+            self._execute(c, "UPDATE stats_counters SET value = ? WHERE name = 'reconciled_at' AND value <= ?",
+                          (now, now - min_interval))
+            if c.rowcount != 1:
+                conn.rollback()
+                return False
+            self._reconcile_stats(c)
+        return True
+
+    def get_counter(self, conn, name):
+        """Значение одного счетчика stats_counters"""
+        c = conn.cursor()
+        self._execute(c, 'SELECT value FROM stats_counters WHERE name = ?', (name,))
+        row = c.fetchone()
+        return row['value'] if row else 0
+
+    def get_data_version(self, conn):
+        """Общая версия данных: меняется при любом изменении лицензий и активаций"""
+        return self.get_counter(conn, 'data_version')
+
+    def get_stats(self, conn):
+        """Счетчики и активации по дням - O(1), без сканирования таблиц"""
+        c = conn.cursor()
+        self._execute(c, 'SELECT name, value FROM stats_counters')
+        counters = {row['name']: row['value'] for row in c.fetchall()}
+
+        self._execute(c, 'SELECT day, activations FROM activation_daily ORDER BY day DESC LIMIT ?',
+                      (self.daily_days,))
+        activations_per_day = {row['day']: row['activations'] for row in c.fetchall()}
+        return counters, activations_per_day
+
+# ========== SQLITE ==========
+class ConnectionPool:
+    """Ограниченный пул соединений SQLite (один на процесс)"""
+
+    def __init__(self, database, pragmas=(), max_size=8, timeout=30, health_check_interval=60, uri=False):
+        self.database = database
+        self.pragmas = pragmas
+        self.uri = uri
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._size = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False, timeout=self.timeout,
+                               cached_statements=256, uri=self.uri)
+        conn.row_factory = sqlite3.Row
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        with self._lock:
+            self._size += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._size -= 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _is_healthy(self, conn):
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        """Берет соединение из пула (или создает новое, если есть место)"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolExhaustedError(f'No free connections after {self.timeout}s')
+        try:
+            while True:
+                try:
+                    conn, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+
+                # Проверяем соединения, которые давно простаивали
+                if time.monotonic() - last_used < self.health_check_interval or self._is_healthy(conn):
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        """Возвращает соединение в пул"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put((conn, time.monotonic()))
+        except sqlite3.Error:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Закрывает свободные соединения; занятые закроются при возврате"""
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    def stats(self):
+        return {
+            'size': self._size,
+            'idle': self._idle.qsize(),
+            'max_size': self.max_size
+        }
+
+class SQLiteStorage(BaseStorage):
+    """Файл SQLite; пишущие транзакции - BEGIN IMMEDIATE
+
+    Соединения чтения открыты с mode=ro: каждый запрос читает снимок WAL
+    и не берет блокировок, которых ждет писатель.
+    """
+
+    name = 'sqlite'
+
+    # Эти PRAGMA меняют файл базы - на соединениях только для чтения не нужны
+    WRITE_PRAGMAS = ('PRAGMA journal_mode', 'PRAGMA synchronous')
+
+    def __init__(self, path, pragmas=(), read_url=None, **options):
+        super().__init__(**options)
+        self.path = path
+        self.pool = ConnectionPool(path, pragmas, self.pool_size, self.timeout, self.health_check_interval)
+        read_pragmas = tuple(pragma for pragma in pragmas if not pragma.startswith(self.WRITE_PRAGMAS))
+        self.read_pool = ConnectionPool(f'file:{quote(os.path.abspath(path))}?mode=ro', read_pragmas,
+                                        self.read_pool_size, self.timeout, self.health_check_interval, uri=True)
+
+    def acquire(self, readonly=False):
+        return (self.read_pool if readonly else self.pool).acquire()
+
+    def release(self, conn, readonly=False):
+        (self.read_pool if readonly else self.pool).release(conn)
+
+    def pool_stats(self):
+        stats = self.pool.stats()
+        stats.update({f'read_{key}': value for key, value in self.read_pool.stats().items()})
+        return stats
+
+    def close(self):
+        self.pool.close()
+        self.read_pool.close()
+
+    def _is_busy_error(self, exc):
+        return isinstance(exc, sqlite3.OperationalError) and ('locked' in str(exc) or 'busy' in str(exc))
+
+    def _begin_write(self, c):
+        # Ожидание блокировки записи - основной источник задержек при конкурентных активациях
+        with DB_LOCK_WAIT.time(), self._observe('begin_immediate'):
+            c.execute('BEGIN IMMEDIATE')
+
+    def _insert_license_rows(self, c, rows):
+        c.executemany('''
+            INSERT INTO licenses (id, license_key, created_at, expires_at, max_activations, notes, created_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (license_key) DO NOTHING
+        ''', rows)
+        ids = [row[0] for row in rows]
+        if c.rowcount == len(rows):
+            return set(ids)
+
+        # Узнаем, какие строки вставились (id - свежий uuid, поэтому совпадение = наша строка)
+        inserted = set()
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            c.execute(f"SELECT id FROM licenses WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            inserted.update(row['id'] for row in c.fetchall())
+        return inserted
+
+    def _insert_import_rows(self, c, table, columns, rows):
+        c.executemany(f'''
+            INSERT INTO {table} ({', '.join(columns)})
+            VALUES ({', '.join('?' * len(columns))})
+            ON CONFLICT DO NOTHING
+        ''', rows)
+        return c.rowcount
+
+    def _has_object(self, c, kind, name):
+        c.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?', (kind, name))
+        return c.fetchone() is not None
+
+    def _has_table(self, c, name):
+        return self._has_object(c, 'table', name)
+
+    def _epoch_day(self, column):
+        return f"date({column}, 'unixepoch', 'localtime')"
+
+    def init_schema(self):
+        logger.info("Creating database at: %s", self.path)
+        super().init_schema()
+
+    def _migration_base_schema(self, c):
+        # Таблица лицензий
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS licenses (
+                id TEXT PRIMARY KEY,
+                license_key TEXT UNIQUE NOT NULL,
+                created_at TIMESTAMP NOT NULL,
+                expires_at TIMESTAMP NOT NULL,
+                max_activations INTEGER DEFAULT 1,
+                current_activations INTEGER DEFAULT 0,
+                is_active BOOLEAN DEFAULT 1,
+                notes TEXT,
+                created_by TEXT,
+                source TEXT DEFAULT 'server'
+            )
+        ''')
+
+        # Таблица активаций
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS activations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                license_key TEXT NOT NULL,
+                hwid TEXT NOT NULL,
+                device_name TEXT,
+                platform TEXT,
+                activation_time TIMESTAMP NOT NULL,
+                ip_address TEXT,
+                user_agent TEXT
+            )
+        ''')
+
+        # Индексы для скорости
+        c.execute('CREATE INDEX IF NOT EXISTS idx_license_key ON licenses(license_key)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_activations_license ON activations(license_key)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_licenses_created ON licenses(created_at, id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_activations_hwid ON activations(hwid)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_licenses_revoked ON licenses(license_key) WHERE is_active = 0')
+
+        # Одна активация на устройство: UNIQUE(license_key, hwid) для INSERT ... ON CONFLICT
+        if not self._has_object(c, 'index', 'idx_activations_license_hwid'):
+            # Дубли могли появиться из-за гонок до введения ограничения
+            c.execute('DELETE FROM activations WHERE id NOT IN (SELECT MIN(id) FROM activations GROUP BY license_key, hwid)')
+            c.execute('CREATE UNIQUE INDEX idx_activations_license_hwid ON activations(license_key, hwid)')
+            c.execute('''
+                UPDATE licenses SET current_activations = (
+                    SELECT COUNT(*) FROM activations a WHERE a.license_key = licenses.license_key
+                )
+            ''')
+            logger.info("Created unique activation index and reconciled activation counters")
+
+        # Агрегаты для /api/stats, обновляются вместе с данными
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS activation_daily (
+                day TEXT PRIMARY KEY,
+                activations INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+    def _migration_epoch_timestamps(self, c):
+        """ISO-строки времени -> целые секунды epoch
+
+        Столбцы TIMESTAMP в SQLite имеют числовое сродство, поэтому тип
+        не меняется - переписываются только значения, порциями по rowid.
+        """
+        for table, columns in (('licenses', ('created_at', 'expires_at')),
+                               ('activations', ('activation_time',))):
+            last_rowid = 0
+            while True:
+                c.execute(f"SELECT rowid, {', '.join(columns)} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                          (last_rowid, EPOCH_MIGRATION_BATCH))
+                rows = c.fetchall()
+                if not rows:
+                    break
+                last_rowid = rows[-1][0]
+                c.executemany(
+                    f"UPDATE {table} SET {', '.join(f'{column} = ?' for column in columns)} WHERE rowid = ?",
+                    [tuple(to_epoch(row[column]) for column in columns) + (row[0],) for row in rows]
+                )
+            logger.info("Converted %s timestamps to epoch seconds", table)
+
+# ========== POSTGRESQL ==========
+def _prepared_connection_class():
+    import psycopg2.extensions
+
+    class PreparedConnection(psycopg2.extensions.connection):
+        """Соединение, помнящее свои серверные подготовленные выражения"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
+
+    return PreparedConnection
+
+class PgConnectionPool:
+    """ThreadedConnectionPool с ожиданием свободного соединения и проверкой простаивавших"""
+
+    def __init__(self, dsn, max_size, timeout, health_check_interval, readonly=False):
+        import psycopg2.extras
+        import psycopg2.pool
+
+        self._psycopg2 = psycopg2
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.readonly = readonly
+        # Соединения открываются по требованию (minconn=0), чтобы считать их самим
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            0, max_size, dsn,
+            connection_factory=_prepared_connection_class(),
+            cursor_factory=psycopg2.extras.RealDictCursor
+        )
+        # ThreadedConnectionPool не ждет свободного соединения - ограничиваем семафором
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self._size = 0
+        self._in_use = 0
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolExhaustedError(f'No free connections after {self.timeout}s')
+        try:
+            while True:
+                conn = self.pool.getconn()
+                last_used = self._last_used.pop(id(conn), None)
+                if last_used is None:
+                    # Только что открытое соединение проверять незачем
+                    last_used = time.monotonic()
+                    with self._lock:
+                        self._size += 1
+                    if not conn.closed and self.readonly:
+                        # Новое соединение чтения: сервер сам отклонит случайную запись
+                        conn.set_session(readonly=True)
+                if not conn.closed and (time.monotonic() - last_used < self.health_check_interval
+                                        or self._is_healthy(conn)):
+                    with self._lock:
+                        self._in_use += 1
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _is_healthy(self, conn):
+        try:
+            with conn.cursor() as c:
+                c.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except self._psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        self.pool.putconn(conn, close=True)
+        with self._lock:
+            self._size -= 1
+
+    def release(self, conn):
+        with self._lock:
+            self._in_use -= 1
+        try:
+            if not conn.closed and conn.status != self._psycopg2.extensions.STATUS_READY:
+                conn.rollback()
+            if conn.closed:
+                self._discard(conn)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                self.pool.putconn(conn)
+        except self._psycopg2.Error:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self._size,
+                'idle': self._size - self._in_use,
+                'max_size': self.max_size
+            }
+
+    def close(self):
+        self.pool.closeall()
+
+class PostgresStorage(BaseStorage):
+    """PostgreSQL через ThreadedConnectionPool; горячие запросы - PREPARE/EXECUTE
+
+    read_url - реплика для чтения (потоковая репликация отстает на доли
+    секунды); без нее чтение идет в основную базу отдельным пулом.
+    """
+
+    name = 'postgresql'
+
+    def __init__(self, dsn, pragmas=(), read_url=None, **options):
+        super().__init__(**options)
+        # psycopg2 нужен только при DATABASE_URL=postgres://...
+        import psycopg2
+
+        self._psycopg2 = psycopg2
+        self.pool = PgConnectionPool(dsn, self.pool_size, self.timeout, self.health_check_interval)
+        self.read_pool = PgConnectionPool(read_url or dsn, self.read_pool_size, self.timeout,
+                                          self.health_check_interval, readonly=True)
+
+    def acquire(self, readonly=False):
+        return (self.read_pool if readonly else self.pool).acquire()
+
+    def release(self, conn, readonly=False):
+        (self.read_pool if readonly else self.pool).release(conn)
+
+    def pool_stats(self):
+        stats = self.pool.stats()
+        stats.update({f'read_{key}': value for key, value in self.read_pool.stats().items()})
+        return stats
+
+    def close(self):
+        self.pool.close()
+        self.read_pool.close()
+
+    def _sql(self, query):
+        return query.replace('?', '%s')
+
+    def _is_busy_error(self, exc):
+        # lock_not_available (lock_timeout) и deadlock_detected
+        return getattr(exc, 'pgcode', None) in ('55P03', '40P01')
+
+    def _execute_prepared(self, c, name, query, params):
+        """Серверные подготовленные выражения: PREPARE один раз на соединение
+
+        Если схему поменяли из другого процесса ("cached plan must not change
+        result type"), выражение готовится заново. Подготовленные выражения -
+        чтения в начале запроса, поэтому откат прерванной транзакции ничего
+        не теряет.
+        """
+        conn = c.connection
+        try:
+            self._execute_prepared_once(c, name, query, params)
+        except self._psycopg2.errors.FeatureNotSupported as e:
+            if 'cached plan' not in str(e):
+                raise
+            logger.warning("Re-preparing %s after a schema change", name)
+            conn.rollback()
+            c.execute(f'DEALLOCATE {name}')
+            conn.prepared.discard(name)
+            self._execute_prepared_once(c, name, query, params)
+
+    def _execute_prepared_once(self, c, name, query, params):
+        conn = c.connection
+        if name not in conn.prepared:
+            numbers = iter(range(1, len(params) + 1))
+            c.execute(f"PREPARE {name} AS {re.sub(r'[?]', lambda _: f'${next(numbers)}', query)}")
+            conn.prepared.add(name)
+        with self._observe(name):
+            c.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+    def _for_update(self, of=None, skip_locked=False):
+        return ' FOR UPDATE' + (f' OF {of}' if of else '') + (' SKIP LOCKED' if skip_locked else '')
+
+    def _activate(self, c, license_key, hwid, device_name, platform, activation_time, ip_address, user_agent):
+        """Активация одним выражением: условный UPDATE лицензии, вставка активации,
+        счетчики и активации по дням - в CTE, один обмен с сервером
+
+        Все части видят один снимок, поэтому проверка нового устройства
+        смотрит на таблицы до вставки, как и в общей реализации.
+        """
+        epoch = int(activation_time.timestamp())
+        self._execute(c, '''
+            WITH license AS (
+                UPDATE licenses SET current_activations = current_activations + 1, version = version + 1
+                WHERE license_key = ? AND status = 'active' AND current_activations < max_activations
+                RETURNING license_key
+            ), device AS (
+                SELECT NOT EXISTS (
+                    SELECT 1 FROM activations WHERE hwid = ?
+                    UNION ALL
+                    SELECT 1 FROM activations_archive WHERE hwid = ?
+                ) AS is_new
+            ), activation AS (
+                INSERT INTO activations (license_key, hwid, device_name, platform, activation_time, ip_address, user_agent)
+                SELECT license_key, ?::text, ?::text, ?::text, ?::bigint, ?::text, ?::text FROM license
+                ON CONFLICT (license_key, hwid) DO NOTHING
+                RETURNING activation_time
+            ), counters AS (
+                UPDATE stats_counters SET value = value + CASE
+                    WHEN name <> 'unique_devices' THEN 1
+                    WHEN (SELECT is_new FROM device) THEN 1
+                    ELSE 0
+                END
+                WHERE name IN ('total_activations', 'unique_devices', 'data_version')
+                  AND EXISTS (SELECT 1 FROM activation)
+            ), daily AS (
+                INSERT INTO activation_daily (day, activations)
+                SELECT ?::text, 1 FROM activation
+                ON CONFLICT (day) DO UPDATE SET activations = activation_daily.activations + 1
+            )
+            SELECT
+                (SELECT COUNT(*) FROM license) AS updated,
+                (SELECT activation_time FROM activation) AS activation_time,
+                (SELECT activation_time FROM activations WHERE license_key = ? AND hwid = ?) AS existing_time
+        ''', (license_key, hwid, hwid, hwid, device_name, platform, epoch, ip_address, user_agent,
+              activation_time.date().isoformat(), license_key, hwid), statement='activate')
+        row = c.fetchone()
+        if not row['updated']:
+            return 'max_reached', None
+        if row['activation_time'] is not None:
+            return 'activated', row['activation_time']
+
+        # Устройство активировали параллельно: строка зафиксирована после снимка выражения
+        existing_time = row['existing_time']
+        if existing_time is None:
+            self._execute(c, 'SELECT activation_time FROM activations WHERE license_key = ? AND hwid = ?',
+                          (license_key, hwid))
+            existing_time = c.fetchone()['activation_time']
+        return 'already_activated', existing_time
+
+    def _insert_license_rows(self, c, rows):
+        from psycopg2.extras import execute_values
+
+        inserted = execute_values(c, '''
+            INSERT INTO licenses (id, license_key, created_at, expires_at, max_activations, notes, created_by)
+            VALUES %s
+            ON CONFLICT (license_key) DO NOTHING
+            RETURNING id
+        ''', rows, page_size=1000, fetch=True)
+        return {row['id'] for row in inserted}
+
+    def _insert_import_rows(self, c, table, columns, rows):
+        from psycopg2.extras import execute_values
+
+        inserted = execute_values(c, f'''
+            INSERT INTO {table} ({', '.join(columns)})
+            VALUES %s
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+        ''', rows, page_size=1000, fetch=True)
+        return len(inserted)
+
+    def _stream_cursor(self, conn):
+        # Именованный (серверный) курсор: строки приходят порциями по itersize
+        c = conn.cursor(name=f'stream_{uuid.uuid4().hex}')
+        c.itersize = 1000
+        return c
+
+    def _lock_schema(self, c):
+        c.execute('SELECT pg_advisory_xact_lock(7247001)')
+
+    def _has_table(self, c, name):
+        c.execute('SELECT to_regclass(%s) IS NOT NULL AS exists', (name,))
+        return c.fetchone()['exists']
+
+    def _epoch_day(self, column):
+        return f"to_char(to_timestamp({column}), 'YYYY-MM-DD')"
+
+    def init_schema(self):
+        logger.info("Initializing PostgreSQL schema")
+        super().init_schema()
+
+    def _migration_base_schema(self, c):
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS licenses (
+                id TEXT PRIMARY KEY,
+                license_key TEXT UNIQUE NOT NULL,
+                created_at TEXT NOT NULL,
+                expires_at TEXT NOT NULL,
+                max_activations INTEGER DEFAULT 1,
+                current_activations INTEGER DEFAULT 0,
+                is_active INTEGER DEFAULT 1,
+                notes TEXT,
+                created_by TEXT,
+                source TEXT DEFAULT 'server'
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS activations (
+                id BIGSERIAL PRIMARY KEY,
+                license_key TEXT NOT NULL,
+                hwid TEXT NOT NULL,
+                device_name TEXT,
+                platform TEXT,
+                activation_time TEXT NOT NULL,
+                ip_address TEXT,
+                user_agent TEXT,
+                UNIQUE (license_key, hwid)
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_licenses_created ON licenses(created_at, id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_activations_hwid ON activations(hwid)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_licenses_revoked ON licenses(license_key) WHERE is_active = 0')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT PRIMARY KEY,
+                value BIGINT NOT NULL DEFAULT 0
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS activation_daily (
+                day TEXT PRIMARY KEY,
+                activations BIGINT NOT NULL DEFAULT 0
+            )
+        ''')
+
+    def _migration_epoch_timestamps(self, c):
+        """TEXT с ISO-временем -> BIGINT epoch; наивное время читается в часовом поясе сессии"""
+        for table, columns in (('licenses', ('created_at', 'expires_at')),
+                               ('activations', ('activation_time',))):
+            c.execute(f"ALTER TABLE {table} " + ', '.join(
+                f"ALTER COLUMN {column} TYPE BIGINT USING EXTRACT(EPOCH FROM {column}::timestamptz)::bigint"
+                for column in columns
+            ))
@@ -0,0 +1,58 @@
+"""Общие фикстуры тестов: база SQLite во временном каталоге
+
+Настройки app читаются из окружения при импорте, поэтому окружение
+задается здесь, до первого import app.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ADMIN_API_KEY = 'test-admin-key'
+
+_app_dir = tempfile.mkdtemp(prefix='snos-tests-')
+os.environ.update({
+    'DATABASE_URL': os.path.join(_app_dir, 'licenses.db'),
+    'ADMIN_API_KEY': ADMIN_API_KEY,
+    'RATE_LIMIT_IP_RATE': '0',
+    'RATE_LIMIT_KEY_RATE': '0',
+    'LOG_LEVEL': 'WARNING',
+    # Ложные срабатывания фильтра ключей делали бы тесты отказа нестабильными
+    'KEY_FILTER_ERROR_RATE': '0.000001',
+})
+os.environ.pop('DATABASE_READ_URL', None)
+os.environ.pop('SHARED_CACHE_PATH', None)
+
+from storage import create_storage  # noqa: E402
+
+PRAGMAS = ('PRAGMA journal_mode=WAL', 'PRAGMA synchronous=NORMAL')
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'licenses.db')
+
+@pytest.fixture
+def storage(db_path):
+    """Отдельное хранилище на тест, схема уже создана"""
+    storage = create_storage(db_path, pragmas=PRAGMAS, pool_size=16)
+    storage.init_schema()
+    yield storage
+    storage.close()
+
+@pytest.fixture(scope='session')
+def app_module():
+    import app
+    assert app.warm_up()
+    return app
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+@pytest.fixture
+def admin_headers():
+    return {'X-API-Key': ADMIN_API_KEY}
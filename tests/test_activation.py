@@ -0,0 +1,172 @@
+"""Лимит активаций при параллельных запросах"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+from licensekeys import KeyFormat
+
+MAX_ACTIVATIONS = 3
+DEVICES = 24
+
+def create_license(storage, max_activations=MAX_ACTIVATIONS):
+    created_at = datetime.now().replace(microsecond=0)
+    with storage.connection() as conn:
+        [(_, license_key)] = storage.create_licenses(
+            conn, 1, KeyFormat('test').generate, created_at, created_at + timedelta(days=30),
+            max_activations, '', 'tests'
+        )
+    return license_key
+
+def activate_concurrently(storage, license_key, hwids):
+    """Активирует устройства из отдельных потоков и соединений, стартуя одновременно"""
+    barrier = threading.Barrier(len(hwids))
+
+    def activate(hwid):
+        # Соединение берем после барьера: потоков больше, чем соединений в пуле
+        barrier.wait()
+        with storage.connection() as conn:
+            status, _ = storage.activate(conn, license_key, hwid, 'device', 'test', datetime.now(),
+                                         '127.0.0.1', 'pytest')
+        return status
+
+    with ThreadPoolExecutor(len(hwids)) as pool:
+        return list(pool.map(activate, hwids))
+
+def activation_state(storage, license_key):
+    with storage.connection() as conn:
+        license_row = storage.get_license(conn, license_key)
+        hwids = storage.get_activated_hwids(conn, license_key, DEVICES + 1)
+    return license_row['current_activations'], hwids
+
+def test_concurrent_activations_respect_limit(storage):
+    license_key = create_license(storage)
+
+    results = activate_concurrently(storage, license_key, [f'hwid-{i}' for i in range(DEVICES)])
+
+    assert results.count('activated') == MAX_ACTIVATIONS
+    assert results.count('max_reached') == DEVICES - MAX_ACTIVATIONS
+    current_activations, hwids = activation_state(storage, license_key)
+    assert current_activations == MAX_ACTIVATIONS
+    assert len(hwids) == MAX_ACTIVATIONS
+
+def test_concurrent_activations_of_one_device_take_one_slot(storage):
+    license_key = create_license(storage)
+
+    results = activate_concurrently(storage, license_key, ['hwid-same'] * 8)
+
+    assert results.count('activated') == 1
+    assert set(results) <= {'activated', 'already_activated'}
+    current_activations, hwids = activation_state(storage, license_key)
+    assert current_activations == 1
+    assert list(hwids) == ['hwid-same']
+
+def test_activate_many_stops_at_limit(storage):
+    license_key = create_license(storage)
+    activations = [
+        (license_key, f'hwid-{i}', 'device', 'test', datetime.now(), '127.0.0.1', 'pytest')
+        for i in range(MAX_ACTIVATIONS + 2)
+    ]
+
+    with storage.connection() as conn:
+        results = storage.activate_many(conn, activations)
+
+    assert [result[0] for result in results] == ['activated'] * MAX_ACTIVATIONS + ['max_reached'] * 2
+    current_activations, hwids = activation_state(storage, license_key)
+    assert current_activations == MAX_ACTIVATIONS
+    assert len(hwids) == MAX_ACTIVATIONS
+
+@pytest.mark.parametrize('max_activations', [1, 2])
+def test_concurrent_api_activations_respect_limit(app_module, admin_headers, max_activations):
+    client = app_module.app.test_client()
+    response = client.post('/api/generate', json={'max_activations': max_activations}, headers=admin_headers)
+    license_key = response.get_json()['license_key']
+    barrier = threading.Barrier(12)
+
+    def activate(i):
+        client = app_module.app.test_client()
+        barrier.wait()
+        response = client.post('/api/activate', json={'license_key': license_key, 'hwid': f'api-hwid-{i}'})
+        return response.status_code, response.get_json()['success']
+
+    with ThreadPoolExecutor(12) as pool:
+        results = list(pool.map(activate, range(12)))
+
+    assert sum(success for _, success in results) == max_activations
+    validate = client.post('/api/validate', json={'license_key': license_key, 'hwid': ''}).get_json()
+    assert validate['current_activations'] == max_activations
+
+def test_archived_device_is_not_counted_again(storage):
+    first = create_license(storage)
+    activate_concurrently(storage, first, ['hwid-archived'])
+    with storage.connection() as conn:
+        storage.revoke(conn, first)
+        assert storage.archive_activations(conn, 2 ** 40, 100) == 1
+
+    second = create_license(storage)
+    assert activate_concurrently(storage, second, ['hwid-archived']) == ['activated']
+
+    with storage.connection() as conn:
+        counters, _ = storage.get_stats(conn)
+        with storage.transaction(conn) as c:
+            storage._reconcile_stats(c)
+        reconciled, _ = storage.get_stats(conn)
+    assert counters['unique_devices'] == reconciled['unique_devices'] == 1
+    assert counters['total_activations'] == reconciled['total_activations'] == 2
+
+def test_timed_out_batch_activation_is_not_committed(app_module, admin_headers, monkeypatch):
+    client = app_module.app.test_client()
+    license_key = client.post('/api/generate', json={'max_activations': 5}, headers=admin_headers).get_json()['license_key']
+    monkeypatch.setattr(app_module, 'DB_TIMEOUT', 0.05)
+    batcher = app_module.ActivationBatcher(max_batch=1, max_delay=0)
+    flush = batcher._flush
+    release = threading.Event()
+
+    def slow_flush(batch):
+        # Первая пачка фиксируется дольше таймаута, вторая стоит за ней в очереди
+        release.wait(5)
+        flush(batch)
+
+    monkeypatch.setattr(batcher, '_flush', slow_flush)
+
+    def submit(hwid):
+        activation = (license_key, hwid, 'device', 'test', datetime.now(), '127.0.0.1', 'pytest')
+        with pytest.raises(app_module.ActivationTimeout) as excinfo:
+            batcher.submit(*activation)
+        return excinfo.value.unknown
+
+    with ThreadPoolExecutor(2) as pool:
+        running = pool.submit(submit, 'hwid-running')
+        time.sleep(0.02)
+        queued = pool.submit(submit, 'hwid-queued')
+        assert queued.result() is False
+        assert running.result() is True
+    release.set()
+
+    deadline = time.monotonic() + 5
+    storage = app_module.get_storage()
+    while time.monotonic() < deadline:
+        with storage.connection() as conn:
+            hwids = storage.get_activated_hwids(conn, license_key, 10)
+        if hwids:
+            break
+        time.sleep(0.01)
+    # Зафиксирована только пачка, которая уже выполнялась; снятая с очереди - нет
+    assert list(hwids) == ['hwid-running']
+
+def test_batch_timeout_returns_503(app_module, admin_headers, monkeypatch):
+    client = app_module.app.test_client()
+    license_key = client.post('/api/generate', json={}, headers=admin_headers).get_json()['license_key']
+
+    def submit(*activation):
+        raise app_module.ActivationTimeout(unknown=True)
+
+    monkeypatch.setattr(app_module, 'ACTIVATION_GROUP_COMMIT', True)
+    monkeypatch.setattr(app_module.activation_batcher, 'submit', submit)
+    response = client.post('/api/activate', json={'license_key': license_key, 'hwid': 'hwid-1'})
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert response.get_json()['result_unknown'] is True
@@ -0,0 +1,26 @@
+"""Ключ администратора: совместимость эндпоинтов исходной версии и закрытые новые"""
+import pytest
+
+@pytest.mark.parametrize('headers', [{}, {'X-API-Key': 'wrong'}])
+def test_baseline_endpoints_accept_any_key(client, headers):
+    assert client.get('/api/stats', headers=headers).status_code == 200
+    assert client.get('/api/licenses', headers=headers).status_code == 200
+    assert client.post('/api/generate', json={}, headers=headers).get_json()['success']
+
+@pytest.mark.parametrize('method, path', [
+    ('post', '/api/revoke'),
+    ('post', '/api/generate/batch'),
+    ('post', '/api/admin/import/licenses'),
+    ('get', '/api/admin/export/licenses'),
+    ('get', '/api/admin/logging'),
+    ('get', '/api/admin/profile'),
+])
+def test_admin_endpoints_require_key(client, admin_headers, method, path):
+    for headers in ({}, {'X-API-Key': 'wrong'}):
+        assert getattr(client, method)(path, headers=headers).status_code == 401
+
+def test_admin_endpoints_disabled_without_configured_key(app_module, client, admin_headers, monkeypatch):
+    monkeypatch.setattr(app_module, 'ADMIN_API_KEY_CONFIGURED', False)
+
+    assert client.get('/api/admin/logging', headers=admin_headers).status_code == 503
+    assert client.get('/api/stats').status_code == 200
@@ -0,0 +1,53 @@
+"""Разбор строк импорта лицензий"""
+import io
+
+import pytest
+
+import bulk
+
+NOW = 1_800_000_000
+
+def record(**fields):
+    return {'license_key': 'LEGACY-1', 'expires_at': NOW + 86400, **fields}
+
+def parsed(**fields):
+    return dict(zip(bulk.TABLES['licenses'], bulk.parse_license(record(**fields), NOW)))
+
+@pytest.mark.parametrize('status, is_active', [
+    ('active', '0'),
+    ('expired', 'false'),
+    ('revoked', '1'),
+    ('revoked', True),
+])
+def test_conflicting_status_and_is_active_are_rejected(status, is_active):
+    with pytest.raises(ValueError, match='status and is_active disagree'):
+        bulk.parse_license(record(status=status, is_active=is_active), NOW)
+
+@pytest.mark.parametrize('fields, status, is_active', [
+    ({}, 'active', 1),
+    ({'is_active': '0'}, 'revoked', 0),
+    ({'expires_at': NOW - 1}, 'expired', 1),
+    ({'status': 'revoked'}, 'revoked', 0),
+    ({'status': 'expired'}, 'expired', 1),
+    ({'status': 'active', 'is_active': 'true'}, 'active', 1),
+    ({'status': 'revoked', 'is_active': '0'}, 'revoked', 0),
+])
+def test_status_and_is_active_are_derived(fields, status, is_active):
+    row = parsed(**fields)
+
+    assert (row['status'], row['is_active']) == (status, is_active)
+
+def test_conflicting_row_is_reported_and_skipped(storage):
+    lines = [
+        '{"license_key": "LEGACY-1", "expires_at": 9999999999, "status": "revoked", "is_active": 1}',
+        '{"license_key": "LEGACY-2", "expires_at": 9999999999, "status": "revoked"}',
+    ]
+    stream = io.BytesIO('\n'.join(lines).encode())
+
+    with storage.connection() as conn:
+        report = bulk.import_file(storage, conn, 'licenses', stream, 'ndjson')
+        revoked = storage.list_revoked_keys(conn)
+
+    assert (report.imported, report.invalid) == (1, 1)
+    assert report.errors == [{'line': 1, 'error': 'status and is_active disagree'}]
+    assert revoked == ['LEGACY-2']
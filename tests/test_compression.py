@@ -0,0 +1,92 @@
+"""Сжатие ответов: выбор кодировки по Accept-Encoding, потоки, 304 и маленькие тела"""
+import gzip
+import json
+import zlib
+
+import pytest
+
+@pytest.fixture(scope='module')
+def licenses(app_module):
+    """Достаточно лицензий, чтобы страница списка была больше COMPRESS_MIN_SIZE"""
+    client = app_module.app.test_client()
+    response = client.post('/api/generate/batch', json={'count': 30, 'created_by': 'compression-test'},
+                           headers={'X-API-Key': app_module.ADMIN_API_KEY, 'Accept-Encoding': 'identity'})
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+def get_list(client, admin_headers, accept_encoding=None, **params):
+    headers = dict(admin_headers)
+    if accept_encoding is not None:
+        headers['Accept-Encoding'] = accept_encoding
+    params.setdefault('created_by', 'compression-test')
+    return client.get('/api/licenses', query_string=params, headers=headers)
+
+def test_large_json_is_gzipped(client, admin_headers, licenses, app_module):
+    response = get_list(client, admin_headers, 'gzip, deflate')
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.vary
+    body = gzip.decompress(response.get_data())
+    assert len(body) >= app_module.COMPRESS_MIN_SIZE
+    assert json.loads(body)['count'] == len(licenses)
+    assert int(response.headers['Content-Length']) == len(response.get_data())
+
+@pytest.mark.parametrize('accept_encoding', [None, 'identity', 'gzip;q=0, identity', 'deflate'])
+def test_no_acceptable_encoding_sends_plain_body(client, admin_headers, licenses, accept_encoding):
+    response = get_list(client, admin_headers, accept_encoding)
+
+    assert 'Content-Encoding' not in response.headers
+    assert 'Accept-Encoding' in response.vary
+    assert response.get_json()['count'] == len(licenses)
+
+def test_brotli_is_not_offered_without_module(client, admin_headers, licenses, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'brotli', None)
+
+    assert get_list(client, admin_headers, 'br').headers.get('Content-Encoding') is None
+    assert get_list(client, admin_headers, 'br, gzip;q=0.5').headers['Content-Encoding'] == 'gzip'
+
+def test_brotli_preferred_when_installed(client, admin_headers, licenses):
+    brotli = pytest.importorskip('brotli')
+    response = get_list(client, admin_headers, 'gzip, br')
+
+    assert response.headers['Content-Encoding'] == 'br'
+    assert json.loads(brotli.decompress(response.get_data()))['count'] == len(licenses)
+
+def test_small_body_is_not_compressed(client, app_module):
+    response = client.post('/api/validate', json={'license_key': 'SNOS-NONE-0000', 'hwid': ''},
+                           headers={'Accept-Encoding': 'gzip'})
+
+    assert len(response.get_data()) < app_module.COMPRESS_MIN_SIZE
+    assert 'Content-Encoding' not in response.headers
+    assert 'Accept-Encoding' in response.vary
+
+def test_not_modified_is_not_compressed(client, admin_headers, licenses):
+    etag = get_list(client, admin_headers, 'gzip').headers['ETag']
+
+    headers = dict(admin_headers, **{'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    response = client.get('/api/licenses', query_string={'created_by': 'compression-test'}, headers=headers)
+    assert response.status_code == 304
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data() == b''
+
+def test_streamed_ndjson_is_compressed_per_chunk(client, admin_headers, licenses):
+    response = get_list(client, admin_headers, 'gzip', format='ndjson')
+
+    assert response.is_streamed
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in response.headers
+
+    # Каждая порция сброшена Z_SYNC_FLUSH: ее можно распаковать, не дожидаясь конца потока
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = [decompressor.decompress(chunk) for chunk in response.response]
+    assert sum(1 for chunk in chunks if chunk) == len(licenses)
+    lines = b''.join(chunks).decode().splitlines()
+    assert sorted(json.loads(line)['license_key'] for line in lines) == sorted(row['license_key'] for row in licenses)
+
+def test_streamed_batch_without_gzip_is_plain(client, admin_headers):
+    response = client.post('/api/generate/batch', json={'count': 2, 'format': 'csv'},
+                           headers=dict(admin_headers, **{'Accept-Encoding': 'identity'}))
+
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data(as_text=True).count('\n') == 3
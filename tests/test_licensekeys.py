@@ -0,0 +1,131 @@
+"""Формат ключей SNOS2 и отсев неизвестных ключей без запроса к базе"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from licensekeys import ALPHABET, KEY_LENGTH, KEY_PREFIX, BloomFilter, KeyFormat, KnownKeyFilter
+
+@pytest.fixture
+def key_format():
+    return KeyFormat('test-secret')
+
+def replace_char(license_key, index):
+    char = license_key[index]
+    return license_key[:index] + ALPHABET[(ALPHABET.index(char) + 1) % len(ALPHABET)] + license_key[index + 1:]
+
+def test_generated_keys_have_expected_shape(key_format):
+    keys = {key_format.generate() for _ in range(200)}
+
+    assert len(keys) == 200
+    for license_key in keys:
+        assert len(license_key) == KEY_LENGTH
+        assert license_key.startswith(KEY_PREFIX)
+        groups = license_key[len(KEY_PREFIX):].split('-')
+        assert [len(group) for group in groups] == [6, 6, 6, 6]
+        assert set(''.join(groups)) <= set(ALPHABET)
+        assert key_format.verify(license_key)
+
+def test_any_changed_character_fails_verification(key_format):
+    license_key = key_format.generate()
+    positions = [i for i, char in enumerate(license_key) if i >= len(KEY_PREFIX) and char != '-']
+
+    for i in positions:
+        assert not key_format.verify(replace_char(license_key, i))
+
+def test_keys_of_another_secret_fail_verification(key_format):
+    other = KeyFormat('other-secret')
+
+    assert not any(key_format.verify(other.generate()) for _ in range(100))
+
+@pytest.mark.parametrize('license_key', [
+    '',
+    'TEST-SNOS-0000-0000-0000-0000-0001',
+    'SNOS-AAAA-BBBB-CCCC-DDDD-EEEE',
+    'SNOS2-000000-000000-000000-000000',
+    'SNOS2-0000000-00000-000000-000000',
+    'SNOS2-00000U-000000-000000-000000',
+    'snos2-000000-000000-000000-000000',
+])
+def test_malformed_keys_fail_verification(key_format, license_key):
+    assert not key_format.verify(license_key)
+
+def test_lowercase_key_fails_verification(key_format):
+    assert not key_format.verify(key_format.generate().lower())
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000)
+    keys = [f'SNOS-KEY-{i}' for i in range(1000)]
+    for license_key in keys:
+        bloom.add(license_key)
+
+    assert all(license_key in bloom for license_key in keys)
+    false_positives = sum(f'UNKNOWN-KEY-{i}' in bloom for i in range(10000))
+    assert false_positives < 300
+
+def test_known_key_filter_tracks_keys_without_mac(storage, key_format):
+    known_keys = KnownKeyFilter(key_format, error_rate=0.000001)
+    # До первой сборки фильтр пропускает все ключи
+    assert known_keys.might_contain('UNKNOWN-KEY')
+
+    created_at = datetime.now().replace(microsecond=0)
+    with storage.connection() as conn:
+        [(_, new_key)] = storage.create_licenses(conn, 1, key_format.generate, created_at,
+                                                 created_at + timedelta(days=30), 1, '', 'tests')
+        storage.import_licenses(conn, [
+            ('legacy-id', 'LEGACY-KEY-1', int(created_at.timestamp()), int(created_at.timestamp()) + 86400,
+             1, 0, 1, 'active', '', 'import', 'import')
+        ])
+        assert known_keys.refresh(storage, conn)
+        assert not known_keys.refresh(storage, conn)
+
+    assert known_keys.might_contain('LEGACY-KEY-1')
+    assert known_keys.might_contain('TEST-SNOS-0000-0000-0000-0000-0001')
+    assert not known_keys.might_contain('UNKNOWN-KEY')
+    # Ключи с верным HMAC в фильтр не попадают
+    assert known_keys.keys == 2
+
+def test_validate_rejects_unknown_keys(client, admin_headers):
+    license_key = client.post('/api/generate', json={}, headers=admin_headers).get_json()['license_key']
+
+    response = client.post('/api/validate', json={'license_key': license_key, 'hwid': 'hwid-1'})
+    assert response.get_json()['message'] == 'License not activated on this device'
+
+    for unknown in (replace_char(license_key, len(license_key) - 1), 'SNOS2-000000-000000-000000-000000'):
+        response = client.post('/api/validate', json={'license_key': unknown, 'hwid': 'hwid-1'})
+        assert response.get_json() == {'valid': False, 'message': 'License key not found'}
+
+def test_legacy_key_missing_from_filter_is_found_in_db(app_module, client):
+    app_module.refresh_key_filter(app_module.get_storage())
+    # Вставка в обход счетчика key_filter_version: ручной SQL или инстанс прошлой версии
+    now = int(datetime.now().timestamp())
+    with app_module.get_storage().connection() as conn:
+        conn.execute('''
+            INSERT INTO licenses (id, license_key, created_at, expires_at, max_activations)
+            VALUES ('manual-id', 'SNOS-MANUAL-0001', ?, ?, 1)
+        ''', (now, now + 86400))
+        conn.commit()
+    assert app_module.check_key('SNOS-MANUAL-0001') is None
+
+    response = client.post('/api/activate', json={'license_key': 'SNOS-MANUAL-0001', 'hwid': 'hwid-1'})
+    assert response.get_json()['success']
+    # Найденный ключ добавлен в фильтр - дальше без запроса к базе
+    assert app_module.check_key('SNOS-MANUAL-0001') is True
+
+    response = client.post('/api/validate', json={'license_key': 'SNOS-MANUAL-0002', 'hwid': 'hwid-1'})
+    assert response.get_json() == {'valid': False, 'message': 'License key not found'}
+
+def test_new_format_key_with_bad_mac_skips_db(app_module, client, monkeypatch):
+    lookups = []
+    monkeypatch.setattr(app_module.get_storage(), 'has_license', lambda conn, key: lookups.append(key))
+    license_key = app_module.key_format.generate()
+
+    response = client.post('/api/activate', json={'license_key': replace_char(license_key, len(license_key) - 1), 'hwid': 'hwid-1'})
+
+    assert response.status_code == 404
+    assert lookups == []
+
+def test_matches_checks_shape_only(key_format):
+    license_key = key_format.generate()
+
+    assert key_format.matches(replace_char(license_key, len(license_key) - 1))
+    assert not key_format.matches('SNOS-AAAA-BBBB-CCCC-DDDD-EEEE')
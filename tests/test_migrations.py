@@ -0,0 +1,140 @@
+"""Обновление базы со схемы исходной версии (до schema_version) до текущей"""
+import sqlite3
+from datetime import datetime, timedelta
+
+from conftest import PRAGMAS
+from storage import TEST_LICENSE_KEY, SQLiteStorage, create_storage
+
+NOW = datetime.now().replace(microsecond=0)
+
+# Схема и формат данных исходного app.py: ISO-строки времени, без UNIQUE(license_key, hwid)
+BASELINE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS licenses (
+        id TEXT PRIMARY KEY,
+        license_key TEXT UNIQUE NOT NULL,
+        created_at TIMESTAMP NOT NULL,
+        expires_at TIMESTAMP NOT NULL,
+        max_activations INTEGER DEFAULT 1,
+        current_activations INTEGER DEFAULT 0,
+        is_active BOOLEAN DEFAULT 1,
+        notes TEXT,
+        created_by TEXT,
+        source TEXT DEFAULT 'server'
+    );
+    CREATE TABLE IF NOT EXISTS activations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        license_key TEXT NOT NULL,
+        hwid TEXT NOT NULL,
+        device_name TEXT,
+        platform TEXT,
+        activation_time TIMESTAMP NOT NULL,
+        ip_address TEXT,
+        user_agent TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_license_key ON licenses(license_key);
+    CREATE INDEX IF NOT EXISTS idx_activations_license ON activations(license_key);
+'''
+
+LICENSES = [
+    # license_key, created_at, expires_at, max_activations, current_activations, is_active
+    (TEST_LICENSE_KEY, NOW, NOW + timedelta(days=365), 999, 0, 1),
+    ('SNOS-AAAA-BBBB-CCCC-DDDD-0001', NOW - timedelta(days=10), NOW + timedelta(days=20), 3, 3, 1),
+    ('SNOS-AAAA-BBBB-CCCC-DDDD-0002', NOW - timedelta(days=40), NOW - timedelta(days=10), 1, 1, 1),
+    ('SNOS-AAAA-BBBB-CCCC-DDDD-0003', NOW - timedelta(days=5), NOW + timedelta(days=25), 1, 0, 0),
+]
+
+ACTIVATIONS = [
+    ('SNOS-AAAA-BBBB-CCCC-DDDD-0001', 'hwid-1', NOW - timedelta(days=9)),
+    ('SNOS-AAAA-BBBB-CCCC-DDDD-0001', 'hwid-2', NOW - timedelta(days=8)),
+    # Дубль из гонки активаций исходной версии
+    ('SNOS-AAAA-BBBB-CCCC-DDDD-0001', 'hwid-2', NOW - timedelta(days=7)),
+    ('SNOS-AAAA-BBBB-CCCC-DDDD-0002', 'hwid-1', NOW - timedelta(days=30)),
+]
+
+def create_baseline_db(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    for i, (license_key, created_at, expires_at, max_activations, current, is_active) in enumerate(LICENSES):
+        conn.execute('''
+            INSERT INTO licenses (id, license_key, created_at, expires_at, max_activations,
+                                  current_activations, is_active, notes, created_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (f'id-{i}', license_key, created_at.isoformat(), expires_at.isoformat(), max_activations,
+              current, is_active, '', 'system'))
+    for license_key, hwid, activation_time in ACTIVATIONS:
+        conn.execute('''
+            INSERT INTO activations (license_key, hwid, device_name, platform, activation_time, ip_address, user_agent)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (license_key, hwid, 'Unknown', 'Unknown', activation_time.isoformat(), '127.0.0.1', 'client'))
+    conn.commit()
+    conn.close()
+
+def migrate(db_path):
+    create_baseline_db(db_path)
+    storage = create_storage(db_path, pragmas=PRAGMAS)
+    storage.init_schema()
+    return storage
+
+def test_baseline_schema_upgrades_to_latest(db_path):
+    storage = migrate(db_path)
+    with storage.connection() as conn:
+        versions = [row['version'] for row in conn.execute('SELECT version FROM schema_version ORDER BY version')]
+        assert versions == [version for version, _ in SQLiteStorage.MIGRATIONS]
+
+        indexes = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert 'idx_activations_license_hwid' in indexes
+        assert 'idx_license_key' not in indexes
+    storage.close()
+
+def test_baseline_data_is_converted(db_path):
+    storage = migrate(db_path)
+    with storage.connection() as conn:
+        licenses = {row['license_key']: dict(row) for row in conn.execute('SELECT * FROM licenses')}
+        for license_key, created_at, expires_at, *_ in LICENSES:
+            assert licenses[license_key]['created_at'] == int(created_at.timestamp())
+            assert licenses[license_key]['expires_at'] == int(expires_at.timestamp())
+            assert licenses[license_key]['version'] == 1
+
+        assert licenses['SNOS-AAAA-BBBB-CCCC-DDDD-0001']['status'] == 'active'
+        assert licenses['SNOS-AAAA-BBBB-CCCC-DDDD-0002']['status'] == 'expired'
+        assert licenses['SNOS-AAAA-BBBB-CCCC-DDDD-0003']['status'] == 'revoked'
+
+        # Дубль активации удален, счетчик лицензии пересчитан по активациям
+        assert licenses['SNOS-AAAA-BBBB-CCCC-DDDD-0001']['current_activations'] == 2
+        times = [row['activation_time'] for row in conn.execute('SELECT activation_time FROM activations')]
+        assert len(times) == 3
+        assert all(isinstance(value, int) for value in times)
+
+        stats, _ = storage.get_stats(conn)
+    assert stats['total_licenses'] == len(LICENSES)
+    assert stats['active_licenses'] == 2
+    assert stats['expired_licenses'] == 1
+    assert stats['revoked_licenses'] == 1
+    assert stats['total_activations'] == 3
+    assert stats['unique_devices'] == 2
+    storage.close()
+
+def test_upgraded_database_accepts_activations(db_path):
+    storage = migrate(db_path)
+    license_key = 'SNOS-AAAA-BBBB-CCCC-DDDD-0001'
+    with storage.connection() as conn:
+        assert storage.activate(conn, license_key, 'hwid-2', 'device', 'test', datetime.now(),
+                                '127.0.0.1', 'pytest')[0] == 'already_activated'
+        assert storage.activate(conn, license_key, 'hwid-3', 'device', 'test', datetime.now(),
+                                '127.0.0.1', 'pytest')[0] == 'activated'
+        assert storage.activate(conn, license_key, 'hwid-4', 'device', 'test', datetime.now(),
+                                '127.0.0.1', 'pytest')[0] == 'max_reached'
+    storage.close()
+
+def test_migrations_are_applied_once(db_path):
+    migrate(db_path).close()
+    with sqlite3.connect(db_path) as conn:
+        before = conn.execute('SELECT * FROM licenses ORDER BY id').fetchall()
+
+    storage = create_storage(db_path, pragmas=PRAGMAS)
+    storage.init_schema()
+    storage.close()
+
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT * FROM licenses ORDER BY id').fetchall() == before
+        assert conn.execute('SELECT COUNT(*) FROM schema_version').fetchone()[0] == len(SQLiteStorage.MIGRATIONS)
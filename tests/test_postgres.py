@@ -0,0 +1,312 @@
+"""PostgresStorage на живом сервере: запускается при заданном PG_TEST_URL
+
+Каждый тест работает в собственной схеме (search_path), которая удаляется
+после теста, поэтому базу можно делить с другими прогонами.
+"""
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+from licensekeys import KeyFormat
+from storage import LICENSE_COLUMNS, TEST_LICENSE_KEY, PostgresStorage
+from test_activation import DEVICES, MAX_ACTIVATIONS, activate_concurrently, activation_state, create_license
+
+PG_TEST_URL = os.environ.get('PG_TEST_URL')
+
+pytestmark = pytest.mark.skipif(not PG_TEST_URL, reason='PG_TEST_URL is not set')
+
+NOW = datetime.now().replace(microsecond=0)
+
+@pytest.fixture
+def pg_dsn():
+    """DSN с search_path на свежую схему"""
+    psycopg2 = pytest.importorskip('psycopg2')
+    from psycopg2.extensions import make_dsn
+
+    schema = f'snos_test_{uuid.uuid4().hex[:12]}'
+    admin = psycopg2.connect(PG_TEST_URL)
+    admin.autocommit = True
+    with admin.cursor() as c:
+        c.execute(f'CREATE SCHEMA {schema}')
+    try:
+        yield make_dsn(PG_TEST_URL, options=f'-csearch_path={schema}')
+    finally:
+        with admin.cursor() as c:
+            c.execute(f'DROP SCHEMA {schema} CASCADE')
+        admin.close()
+
+@pytest.fixture
+def pg_admin(pg_dsn):
+    """Отдельное соединение вне пулов хранилища (DDL, блокировки из "другого воркера")"""
+    import psycopg2
+
+    conn = psycopg2.connect(pg_dsn)
+    yield conn
+    conn.close()
+
+@pytest.fixture
+def storage(pg_dsn):
+    """Имя совпадает с фикстурой conftest, чтобы переиспользовать хелперы test_activation"""
+    storage = PostgresStorage(pg_dsn, pool_size=16)
+    storage.init_schema()
+    yield storage
+    storage.close()
+
+def create_licenses(storage, count, expires_at, max_activations=MAX_ACTIVATIONS):
+    with storage.connection() as conn:
+        return [license_key for _, license_key in storage.create_licenses(
+            conn, count, KeyFormat('test').generate, NOW - timedelta(days=60), expires_at,
+            max_activations, '', 'tests'
+        )]
+
+def activate(storage, license_key, hwid):
+    with storage.connection() as conn:
+        return storage.activate(conn, license_key, hwid, 'device', 'test', datetime.now(), '127.0.0.1', 'pytest')[0]
+
+def get_stats(storage):
+    with storage.connection() as conn:
+        return storage.get_stats(conn)[0]
+
+# ----- Миграции -----
+def test_fresh_schema_has_all_migrations(storage, pg_admin):
+    with pg_admin.cursor() as c:
+        c.execute('SELECT version FROM schema_version ORDER BY version')
+        assert [row[0] for row in c.fetchall()] == [version for version, _ in PostgresStorage.MIGRATIONS]
+        c.execute("SELECT data_type FROM information_schema.columns WHERE table_schema = current_schema() "
+                  "AND table_name = 'licenses' AND column_name = 'expires_at'")
+        assert c.fetchone()[0] == 'bigint'
+
+    with storage.connection() as conn:
+        assert storage.get_license(conn, TEST_LICENSE_KEY)['status'] == 'active'
+
+def test_text_timestamp_schema_upgrades_to_latest(pg_dsn):
+    storage = PostgresStorage(pg_dsn, pool_size=2)
+    # Схема до schema_version: время - ISO-строки
+    with storage.connection() as conn:
+        with storage.transaction(conn) as c:
+            storage._migration_base_schema(c)
+            for i, (expires_at, is_active) in enumerate([(NOW + timedelta(days=20), 1),
+                                                          (NOW - timedelta(days=10), 1),
+                                                          (NOW + timedelta(days=20), 0)]):
+                c.execute('''
+                    INSERT INTO licenses (id, license_key, created_at, expires_at, max_activations,
+                                          current_activations, is_active, notes, created_by)
+                    VALUES (%s, %s, %s, %s, 3, 0, %s, '', 'system')
+                ''', (f'id-{i}', f'SNOS-AAAA-BBBB-CCCC-DDDD-000{i}', NOW.astimezone().isoformat(),
+                      expires_at.astimezone().isoformat(), is_active))
+            c.execute('''
+                INSERT INTO activations (license_key, hwid, activation_time)
+                VALUES ('SNOS-AAAA-BBBB-CCCC-DDDD-0000', 'hwid-1', %s)
+            ''', (NOW.astimezone().isoformat(),))
+
+    storage.init_schema()
+    with storage.connection() as conn:
+        rows = {key: storage.get_license(conn, key) for key in
+                ('SNOS-AAAA-BBBB-CCCC-DDDD-0000', 'SNOS-AAAA-BBBB-CCCC-DDDD-0001', 'SNOS-AAAA-BBBB-CCCC-DDDD-0002')}
+        assert [row['status'] for row in rows.values()] == ['active', 'expired', 'revoked']
+        assert rows['SNOS-AAAA-BBBB-CCCC-DDDD-0000']['created_at'] == int(NOW.timestamp())
+        assert storage.activate(conn, 'SNOS-AAAA-BBBB-CCCC-DDDD-0000', 'hwid-1', 'device', 'test', datetime.now(),
+                                '127.0.0.1', 'pytest')[0] == 'already_activated'
+
+    # Повторный старт ничего не применяет заново
+    storage.init_schema()
+    with storage.connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT COUNT(*) AS count FROM schema_version')
+        assert c.fetchone()['count'] == len(PostgresStorage.MIGRATIONS)
+    storage.close()
+
+# ----- Активация -----
+def test_concurrent_activations_respect_limit(storage):
+    license_key = create_license(storage)
+
+    results = activate_concurrently(storage, license_key, [f'hwid-{i}' for i in range(DEVICES)])
+
+    assert results.count('activated') == MAX_ACTIVATIONS
+    assert results.count('max_reached') == DEVICES - MAX_ACTIVATIONS
+    current_activations, hwids = activation_state(storage, license_key)
+    assert current_activations == MAX_ACTIVATIONS
+    assert len(hwids) == MAX_ACTIVATIONS
+
+def test_concurrent_activations_of_one_device_take_one_slot(storage):
+    license_key = create_license(storage)
+
+    results = activate_concurrently(storage, license_key, ['hwid-same'] * 8)
+
+    assert results.count('activated') == 1
+    assert set(results) <= {'activated', 'already_activated'}
+    assert activation_state(storage, license_key) == (1, ['hwid-same'])
+
+def test_activation_updates_counters_in_one_statement(storage):
+    license_key = create_license(storage)
+    before = get_stats(storage)
+
+    assert activate(storage, license_key, 'hwid-1') == 'activated'
+    assert activate(storage, license_key, 'hwid-1') == 'already_activated'
+    # Устройство уже известно - unique_devices не растет
+    other_key = create_license(storage)
+    assert activate(storage, other_key, 'hwid-1') == 'activated'
+
+    after = get_stats(storage)
+    assert after['total_activations'] - before['total_activations'] == 2
+    assert after['unique_devices'] - before['unique_devices'] == 1
+    with storage.connection() as conn:
+        assert storage.get_license(conn, license_key)['version'] == 2
+        assert sum(storage.get_stats(conn)[1].values()) == after['total_activations']
+
+def test_activate_many_stops_at_limit(storage):
+    license_key = create_license(storage)
+    activations = [
+        (license_key, f'hwid-{i}', 'device', 'test', datetime.now(), '127.0.0.1', 'pytest')
+        for i in range(MAX_ACTIVATIONS + 2)
+    ]
+
+    with storage.connection() as conn:
+        results = storage.activate_many(conn, activations)
+
+    assert [result[0] for result in results] == ['activated'] * MAX_ACTIVATIONS + ['max_reached'] * 2
+    assert activation_state(storage, license_key)[0] == MAX_ACTIVATIONS
+
+# ----- Подготовленные выражения -----
+def test_prepared_statement_survives_schema_change(storage, pg_admin):
+    license_key = create_license(storage)
+    conn = storage.acquire()
+    try:
+        assert storage.get_license(conn, license_key)['license_key'] == license_key
+        assert 'get_license' in conn.prepared
+        conn.rollback()
+
+        # Миграция другого инстанса меняет тип столбца из результата выражения
+        with pg_admin.cursor() as c:
+            c.execute('ALTER TABLE licenses ALTER COLUMN notes TYPE VARCHAR(1000)')
+        pg_admin.commit()
+
+        assert storage.get_license(conn, license_key)['license_key'] == license_key
+        assert 'get_license' in conn.prepared
+    finally:
+        storage.release(conn)
+
+# ----- Фоновое обслуживание -----
+def test_sweep_expired_marks_licenses_in_batches(storage):
+    expired = create_licenses(storage, 5, NOW - timedelta(days=1))
+    create_licenses(storage, 2, NOW + timedelta(days=1))
+    before = get_stats(storage)
+
+    with storage.connection() as conn:
+        assert sorted(storage.sweep_expired(conn, batch_size=2)) == sorted(expired)
+        assert storage.sweep_expired(conn, batch_size=2) == []
+        assert {storage.get_license(conn, key)['status'] for key in expired} == {'expired'}
+
+    after = get_stats(storage)
+    assert after['active_licenses'] == before['active_licenses'] - 5
+    assert after['expired_licenses'] == before['expired_licenses'] + 5
+
+def expired_with_activations(storage, count, devices):
+    """Лицензии с активациями, уже истекшие и отмеченные обходом"""
+    keys = create_licenses(storage, count, NOW - timedelta(days=2), max_activations=devices)
+    for key in keys:
+        for i in range(devices):
+            assert activate(storage, key, f'{key}-hwid-{i}') == 'activated'
+    with storage.connection() as conn:
+        storage.sweep_expired(conn, batch_size=100)
+    return keys
+
+def count_rows(storage, table, license_key):
+    with storage.connection() as conn:
+        c = conn.cursor()
+        c.execute(f'SELECT COUNT(*) AS count FROM {table} WHERE license_key = %s', (license_key,))
+        return c.fetchone()['count']
+
+def test_archive_skips_rows_locked_by_another_worker(storage, pg_admin):
+    locked_key, free_key = expired_with_activations(storage, 2, devices=3)
+
+    # Другой воркер держит активации первой лицензии
+    with pg_admin.cursor() as c:
+        c.execute('SELECT id FROM activations WHERE license_key = %s FOR UPDATE', (locked_key,))
+
+    result = {}
+
+    def archive():
+        with storage.connection() as conn:
+            result['archived'] = storage.archive_activations(conn, int(time.time()), batch_size=2)
+
+    worker = threading.Thread(target=archive)
+    worker.start()
+    worker.join(timeout=10)
+    assert not worker.is_alive(), 'archive_activations waited for locked rows'
+
+    assert result['archived'] == 3
+    assert count_rows(storage, 'activations', locked_key) == 3
+    assert count_rows(storage, 'activations_archive', free_key) == 3
+
+    pg_admin.rollback()
+    with storage.connection() as conn:
+        assert storage.archive_activations(conn, int(time.time()), batch_size=2) == 3
+    assert count_rows(storage, 'activations', locked_key) == 0
+    # Архивные активации остаются в итогах и в проверке нового устройства
+    assert get_stats(storage)['total_activations'] == 6
+    assert activate(storage, create_license(storage), f'{locked_key}-hwid-0') == 'activated'
+    assert get_stats(storage)['unique_devices'] == 6
+
+def test_compact_folds_archive_into_daily_summaries(storage):
+    [license_key] = expired_with_activations(storage, 1, devices=4)
+    with storage.connection() as conn:
+        assert storage.archive_activations(conn, int(time.time()), batch_size=100) == 4
+        version = storage.get_license(conn, license_key)['version']
+
+        assert storage.compact_activations(conn, int(time.time()) + 1, batch_size=3) == 4
+        assert storage.get_activation_summaries(conn, license_key) == [
+            {'day': datetime.now().date().isoformat(), 'activations': 4}
+        ]
+        assert storage.get_license(conn, license_key)['version'] > version
+    assert count_rows(storage, 'activations_archive', license_key) == 0
+    assert get_stats(storage)['total_activations'] == 4
+
+# ----- Потоковое чтение и импорт -----
+def test_license_rows_stream_through_named_cursor(storage):
+    create_licenses(storage, 2500, NOW + timedelta(days=30))
+
+    with storage.connection() as conn:
+        rows = storage.iter_license_rows(conn)
+        first = next(rows)
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) AS count FROM pg_cursors WHERE name LIKE 'stream_%'")
+        assert c.fetchone()['count'] == 1
+
+        ids = [first['id']] + [row['id'] for row in rows]
+        assert len(ids) == 2501
+        assert ids == sorted(ids)
+        assert set(first) == set(LICENSE_COLUMNS)
+
+        page = list(storage.iter_licenses(conn, limit=10, created_by='tests'))
+        assert len(page) == 10
+        assert all(row['activation_count'] == 0 for row in page)
+
+def test_import_skips_existing_and_reconciles_stats(storage):
+    epoch = int(NOW.timestamp())
+    rows = [
+        (f'import-{i}', f'SNOS-IMPO-RTED-0000-{i:04d}', epoch, epoch + 86400, 2, 0, 1 if i else 0,
+         'active' if i else 'revoked', '', 'import', 'import')
+        for i in range(5)
+    ]
+    with storage.connection() as conn:
+        version = storage.get_counter(conn, 'revocation_version')
+        assert storage.import_licenses(conn, rows, chunk_size=2) == (5, 0)
+        assert storage.import_licenses(conn, rows, chunk_size=2) == (0, 5)
+        assert storage.get_counter(conn, 'revocation_version') > version
+        assert 'SNOS-IMPO-RTED-0000-0000' in storage.list_revoked_keys(conn)
+
+        activations = [('SNOS-IMPO-RTED-0000-0001', 'hwid-1', 'device', 'test', epoch, '127.0.0.1', 'import'),
+                       ('SNOS-IMPO-RTED-0000-0001', 'hwid-1', 'device', 'test', epoch, '127.0.0.1', 'import'),
+                       ('SNOS-UNKN-OWN0-0000-0000', 'hwid-1', 'device', 'test', epoch, '127.0.0.1', 'import')]
+        assert storage.import_activations(conn, activations) == (1, 2)
+        assert storage.get_license(conn, 'SNOS-IMPO-RTED-0000-0001')['current_activations'] == 1
+
+    stats = get_stats(storage)
+    assert stats['total_licenses'] == 6
+    assert stats['revoked_licenses'] == 1
+    assert stats['total_activations'] == 1
@@ -0,0 +1,127 @@
+"""Ограничение частоты запросов: token bucket, Lua-скрипт Redis, ответ 429"""
+import pytest
+
+import ratelimit
+from ratelimit import TokenBucketLimiter, create_rate_limiter, retry_after_header
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+def test_burst_then_retry_after(clock):
+    limiter = TokenBucketLimiter(rate=2, burst=3, clock=clock)
+
+    assert [limiter.hit('ip') for _ in range(3)] == [0, 0, 0]
+    assert limiter.hit('ip') == pytest.approx(0.5)
+
+def test_tokens_refill_at_rate(clock):
+    limiter = TokenBucketLimiter(rate=2, burst=3, clock=clock)
+    for _ in range(3):
+        limiter.hit('ip')
+
+    clock.advance(0.25)
+    assert limiter.hit('ip') == pytest.approx(0.25)
+    clock.advance(0.25)
+    assert limiter.hit('ip') == 0
+    assert limiter.hit('ip') > 0
+
+def test_refill_is_capped_by_burst(clock):
+    limiter = TokenBucketLimiter(rate=2, burst=3, clock=clock)
+    limiter.hit('ip')
+
+    clock.advance(3600)
+    assert [limiter.hit('ip') for _ in range(3)] == [0, 0, 0]
+    assert limiter.hit('ip') > 0
+
+def test_keys_have_separate_buckets_and_old_ones_are_evicted(clock):
+    limiter = TokenBucketLimiter(rate=1, burst=1, max_keys=2, clock=clock)
+
+    assert limiter.hit('a') == 0
+    assert limiter.hit('b') == 0
+    assert limiter.hit('a') > 0
+    # 'b' использован раньше 'a' - вытесняется третьим ключом и начинает с полной корзины
+    assert limiter.hit('c') == 0
+    assert limiter.hit('b') == 0
+
+@pytest.mark.parametrize('rate', [0, -1])
+def test_zero_rate_disables_limiter(rate):
+    assert create_rate_limiter('', rate, 10, 'ip') is None
+
+def test_retry_after_header_rounds_up():
+    assert retry_after_header(0.01) == '1'
+    assert retry_after_header(1.2) == '2'
+    assert retry_after_header(3) == '3'
+
+def test_api_returns_429_with_retry_after(app_module, client, clock, monkeypatch):
+    monkeypatch.setattr(app_module, 'ip_rate_limiter', TokenBucketLimiter(rate=0.5, burst=2, clock=clock))
+    body = {'license_key': 'TEST-SNOS-0000-0000-0000-0000-0001', 'hwid': ''}
+
+    assert [client.post('/api/validate', json=body).status_code for _ in range(2)] == [200, 200]
+    response = client.post('/api/validate', json=body)
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '2'
+    assert response.get_json()['retry_after'] == 2
+
+    clock.advance(2)
+    assert client.post('/api/validate', json=body).status_code == 200
+
+def test_api_limits_by_license_key(app_module, client, clock, monkeypatch):
+    monkeypatch.setattr(app_module, 'key_rate_limiter', TokenBucketLimiter(rate=1, burst=1, clock=clock))
+
+    first = {'license_key': 'SNOS-AAAA-0001', 'hwid': 'hwid-1'}
+    assert client.post('/api/activate', json=first).status_code != 429
+    assert client.post('/api/activate', json=first).status_code == 429
+    other = {'license_key': 'SNOS-AAAA-0002', 'hwid': 'hwid-1'}
+    assert client.post('/api/activate', json=other).status_code != 429
+
+def test_api_without_limiters_never_returns_429(app_module, client):
+    # Окружение тестов задает RATE_LIMIT_*_RATE=0
+    assert app_module.ip_rate_limiter is None and app_module.key_rate_limiter is None
+
+    body = {'license_key': 'TEST-SNOS-0000-0000-0000-0000-0001', 'hwid': ''}
+    assert all(client.post('/api/validate', json=body).status_code == 200 for _ in range(50))
+
+@pytest.fixture
+def redis_limiter(clock, monkeypatch):
+    """RedisRateLimiter на fakeredis; TIME в Lua-скрипте берется из clock"""
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    import redis
+    from fakeredis.commands_mixins import server_mixin
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, 'from_url', classmethod(lambda cls, url, **kwargs: fakeredis.FakeRedis(server=server)))
+    monkeypatch.setattr(server_mixin, 'time', type('FakeTime', (), {'time': staticmethod(clock)}))
+    return create_rate_limiter('redis://localhost', 2, 3, 'ip')
+
+def test_redis_burst_and_refill(redis_limiter, clock):
+    assert isinstance(redis_limiter, ratelimit.RedisRateLimiter)
+    assert [redis_limiter.hit('ip') for _ in range(3)] == [0, 0, 0]
+    assert redis_limiter.hit('ip') == pytest.approx(0.5)
+
+    clock.advance(0.5)
+    assert redis_limiter.hit('ip') == 0
+    assert redis_limiter.hit('ip') > 0
+
+    clock.advance(3600)
+    assert [redis_limiter.hit('ip') for _ in range(3)] == [0, 0, 0]
+    assert redis_limiter.hit('other') == 0
+
+def test_redis_errors_allow_requests(redis_limiter, monkeypatch):
+    import redis
+
+    def fail(*args, **kwargs):
+        raise redis.ConnectionError('down')
+
+    monkeypatch.setattr(redis_limiter, '_script', fail)
+    assert redis_limiter.hit('ip') == 0
@@ -0,0 +1,122 @@
+"""Подписанный список отзыва: подпись, монотонная версия, ETag"""
+import base64
+import json
+import time
+
+import pytest
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+
+def b64url_decode(value):
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+@pytest.fixture
+def public_key(client):
+    data = client.get('/api/token/public-key').get_json()
+    return Ed25519PublicKey.from_public_bytes(base64.b64decode(data['public_key']))
+
+def fetch_payload(client, public_key):
+    """Тело ответа и проверенный подписью payload"""
+    body = client.get('/api/revocations').get_json()
+    payload = b64url_decode(body['payload'])
+    public_key.verify(b64url_decode(body['signature']), payload)
+    return body, json.loads(payload)
+
+def revoke(client, admin_headers):
+    license_key = client.post('/api/generate', json={}, headers=admin_headers).get_json()['license_key']
+    response = client.post('/api/revoke', json={'license_key': license_key}, headers=admin_headers)
+    assert response.get_json()['success']
+    return license_key
+
+def test_revocation_list_is_signed(client, public_key):
+    body, payload = fetch_payload(client, public_key)
+
+    assert payload['version'] == body['version']
+    assert payload['revoked'] == body['revoked']
+    assert payload['issued_at'] <= time.time() < payload['expires_at']
+    # Подписан канонический JSON: ключи отсортированы, без пробелов
+    assert b64url_decode(body['payload']) == json.dumps(payload, separators=(',', ':'), sort_keys=True).encode()
+
+def test_tampered_payload_fails_verification(client, public_key):
+    body = client.get('/api/revocations').get_json()
+    payload = json.loads(b64url_decode(body['payload']))
+    # Старый список нельзя выдать за свежий, подняв версию
+    payload['version'] += 1
+    tampered = json.dumps(payload, separators=(',', ':'), sort_keys=True).encode()
+
+    with pytest.raises(InvalidSignature):
+        public_key.verify(b64url_decode(body['signature']), tampered)
+
+def test_revoke_bumps_version_and_lists_key(client, public_key, admin_headers):
+    _, before = fetch_payload(client, public_key)
+
+    license_key = revoke(client, admin_headers)
+    _, after = fetch_payload(client, public_key)
+
+    assert after['version'] == before['version'] + 1
+    assert license_key in after['revoked']
+    assert license_key not in before['revoked']
+    assert after['revoked'] == sorted(after['revoked'])
+
+def test_repeated_revoke_keeps_version(client, public_key, admin_headers):
+    license_key = revoke(client, admin_headers)
+    _, before = fetch_payload(client, public_key)
+
+    client.post('/api/revoke', json={'license_key': license_key}, headers=admin_headers)
+    _, after = fetch_payload(client, public_key)
+
+    assert after['version'] == before['version']
+    assert after['revoked'] == before['revoked']
+
+def test_revocation_list_etag(client, admin_headers):
+    response = client.get('/api/revocations')
+    etag = response.headers['ETag']
+
+    assert client.get('/api/revocations', headers={'If-None-Match': etag}).status_code == 304
+
+    revoke(client, admin_headers)
+    response = client.get('/api/revocations', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+def test_revoke_requires_admin_key(client):
+    response = client.post('/api/revoke', json={'license_key': 'SNOS-AAAA'}, headers={'X-API-Key': 'wrong'})
+    assert response.status_code == 401
+
+def test_rebuilt_list_keeps_etag(app_module, client, monkeypatch):
+    """Пересборка после TTL и другой воркер без нового отзыва отдают тот же ETag"""
+    etag = client.get('/api/revocations').headers['ETag']
+
+    for _ in range(2):
+        # Новый экземпляр с нулевым TTL - как соседний воркер или истекший кэш
+        monkeypatch.setattr(app_module, 'revocation_list', app_module.RevocationList(ttl=0))
+        response = client.get('/api/revocations', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+
+def test_rebuilt_list_body_is_identical(app_module):
+    load_version, load_keys = lambda: 7, lambda: ['SNOS-AAAA-0001']
+    first = app_module.RevocationList(ttl=0).get(load_version, load_keys)
+    second = app_module.RevocationList(ttl=0).get(load_version, load_keys)
+
+    assert first == second
+
+def test_list_is_resigned_each_period(app_module, monkeypatch):
+    revocations = app_module.RevocationList(ttl=0, period=100)
+    loads = []
+
+    def load_keys():
+        loads.append(1)
+        return []
+
+    monkeypatch.setattr(app_module.time, 'time', lambda: 1000)
+    _, etag = revocations.get(lambda: 1, load_keys)
+    monkeypatch.setattr(app_module.time, 'time', lambda: 1099)
+    assert revocations.get(lambda: 1, load_keys)[1] == etag
+    assert len(loads) == 1
+
+    monkeypatch.setattr(app_module.time, 'time', lambda: 1100)
+    body, new_etag = revocations.get(lambda: 1, load_keys)
+    assert new_etag != etag
+    assert json.loads(body)['issued_at'] == 1100
+    assert len(loads) == 2
@@ -0,0 +1,129 @@
+"""Общий mmap-кэш лицензий: записи, seqlock, смена разметки файла"""
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import sharedcache
+from sharedcache import HEADER_SIZE, SEQ, SharedLicenseCache
+
+def license_dict(current_activations=0, max_activations=3, status='active'):
+    return {
+        'status': status,
+        'expires_at': 2_000_000_000,
+        'max_activations': max_activations,
+        'current_activations': current_activations,
+        'is_active': status != 'revoked'
+    }
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'license-cache')
+
+def test_set_get_invalidate(cache_path):
+    cache = SharedLicenseCache(cache_path, size=64, ttl=60)
+    cache.set('SNOS-KEY-1', license_dict(current_activations=2), ['hwid-1', 'hwid-2'])
+
+    license_row, fingerprints, complete = cache.get('SNOS-KEY-1')
+    assert license_row['current_activations'] == 2
+    assert fingerprints == {cache.fingerprint('hwid-1'), cache.fingerprint('hwid-2')}
+    assert complete
+
+    # Другой процесс хоста видит ту же запись
+    assert SharedLicenseCache(cache_path, size=64, ttl=60).get('SNOS-KEY-1')[0] == license_row
+
+    cache.invalidate('SNOS-KEY-1')
+    assert cache.get('SNOS-KEY-1') is None
+
+def test_expired_record_is_a_miss(cache_path):
+    cache = SharedLicenseCache(cache_path, size=64, ttl=-1)
+    cache.set('SNOS-KEY-1', license_dict(), [])
+
+    assert cache.get('SNOS-KEY-1') is None
+
+def record_offset(cache, license_key):
+    bucket = cache._bucket(cache._hash(license_key))
+    for slot in range(sharedcache.BUCKET_SLOTS):
+        offset = bucket + slot * sharedcache.RECORD_SIZE
+        if cache._read(offset)[0] == cache._hash(license_key):
+            return offset
+    raise AssertionError('record not found')
+
+def test_reader_skips_record_being_written(cache_path):
+    cache = SharedLicenseCache(cache_path, size=64, ttl=60)
+    cache.set('SNOS-KEY-1', license_dict(), [])
+    offset = record_offset(cache, 'SNOS-KEY-1')
+    seq = SEQ.unpack_from(cache._map, offset)[0]
+
+    # Нечетный счетчик - писатель посреди записи: читатель не берет запись
+    SEQ.pack_into(cache._map, offset, seq + 1)
+    assert cache.get('SNOS-KEY-1') is None
+
+    SEQ.pack_into(cache._map, offset, seq + 2)
+    assert cache.get('SNOS-KEY-1') is not None
+
+def _write_forever(cache_path, stop):
+    cache = SharedLicenseCache(cache_path, size=64, ttl=60)
+    i = 0
+    while not stop.is_set():
+        i += 1
+        cache.set('SNOS-KEY-1', license_dict(current_activations=i % 1000, max_activations=i % 1000 + 1),
+                  [f'hwid-{i}'])
+
+def test_concurrent_reader_sees_whole_records(cache_path):
+    cache = SharedLicenseCache(cache_path, size=64, ttl=60)
+    cache.set('SNOS-KEY-1', license_dict(current_activations=0, max_activations=1), ['hwid-0'])
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    writer = context.Process(target=_write_forever, args=(cache_path, stop))
+    writer.start()
+    try:
+        reads = 0
+        deadline = time.monotonic() + 1
+        while time.monotonic() < deadline:
+            entry = cache.get('SNOS-KEY-1')
+            if entry is None:
+                continue
+            license_row, fingerprints, _ = entry
+            # Поля записи писались вместе: смешение двух версий нарушило бы связь
+            i = license_row['max_activations'] - 1
+            assert license_row['current_activations'] == i
+            assert len(fingerprints) == 1
+            reads += 1
+        assert reads > 0
+    finally:
+        stop.set()
+        writer.join(5)
+
+def test_layout_change_uses_another_file(cache_path):
+    small = SharedLicenseCache(cache_path, size=64, ttl=60)
+    small.set('SNOS-KEY-1', license_dict(), [])
+    size = os.path.getsize(small.file)
+
+    large = SharedLicenseCache(cache_path, size=256, ttl=60)
+    large.set('SNOS-KEY-2', license_dict(), [])
+
+    assert large.file != small.file
+    assert os.path.getsize(small.file) == size
+    # Старая разметка продолжает работать с уже открытым файлом
+    assert small.get('SNOS-KEY-1') is not None
+    assert large.get('SNOS-KEY-1') is None
+
+def test_broken_file_is_replaced_not_truncated(cache_path):
+    cache = SharedLicenseCache(cache_path, size=64, ttl=60)
+    cache.set('SNOS-KEY-1', license_dict(), [])
+    inode = os.stat(cache.file).st_ino
+    size = os.path.getsize(cache.file)
+
+    # Заголовок испорчен на диске: следующий процесс размечает новый файл
+    with open(cache.file, 'r+b') as f:
+        f.write(b'GARBAGE!')
+    fresh = SharedLicenseCache(cache_path, size=64, ttl=60)
+    assert fresh.get('SNOS-KEY-1') is None
+
+    assert os.stat(fresh.file).st_ino != inode
+    # Процесс со старым mmap не получает SIGBUS: его файл не усекался
+    assert len(cache._map) == size
+    assert cache.get('SNOS-KEY-1') is not None
+    assert os.pread(fresh._fd, HEADER_SIZE, 0)[:8] == sharedcache.MAGIC